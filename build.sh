@@ -10,3 +10,6 @@ python manage.py collectstatic --no-input
 
 # Apply any outstanding database migrations
 python manage.py migrate
+
+# Resync the precomputed catalog facet counts
+python manage.py rebuild_facet_counts
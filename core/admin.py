@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from core.models import Product, Category, Order, Cart, CartItem, User, Address
+from core.models import Product, Category, Order, Cart, CartItem, User, Address, OrderLine, CheckoutJob, StockCounter, \
+    StockReservation
 from custom_user.admin import EmailUserAdmin
 
 from django.utils.translation import gettext_lazy as _
@@ -34,3 +35,7 @@ admin.site.register(Cart)
 admin.site.register(CartItem)
 admin.site.register(User, CustomUserAdmin)
 admin.site.register(Address)
+admin.site.register(OrderLine)
+admin.site.register(CheckoutJob)
+admin.site.register(StockCounter)
+admin.site.register(StockReservation)
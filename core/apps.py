@@ -1,6 +1,12 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
+
+    def ready(self):
+        from core import checks, instrumentation, signals  # noqa: F401
+        from core.search import ensure_sqlite_index
+        post_migrate.connect(ensure_sqlite_index, sender=self)
@@ -0,0 +1,131 @@
+"""
+Async versions of the catalog and active cart read paths.
+
+Under `djangoEcommerce.asgi` these run on the event loop: the JWT is checked
+against the cached user, cached responses and the cart store are read with
+the async cache API and pages are loaded with the async ORM. A request waiting
+on a slow client or on the database holds no worker thread, the middleware
+chain in front of them runs async too (see core.static). Only cache misses
+that have to write (creating a cart, loading a user) fall back to the sync
+code in a thread.
+
+They answer the same as their DRF counterparts in core.views, including the
+response cache, ETags and 304s, and are routed under `/api/async/` so both
+paths can be compared side by side (see the benchmark_read_path command).
+"""
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.http import HttpResponse, JsonResponse
+from rest_framework.exceptions import APIException, NotAuthenticated, NotFound
+from rest_framework.request import Request
+from rest_framework.status import HTTP_304_NOT_MODIFIED, HTTP_405_METHOD_NOT_ALLOWED
+from rest_framework.utils.encoders import JSONEncoder
+
+from core.authentication import CachedJWTCookieAuthentication
+from core.facets import facet_counts, filter_products, parse_filters
+from core.models import Category, Product
+from core.pagination import KeysetPagination
+from core.response_cache import RESPONSE_CACHE_TIMEOUT, aget_version_state, building_reads, etag_matches, make_entry, \
+    make_key
+from core.serializers import ListCategorySerializer, ListProductSerializer, RetrieveCategorySerializer, \
+    RetrieveProductSerializer
+from core.services import cart_store
+
+
+def api_view(view):
+    """Authenticate the request and turn DRF's exceptions into JSON errors, like APIView does."""
+    authentication = CachedJWTCookieAuthentication()
+
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method != 'GET':
+            return JsonResponse({'detail': f'Method "{request.method}" not allowed.'}, status=HTTP_405_METHOD_NOT_ALLOWED)
+        try:
+            result = await authentication.aauthenticate(request)
+            if result is None:
+                raise NotAuthenticated()
+            # DRF's request only for query_params and the serializers' context, it never reads the body
+            request = Request(request)
+            request.user = result[0]
+            return await view(request, *args, **kwargs)
+        except APIException as exc:
+            detail = exc.detail if isinstance(exc.detail, (list, dict)) else {'detail': exc.detail}
+            response = JsonResponse(detail, status=exc.status_code, safe=False)
+            if exc.status_code == 401:
+                response['WWW-Authenticate'] = authentication.authenticate_header(request)
+            return response
+    return wrapper
+
+
+async def cached(request, name, dependencies, build, kwargs=None):
+    """Serve `build()` through the response cache, the async twin of CachedResponseMixin."""
+    versions, recent = await aget_version_state(dependencies)
+    key = make_key(f'async:{name}', [
+        request.get_host(),
+        request.path,
+        sorted((key, sorted(values)) for key, values in request.query_params.lists()),
+        sorted((kwargs or {}).items()),
+        sorted(versions.items()),
+    ])
+    entry = await cache.aget(key)
+    if entry is None:
+        with building_reads(recent):
+            entry = make_entry(await build())
+        await cache.aadd(key, entry, RESPONSE_CACHE_TIMEOUT)
+    if etag_matches(request, entry['etag']):
+        return HttpResponse(status=HTTP_304_NOT_MODIFIED, headers={'ETag': entry['etag']})
+    return JsonResponse(entry['data'], encoder=JSONEncoder, safe=False, headers={'ETag': entry['etag']})
+
+
+@api_view
+async def product_list(request):
+    async def build():
+        filters = parse_filters(request.query_params)
+        queryset = filter_products(Product.objects.prefetch_related('categories'), *filters)
+        paginator = KeysetPagination()
+        page = await paginator.apaginate_queryset(queryset, request)
+        data = paginator.get_paginated_response(
+            ListProductSerializer(page, many=True, context={'request': request}).data).data
+        data['facets'] = await sync_to_async(facet_counts)(*filters)
+        return data
+
+    return await cached(request, 'product:list', ('product', 'category'), build)
+
+
+@api_view
+async def product_detail(request, pk):
+    async def build():
+        try:
+            product = await Product.objects.prefetch_related('categories').aget(pk=pk)
+        except Product.DoesNotExist:
+            raise NotFound('No Product matches the given query.')
+        return RetrieveProductSerializer(product, context={'request': request}).data
+
+    return await cached(request, 'product:retrieve', ('product', 'category'), build, {'pk': pk})
+
+
+@api_view
+async def category_list(request):
+    async def build():
+        return ListCategorySerializer([category async for category in Category.objects.all()], many=True).data
+
+    return await cached(request, 'category:list', ('category',), build)
+
+
+@api_view
+async def category_detail(request, pk):
+    async def build():
+        try:
+            category = await Category.objects.aget(pk=pk)
+        except Category.DoesNotExist:
+            raise NotFound('No Category matches the given query.')
+        return RetrieveCategorySerializer(category).data
+
+    return await cached(request, 'category:retrieve', ('category',), build, {'pk': pk})
+
+
+@api_view
+async def active_cart(request):
+    return JsonResponse(await cart_store.aget_active_cart(request.user), encoder=JSONEncoder)
@@ -0,0 +1,130 @@
+"""
+JWT authentication that builds the request user from the cache.
+
+Access tokens carry the user's `token_version` in the `ver` claim, and the
+user row is cached under `auth-user:{id}:{version}`. A request with a valid
+token therefore costs one cache read instead of a database query. Only the
+`CACHED_FIELDS` are cached, the password hash never leaves the database; the
+other fields are deferred and loaded on first access.
+
+The version is bumped (see core.signals) when the password, `is_active`,
+`is_staff`, `is_superuser`, the groups or the direct permissions change.
+Tokens issued before that no longer find a cache entry, fail the version
+check against the database and are rejected, so the change takes effect on
+every session at once. Any other save of a cached field drops the cache entry.
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils.translation import gettext_lazy as _
+from dj_rest_auth.app_settings import api_settings as jwt_settings
+from dj_rest_auth.jwt_auth import JWTCookieAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+AUTH_USER_CACHE_TIMEOUT = getattr(settings, 'AUTH_USER_CACHE_TIMEOUT', 60 * 15)
+
+TOKEN_VERSION_CLAIM = 'ver'
+
+USER_KEY = 'auth-user:{}:{}'
+
+# fields whose change revokes the tokens issued before it
+REVOKING_FIELDS = ('password', 'is_active', 'is_staff', 'is_superuser')
+
+
+# what authentication, permission checks and the user details endpoint read
+CACHED_FIELDS = ('email', 'first_name', 'last_name', 'is_active', 'is_staff', 'is_superuser', 'token_version')
+
+
+def _fields():
+    # in model order, which from_db expects of a partial row
+    meta = get_user_model()._meta
+    return [field.attname for field in meta.concrete_fields
+            if field.attname == meta.pk.attname or field.attname in CACHED_FIELDS]
+
+
+def cache_user(user):
+    # the key changes with the version and is deleted on any other change, nothing to overwrite
+    cache.add(USER_KEY.format(user.pk, user.token_version),
+              [getattr(user, name) for name in _fields()], AUTH_USER_CACHE_TIMEOUT)
+
+
+def get_cached_user(user_id, version):
+    values = cache.get(USER_KEY.format(user_id, version))
+    if values is None:
+        return None
+    # from_db marks the instance as loaded, so saving it updates the row instead of inserting,
+    # and defers the fields left out
+    return get_user_model().from_db('default', _fields(), values)
+
+
+async def aget_cached_user(user_id, version):
+    values = await cache.aget(USER_KEY.format(user_id, version))
+    if values is None:
+        return None
+    return get_user_model().from_db('default', _fields(), values)
+
+
+def forget_user(user_id, *versions):
+    keys = [USER_KEY.format(user_id, version) for version in versions]
+    # once now and again after commit, so a read in between cannot cache the old row again
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def bump_token_version(user_ids):
+    """Revoke every token issued to `user_ids` so far."""
+    User = get_user_model()
+    versions = list(User.objects.filter(pk__in=user_ids).values_list('pk', 'token_version'))
+    User.objects.filter(pk__in=user_ids).update(token_version=F('token_version') + 1)
+    for user_id, version in versions:
+        forget_user(user_id, version, version + 1)
+
+
+class CachedJWTCookieAuthentication(JWTCookieAuthentication):
+    """JWTCookieAuthentication reading the user from the cache, see the module docstring."""
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+        # tokens issued before versioning carry no claim and match the initial version
+        version = validated_token.get(TOKEN_VERSION_CLAIM, 0)
+
+        user = get_cached_user(user_id, version)
+        if user is not None:
+            return user
+
+        # loads the row and rejects unknown and inactive users
+        user = super().get_user(validated_token)
+        if user.token_version != version:
+            raise AuthenticationFailed(_('Token has been revoked'), code='token_revoked')
+        cache_user(user)
+        return user
+
+    async def aauthenticate(self, request):
+        """`authenticate` for async views: only a cache miss leaves the event loop."""
+        header = self.get_header(request)
+        if header is None:
+            if not jwt_settings.JWT_AUTH_COOKIE:
+                return None
+            raw_token = request.COOKIES.get(jwt_settings.JWT_AUTH_COOKIE)
+            if jwt_settings.JWT_AUTH_COOKIE_ENFORCE_CSRF_ON_UNAUTHENTICATED:
+                self.enforce_csrf(request)
+            elif raw_token is not None and jwt_settings.JWT_AUTH_COOKIE_USE_CSRF:
+                self.enforce_csrf(request)
+        else:
+            raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+
+        validated_token = self.get_validated_token(raw_token)
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        user = await aget_cached_user(user_id, validated_token.get(TOKEN_VERSION_CLAIM, 0))
+        if user is None:
+            user = await sync_to_async(self.get_user)(validated_token)
+        return user, validated_token
@@ -0,0 +1,318 @@
+"""
+Two-tier cache backend: a small per-process LRU (L1) in front of the shared cache (L2).
+
+Only keys starting with one of the `L1_PREFIXES` go through the L1, all other
+keys (counters, locks, the cart store) go straight to the shared cache. Good
+candidates are keys whose name changes with their content, such as the
+versioned catalog responses and the cached user rows: they are only ever
+written once, then deleted or left to expire.
+
+Every L1 entry lives at most `L1_TIMEOUT` seconds. `set`, `set_many`,
+`delete`, `incr`, `decr` and `clear` on a prefix additionally bump that
+prefix's stamp in the shared cache. Each process compares its stamps with the
+shared ones at most every `L1_CHECK_INTERVAL` seconds and drops the entries of
+every prefix whose stamp moved, so an invalidation reaches the other workers
+within that interval. A stamp covers a whole prefix, so keys that change often
+(version counters) belong under a prefix of their own. `add` never overwrites
+and leaves the stamp alone, which makes it the way to write a write-once key.
+
+    CACHES = {
+        "default": {
+            "BACKEND": "core.cache_backends.TieredCache",
+            "LOCATION": "shared",
+            "OPTIONS": {"L1_PREFIXES": ["auth-user:"], "L1_MAX_ENTRIES": 1000, "L1_TIMEOUT": 5},
+        },
+        "shared": {"BACKEND": "django.core.cache.backends.redis.RedisCache", ...},
+    }
+
+Values are pickled in the L1 like in the local-memory backend, so a caller
+mutating what it got back does not change the cached value. `stats()` returns
+this process's hit, miss, eviction and invalidation counters.
+"""
+import pickle
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+STAMP_KEY = 'tiered-cache:stamp:{}'
+
+# one L1 per process and alias, Django hands every thread its own backend instance
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class LocalStore:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        # (key, version) -> (expires_at, prefix, pickled value), least recently used first
+        self.entries = OrderedDict()
+        self.stamps = {}
+        self.next_check = 0
+        self.stats = Counter()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return True, entry[2]
+            if entry is not None:
+                del self.entries[key]
+            self.stats['misses'] += 1
+            return False, None
+
+    def set(self, key, prefix, value, timeout):
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.entries[key] = (time.monotonic() + timeout, prefix, pickled)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def drop_prefixes(self, prefixes):
+        with self.lock:
+            stale = [key for key, entry in self.entries.items() if entry[1] in prefixes]
+            for key in stale:
+                del self.entries[key]
+            self.stats['invalidations'] += len(stale)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class TieredCache(BaseCache):
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self._shared_alias = location
+        self._prefixes = tuple(options.get('L1_PREFIXES', ()))
+        self._l1_timeout = options.get('L1_TIMEOUT', 5)
+        self._check_interval = options.get('L1_CHECK_INTERVAL', 1)
+        with _stores_lock:
+            self._store = _stores.setdefault(location, LocalStore(options.get('L1_MAX_ENTRIES', 1000)))
+
+    @property
+    def _shared(self):
+        return caches[self._shared_alias]
+
+    def _prefix(self, key):
+        for prefix in self._prefixes:
+            if key.startswith(prefix):
+                return prefix
+        return None
+
+    def _local_key(self, key, version):
+        return key, self.version if version is None else version
+
+    def _l1_timeout_for(self, timeout):
+        if timeout is DEFAULT_TIMEOUT or timeout is None:
+            return self._l1_timeout
+        return min(self._l1_timeout, timeout)
+
+    # invalidation stamps
+
+    def _stamps_due(self):
+        now = time.monotonic()
+        if now < self._store.next_check:
+            return False
+        self._store.next_check = now + self._check_interval
+        return True
+
+    def _apply_stamps(self, found):
+        store = self._store
+        moved = set()
+        for prefix in self._prefixes:
+            stamp = found.get(STAMP_KEY.format(prefix))
+            if prefix in store.stamps and store.stamps[prefix] != stamp:
+                moved.add(prefix)
+            store.stamps[prefix] = stamp
+        if moved:
+            store.drop_prefixes(moved)
+
+    def _check_stamps(self):
+        if self._prefixes and self._stamps_due():
+            self._apply_stamps(self._shared.get_many([STAMP_KEY.format(prefix) for prefix in self._prefixes]))
+
+    async def _acheck_stamps(self):
+        if self._prefixes and self._stamps_due():
+            self._apply_stamps(await self._shared.aget_many([STAMP_KEY.format(prefix) for prefix in self._prefixes]))
+
+    def _bump_stamp(self, prefix):
+        key = STAMP_KEY.format(prefix)
+        known = self._store.stamps.get(prefix)
+        try:
+            stamp = self._shared.incr(key)
+        except ValueError:
+            # seed from the clock so an evicted stamp can never come back as an old value
+            stamp = time.time_ns()
+            self._shared.set(key, stamp, timeout=None)
+        if known is not None and stamp == known + 1:
+            # nobody else moved it meanwhile, our own entries were already handled
+            self._store.stamps[prefix] = stamp
+
+    def _invalidate(self, keys, version):
+        prefixes = set()
+        for key in keys:
+            prefix = self._prefix(key)
+            if prefix is not None:
+                self._store.discard(self._local_key(key, version))
+                prefixes.add(prefix)
+        for prefix in prefixes:
+            self._bump_stamp(prefix)
+
+    # cache API
+
+    def _get_local(self, key, version):
+        found, pickled = self._store.get(self._local_key(key, version))
+        return (True, pickle.loads(pickled)) if found else (False, None)
+
+    def _remember(self, key, value, timeout, version):
+        prefix = self._prefix(key)
+        if prefix is None:
+            return
+        timeout = self._l1_timeout_for(timeout)
+        if timeout > 0:
+            self._store.set(self._local_key(key, version), prefix, value, timeout)
+        else:
+            self._store.discard(self._local_key(key, version))
+
+    def get(self, key, default=None, version=None):
+        if self._prefix(key) is None:
+            return self._shared.get(key, default, version=version)
+        self._check_stamps()
+        found, value = self._get_local(key, version)
+        if found:
+            return value
+        value = self._shared.get(key, self._missing_key, version=version)
+        if value is self._missing_key:
+            return default
+        self._remember(key, value, DEFAULT_TIMEOUT, version)
+        return value
+
+    async def aget(self, key, default=None, version=None):
+        if self._prefix(key) is None:
+            return await self._shared.aget(key, default, version=version)
+        await self._acheck_stamps()
+        found, value = self._get_local(key, version)
+        if found:
+            return value
+        value = await self._shared.aget(key, self._missing_key, version=version)
+        if value is self._missing_key:
+            return default
+        self._remember(key, value, DEFAULT_TIMEOUT, version)
+        return value
+
+    def _split_many(self, keys, version):
+        found, remote = {}, []
+        for key in keys:
+            if self._prefix(key) is None:
+                remote.append(key)
+                continue
+            hit, value = self._get_local(key, version)
+            if hit:
+                found[key] = value
+            else:
+                remote.append(key)
+        return found, remote
+
+    def _remember_many(self, found, version):
+        for key, value in found.items():
+            self._remember(key, value, DEFAULT_TIMEOUT, version)
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        self._check_stamps()
+        found, remote = self._split_many(keys, version)
+        if remote:
+            fetched = self._shared.get_many(remote, version=version)
+            self._remember_many(fetched, version)
+            found.update(fetched)
+        return found
+
+    async def aget_many(self, keys, version=None):
+        keys = list(keys)
+        await self._acheck_stamps()
+        found, remote = self._split_many(keys, version)
+        if remote:
+            fetched = await self._shared.aget_many(remote, version=version)
+            self._remember_many(fetched, version)
+            found.update(fetched)
+        return found
+
+    def has_key(self, key, version=None):
+        if self._prefix(key) is not None:
+            self._check_stamps()
+            if self._get_local(key, version)[0]:
+                return True
+        return self._shared.has_key(key, version=version)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._shared.set(key, value, timeout=timeout, version=version)
+        # other processes may hold the value being replaced
+        self._invalidate([key], version)
+        self._remember(key, value, timeout, version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = self._shared.set_many(data, timeout=timeout, version=version)
+        written = {key: value for key, value in data.items() if key not in failed}
+        self._invalidate(written, version)
+        for key, value in written.items():
+            self._remember(key, value, timeout, version)
+        return failed
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        added = self._shared.add(key, value, timeout=timeout, version=version)
+        if added:
+            self._remember(key, value, timeout, version)
+        return added
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self._shared.touch(key, timeout=timeout, version=version)
+
+    def delete(self, key, version=None):
+        deleted = self._shared.delete(key, version=version)
+        self._invalidate([key], version)
+        return deleted
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        self._shared.delete_many(keys, version=version)
+        self._invalidate(keys, version)
+
+    def incr(self, key, delta=1, version=None):
+        value = self._shared.incr(key, delta, version=version)
+        self._invalidate([key], version)
+        return value
+
+    def decr(self, key, delta=1, version=None):
+        value = self._shared.decr(key, delta, version=version)
+        self._invalidate([key], version)
+        return value
+
+    def clear(self):
+        self._shared.clear()
+        self._store.clear()
+        for prefix in self._prefixes:
+            self._bump_stamp(prefix)
+
+    def close(self, **kwargs):
+        self._shared.close(**kwargs)
+
+    def stats(self):
+        """This process's L1 counters."""
+        store = self._store
+        with store.lock:
+            return {'entries': len(store.entries), 'max_entries': store.max_entries, 'hits': store.stats['hits'],
+                    'misses': store.stats['misses'], 'evictions': store.stats['evictions'],
+                    'invalidations': store.stats['invalidations']}
@@ -0,0 +1,100 @@
+"""
+System checks for the connection settings built from the DB_* environment variables
+and for the cache the workers share.
+
+They run with every management command, so a bad combination fails `migrate`
+in build.sh instead of the first request after a deploy. Whether the cache is
+shared between workers only matters in production and is checked by
+`check --deploy`.
+"""
+import importlib.util
+
+import django
+from django.conf import settings
+from django.core.checks import Error, Warning, register
+
+
+@register()
+def check_database_connections(app_configs, **kwargs):
+    messages = []
+    for alias, database in settings.DATABASES.items():
+        engine = database.get('ENGINE', '')
+        conn_max_age = database.get('CONN_MAX_AGE', 0)
+        pool = database.get('OPTIONS', {}).get('pool')
+        if conn_max_age is not None and conn_max_age < 0:
+            messages.append(Error(
+                f'CONN_MAX_AGE of database "{alias}" is negative.',
+                hint='Set DB_CONN_MAX_AGE to 0 or a number of seconds.',
+                id='core.E101',
+            ))
+        if pool:
+            messages.extend(_check_pool(alias, engine, conn_max_age, pool))
+        elif 'postgresql' in engine and conn_max_age == 0:
+            messages.append(Warning(
+                f'Database "{alias}" opens a new connection for every request.',
+                hint='Set DB_CONN_MAX_AGE to keep connections open or DB_POOL=true to pool them.',
+                id='core.W101',
+            ))
+        elif conn_max_age != 0 and not database.get('CONN_HEALTH_CHECKS'):
+            messages.append(Warning(
+                f'Database "{alias}" reuses connections without health checks, a connection closed by the '
+                f'server fails the next request that gets it.',
+                hint='Set DB_CONN_HEALTH_CHECKS=true.',
+                id='core.W102',
+            ))
+    return messages
+
+
+# backends keeping their entries in the process that wrote them
+PROCESS_LOCAL_CACHES = {
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+}
+
+
+@register(deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    messages = []
+    for alias, options in settings.CACHES.items():
+        if options.get('BACKEND', '') in PROCESS_LOCAL_CACHES:
+            messages.append(Warning(
+                f'Cache "{alias}" is local to each process: cart contents, throttling buckets, idempotency '
+                f'keys and response cache invalidations are not shared between workers.',
+                hint='Set REDIS_URL.',
+                id='core.W103',
+            ))
+    return messages
+
+
+@register()
+def check_cache_backends(app_configs, **kwargs):
+    messages = []
+    for alias, options in settings.CACHES.items():
+        if options.get('BACKEND', '') == 'django.core.cache.backends.redis.RedisCache' and \
+                importlib.util.find_spec('redis') is None:
+            messages.append(Error(f'Cache "{alias}" uses Redis but the redis package is not installed.',
+                                  hint='pip install redis.', id='core.E107'))
+    return messages
+
+
+def _check_pool(alias, engine, conn_max_age, pool):
+    messages = []
+    if 'postgresql' not in engine:
+        messages.append(Error(f'Connection pooling is only supported on PostgreSQL, database "{alias}" '
+                              f'uses {engine}.', hint='Unset DB_POOL.', id='core.E102'))
+    if django.VERSION < (5, 1):
+        messages.append(Error(f'Connection pooling of database "{alias}" needs Django 5.1 or later.',
+                              hint='Upgrade Django or unset DB_POOL.', id='core.E103'))
+    if importlib.util.find_spec('psycopg') is None or importlib.util.find_spec('psycopg_pool') is None:
+        messages.append(Error(f'Connection pooling of database "{alias}" needs psycopg 3 and psycopg_pool.',
+                              hint='pip install "psycopg[pool]" or unset DB_POOL.', id='core.E104'))
+    if conn_max_age != 0:
+        messages.append(Error(f'Database "{alias}" is pooled and cannot also keep persistent connections.',
+                              hint='Set CONN_MAX_AGE to 0.', id='core.E105'))
+    if isinstance(pool, dict):
+        min_size, max_size = pool.get('min_size', 4), pool.get('max_size')
+        if max_size is not None and (max_size < 1 or min_size > max_size):
+            messages.append(Error(f'Pool of database "{alias}" has min_size {min_size} and max_size {max_size}.',
+                                  hint='DB_POOL_MAX_SIZE must be at least 1 and at least DB_POOL_MIN_SIZE.',
+                                  id='core.E106'))
+    return messages
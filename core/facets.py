@@ -0,0 +1,204 @@
+"""
+Catalog filtering by category and price, with facet counts.
+
+Facets are disjunctive: category counts honour the price filter and price
+bucket counts honour the category filter, so a client can widen either
+selection without losing the other.
+
+`ProductFacetCount` stores one row per (category, price bucket) plus a row per
+bucket with a null category for the whole catalog. Signals in core.signals
+keep it current with F() increments, so the common requests (no category or a
+single one, and a price range on bucket edges) are answered from a handful of
+rows. Anything else falls back to an exact GROUP BY over the filtered products.
+"""
+from bisect import bisect_right
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Count, Exists, F, IntegerField, OuterRef, Q, Sum, Value, When
+from rest_framework.exceptions import ValidationError
+
+from core.models import Product, ProductFacetCount
+
+# lower edges of the price buckets, the last bucket is open-ended
+PRICE_BUCKETS = [Decimal(str(edge)) for edge in getattr(settings, 'PRODUCT_PRICE_BUCKETS',
+                                                        [0, 25, 50, 100, 250, 500, 1000])]
+
+ProductCategory = Product.categories.through
+
+
+def bucket_for(price):
+    return max(bisect_right(PRICE_BUCKETS, Decimal(price)) - 1, 0)
+
+
+def bucket_bounds(bucket):
+    upper = PRICE_BUCKETS[bucket + 1] if bucket + 1 < len(PRICE_BUCKETS) else None
+    return PRICE_BUCKETS[bucket], upper
+
+
+def parse_filters(query_params):
+    """Read `category`, `min_price` and `max_price` (exclusive) from the query string."""
+    raw_categories = ','.join(query_params.getlist('category'))
+    try:
+        category_ids = sorted({int(value) for value in raw_categories.split(',') if value.strip()})
+    except ValueError:
+        raise ValidationError({'category': 'Expected a comma separated list of category ids.'})
+
+    prices = {}
+    for name in ('min_price', 'max_price'):
+        value = query_params.get(name)
+        if value in (None, ''):
+            prices[name] = None
+            continue
+        try:
+            prices[name] = Decimal(value)
+        except InvalidOperation:
+            raise ValidationError({name: 'Expected a number.'})
+        # NaN and Infinity parse, but cannot be compared with the bucket bounds
+        if not prices[name].is_finite():
+            raise ValidationError({name: 'Expected a number.'})
+    return category_ids, prices['min_price'], prices['max_price']
+
+
+def filter_by_category(queryset, category_ids):
+    if not category_ids:
+        return queryset
+    # EXISTS instead of a join so products in several selected categories are not duplicated
+    return queryset.filter(Exists(
+        ProductCategory.objects.filter(product_id=OuterRef('pk'), category_id__in=category_ids)
+    ))
+
+
+def filter_by_price(queryset, min_price, max_price):
+    if min_price is not None:
+        queryset = queryset.filter(price__gte=min_price)
+    if max_price is not None:
+        queryset = queryset.filter(price__lt=max_price)
+    return queryset
+
+
+def filter_products(queryset, category_ids, min_price, max_price):
+    return filter_by_price(filter_by_category(queryset, category_ids), min_price, max_price)
+
+
+def _aligned_buckets(min_price, max_price):
+    """The buckets exactly covering the price range, or None if it does not fall on bucket edges."""
+    if min_price is None:
+        first = 0
+    elif min_price in PRICE_BUCKETS:
+        first = PRICE_BUCKETS.index(min_price)
+    else:
+        return None
+    if max_price is None:
+        last = len(PRICE_BUCKETS)
+    elif max_price in PRICE_BUCKETS[1:]:
+        last = PRICE_BUCKETS.index(max_price)
+    else:
+        return None
+    return list(range(first, last))
+
+
+def _bucket_expression(price_field='price'):
+    whens = []
+    for bucket in range(len(PRICE_BUCKETS) - 1, 0, -1):
+        whens.append(When(**{f'{price_field}__gte': PRICE_BUCKETS[bucket]}, then=Value(bucket)))
+    return Case(*whens, default=Value(0), output_field=IntegerField())
+
+
+def category_counts(min_price, max_price):
+    buckets = _aligned_buckets(min_price, max_price)
+    if buckets is not None:
+        rows = (ProductFacetCount.objects
+                .filter(category__isnull=False, bucket__in=buckets)
+                .values('category_id')
+                .annotate(total=Sum('count')))
+        counts = {row['category_id']: row['total'] for row in rows}
+    else:
+        links = ProductCategory.objects.all()
+        if min_price is not None:
+            links = links.filter(product__price__gte=min_price)
+        if max_price is not None:
+            links = links.filter(product__price__lt=max_price)
+        counts = {row['category_id']: row['total']
+                  for row in links.values('category_id').annotate(total=Count('product_id'))}
+    return [{'id': category_id, 'count': count} for category_id, count in sorted(counts.items()) if count > 0]
+
+
+def price_counts(category_ids):
+    if len(category_ids) <= 1:
+        category_id = category_ids[0] if category_ids else None
+        rows = ProductFacetCount.objects.filter(category_id=category_id) if category_id is not None \
+            else ProductFacetCount.objects.filter(category__isnull=True)
+        counts = dict(rows.values_list('bucket', 'count'))
+    else:
+        rows = (filter_by_category(Product.objects.all(), category_ids)
+                .annotate(bucket=_bucket_expression())
+                .values('bucket')
+                .annotate(total=Count('id')))
+        counts = {row['bucket']: row['total'] for row in rows}
+
+    facets = []
+    for bucket in range(len(PRICE_BUCKETS)):
+        lower, upper = bucket_bounds(bucket)
+        facets.append({'min_price': lower, 'max_price': upper, 'count': counts.get(bucket, 0)})
+    return facets
+
+
+def facet_counts(category_ids, min_price, max_price):
+    return {
+        'categories': category_counts(min_price, max_price),
+        'price': price_counts(category_ids),
+    }
+
+
+def _rows(category_ids, include_all):
+    rows = Q(category_id__in=[category_id for category_id in category_ids if category_id is not None])
+    if include_all:
+        rows |= Q(category__isnull=True)
+    return rows
+
+
+def apply_delta(bucket, category_ids, delta, include_all=True):
+    """
+    Add `delta` to the rows of `bucket` for every category in `category_ids`, and to the
+    all-products row unless `include_all` is False (linking a category does not change it).
+    """
+    keys = set(category_ids) | ({None} if include_all else set())
+    if not delta or not keys:
+        return
+    updated = ProductFacetCount.objects.filter(_rows(keys, include_all), bucket=bucket) \
+        .update(count=F('count') + delta)
+    if updated == len(keys):
+        return
+
+    # first product in this bucket for some category, create the missing rows
+    existing = set(ProductFacetCount.objects.filter(_rows(keys, include_all), bucket=bucket)
+                   .values_list('category_id', flat=True))
+    missing = keys - existing
+    with transaction.atomic():
+        ProductFacetCount.objects.bulk_create(
+            [ProductFacetCount(category_id=category_id, bucket=bucket, count=0) for category_id in missing],
+            ignore_conflicts=True
+        )
+        ProductFacetCount.objects.filter(_rows(missing, None in missing), bucket=bucket) \
+            .update(count=F('count') + delta)
+
+
+@transaction.atomic
+def rebuild_facet_counts():
+    """Recompute the whole facet store from the product tables."""
+    ProductFacetCount.objects.all().delete()
+    bucket = _bucket_expression()
+    rows = [
+        ProductFacetCount(category=None, bucket=row['bucket'], count=row['total'])
+        for row in Product.objects.annotate(bucket=bucket).values('bucket').annotate(total=Count('id'))
+    ]
+    links = (ProductCategory.objects
+             .annotate(bucket=_bucket_expression('product__price'))
+             .values('category_id', 'bucket')
+             .annotate(total=Count('product_id')))
+    rows += [ProductFacetCount(category_id=row['category_id'], bucket=row['bucket'], count=row['total'])
+             for row in links]
+    ProductFacetCount.objects.bulk_create(rows)
+    return len(rows)
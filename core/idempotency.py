@@ -0,0 +1,159 @@
+"""
+Idempotent replay of mutating API calls.
+
+A request sent with an `Idempotency-Key` header first claims an
+`IdempotencyRecord` for `(user, key)`; the unique constraint on that pair makes
+the claim atomic across workers. The response is stored on the record once the
+view returns, and a retry with the same key gets the stored response back
+without the view running again. A retry arriving while the original is still
+in flight polls the record until the response is there.
+
+Records expire after `IDEMPOTENCY_TTL` seconds and are removed by the
+`purge_idempotency_records` command; an expired record found on the way is
+replaced right away.
+"""
+import hashlib
+import json
+import time
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework.response import Response
+from rest_framework.status import HTTP_409_CONFLICT, HTTP_422_UNPROCESSABLE_ENTITY
+from rest_framework.utils.encoders import JSONEncoder
+
+from core.models import IdempotencyRecord
+
+IDEMPOTENCY_TTL = getattr(settings, 'IDEMPOTENCY_TTL', 60 * 60 * 24)
+IDEMPOTENCY_WAIT_TIMEOUT = getattr(settings, 'IDEMPOTENCY_WAIT_TIMEOUT', 10)
+IDEMPOTENCY_LOCK_TIMEOUT = getattr(settings, 'IDEMPOTENCY_LOCK_TIMEOUT', 60)
+
+# response headers worth replaying, the rest are rebuilt by the renderer
+REPLAYED_HEADERS = ('Location',)
+
+
+class KeyReused(Exception):
+    pass
+
+
+class StillProcessing(Exception):
+    pass
+
+
+def fingerprint(request):
+    digest = hashlib.sha256()
+    for part in (request.method, request.path, request.body):
+        digest.update(part if isinstance(part, bytes) else part.encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def claim(user, key, request_fingerprint):
+    """
+    Return `(record, owner)`. The owner runs the view and stores its response, anyone
+    else gets a record that already holds the response. Raises `KeyReused` when the key
+    was used for a different request and `StillProcessing` when the original request
+    does not finish within `IDEMPOTENCY_WAIT_TIMEOUT`.
+    """
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_TIMEOUT
+    delay = 0.05
+    while True:
+        now = timezone.now()
+        try:
+            with transaction.atomic():
+                record = IdempotencyRecord.objects.create(
+                    user=user, key=key, fingerprint=request_fingerprint,
+                    locked_until=now + timedelta(seconds=IDEMPOTENCY_LOCK_TIMEOUT),
+                    expires_at=now + timedelta(seconds=IDEMPOTENCY_TTL),
+                )
+            return record, True
+        except IntegrityError:
+            pass
+
+        record = IdempotencyRecord.objects.filter(user=user, key=key).first()
+        if record is None:
+            # purged between our insert and this read
+            continue
+        if record.expires_at <= now:
+            IdempotencyRecord.objects.filter(pk=record.pk, expires_at__lte=now).delete()
+            continue
+        if record.fingerprint != request_fingerprint:
+            raise KeyReused()
+        if record.status_code is not None:
+            return record, False
+        if record.locked_until <= now:
+            # the original request died without storing a response, take it over
+            taken = IdempotencyRecord.objects.filter(
+                pk=record.pk, status_code__isnull=True, locked_until=record.locked_until
+            ).update(locked_until=now + timedelta(seconds=IDEMPOTENCY_LOCK_TIMEOUT))
+            if taken:
+                return record, True
+            continue
+        if time.monotonic() >= deadline:
+            raise StillProcessing()
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+
+def store(record, response):
+    body = json.loads(json.dumps(response.data, cls=JSONEncoder))
+    headers = {name: response[name] for name in REPLAYED_HEADERS if response.has_header(name)}
+    IdempotencyRecord.objects.filter(pk=record.pk).update(status_code=response.status_code, body=body,
+                                                          headers=headers)
+
+
+def release(record):
+    # nothing worth replaying, let the next retry run the view again
+    IdempotencyRecord.objects.filter(pk=record.pk, status_code__isnull=True).delete()
+
+
+def replay(record):
+    response = Response(record.body, status=record.status_code, headers=record.headers)
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+class IdempotentResponseMixin:
+    """
+    Make the `idempotent_actions` of a viewset safe to retry: requests carrying an
+    `Idempotency-Key` header run once per user and key, retries get the first response.
+    Requests without the header are handled as usual.
+    """
+    idempotent_actions = ()
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        # after authentication, the records are scoped to the user
+        key = request.headers.get('Idempotency-Key')
+        if key and request.method == 'POST' and self.action in self.idempotent_actions:
+            self.post = partial(self.idempotent_handler, self.post)
+
+    def idempotent_handler(self, handler, request, *args, **kwargs):
+        key = request.headers['Idempotency-Key'].strip()
+        if len(key) > 255:
+            return Response({'message': 'Idempotency-Key must be at most 255 characters'},
+                            status=HTTP_422_UNPROCESSABLE_ENTITY)
+        try:
+            record, owner = claim(request.user, key, fingerprint(request))
+        except KeyReused:
+            return Response({'message': 'Idempotency-Key was already used for a different request'},
+                            status=HTTP_422_UNPROCESSABLE_ENTITY)
+        except StillProcessing:
+            return Response({'message': 'A request with this Idempotency-Key is still being processed'},
+                            status=HTTP_409_CONFLICT, headers={'Retry-After': '1'})
+        if not owner:
+            return replay(record)
+
+        try:
+            response = handler(request, *args, **kwargs)
+        except Exception:
+            release(record)
+            raise
+        if response.status_code >= 500:
+            release(record)
+        else:
+            store(record, response)
+        return response
@@ -0,0 +1,168 @@
+"""
+Per-request SQL instrumentation.
+
+`QueryInstrumentationMiddleware` counts and times the queries of a sampled
+share of the requests (`SQL_SAMPLE_RATE`). Staff users, or everyone with DEBUG
+on, get them in a `Server-Timing` header:
+
+    Server-Timing: db;dur=12.4;desc="7 queries", app;dur=30.1
+
+A sampled request slower than `SLOW_REQUEST_MS` or running more than
+`SLOW_REQUEST_QUERIES` queries is logged as a warning on `core.instrumentation`
+together with its most repeated query shapes, which is how an N+1 shows up.
+The middleware runs sync or async, whichever the chain around it is. An
+async request's ORM calls run on other threads, each with its own
+connections, so instead of wrapping the request's connections every
+connection gets one execute wrapper when it is opened, which records into the
+stats of the current request through a context variable (copied into those
+threads by sync_to_async). Queries of requests that are not sampled only pay
+for looking it up.
+"""
+import logging
+import random
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.utils.functional import SimpleLazyObject, empty
+
+SQL_SAMPLE_RATE = getattr(settings, 'SQL_SAMPLE_RATE', 0.05)
+SLOW_REQUEST_MS = getattr(settings, 'SLOW_REQUEST_MS', 500)
+SLOW_REQUEST_QUERIES = getattr(settings, 'SLOW_REQUEST_QUERIES', 30)
+
+# most repeated query shapes listed for a slow request
+REPEATED_SHOWN = 3
+
+logger = logging.getLogger(__name__)
+
+_PLACEHOLDER_LISTS = re.compile(r'\((?:\s*(?:%s|\?)\s*,)+\s*(?:%s|\?)\s*\)')
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_NUMBERS = re.compile(r'\b\d+(?:\.\d+)?\b')
+_SPACES = re.compile(r'\s+')
+
+
+def fingerprint(sql):
+    """The shape of a query: literals and placeholder lists of any length collapsed."""
+    sql = _STRINGS.sub('?', sql)
+    sql = _NUMBERS.sub('?', sql)
+    sql = _PLACEHOLDER_LISTS.sub('(...)', sql)
+    return _SPACES.sub(' ', sql).strip()
+
+
+class QueryStats:
+    """An execute wrapper collecting the count, time and statements of the queries it sees."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started
+            self.count += 1
+            # the raw text is enough here, fingerprints are only worked out for a slow request
+            self.statements[sql] += 1
+
+    def repeated(self, limit):
+        shapes = Counter()
+        for sql, count in self.statements.items():
+            shapes[fingerprint(sql)] += count
+        return [(shape, count) for shape, count in shapes.most_common(limit) if count > 1]
+
+
+def _shows_timing(user):
+    # query counts and timings tell an outsider which requests are expensive to serve
+    return settings.DEBUG or (user is not None and user.is_staff)
+
+
+def _unresolved(user):
+    # AuthenticationMiddleware's session user, not replaced by DRF's authentication and not loaded yet
+    return isinstance(user, SimpleLazyObject) and user._wrapped is empty
+
+
+_current_stats = ContextVar('query_stats', default=None)
+
+
+def _record(execute, sql, params, many, context):
+    stats = _current_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    return stats(execute, sql, params, many, context)
+
+
+@receiver(connection_created)
+def install_query_recorder(sender, connection, **kwargs):
+    # fires again when the same connection reconnects
+    if _record not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record)
+
+
+@contextmanager
+def _wrapped(stats):
+    token = _current_stats.set(stats)
+    try:
+        yield
+    finally:
+        _current_stats.reset(token)
+
+
+class QueryInstrumentationMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if random.random() >= SQL_SAMPLE_RATE:
+            return self.get_response(request)
+
+        # read by core.metrics
+        stats = request.query_stats = QueryStats()
+        started = time.perf_counter()
+        with _wrapped(stats):
+            response = self.get_response(request)
+        self.report(request, response, stats, time.perf_counter() - started, getattr(request, 'user', None))
+        return response
+
+    async def __acall__(self, request):
+        if random.random() >= SQL_SAMPLE_RATE:
+            return await self.get_response(request)
+
+        stats = request.query_stats = QueryStats()
+        started = time.perf_counter()
+        with _wrapped(stats):
+            response = await self.get_response(request)
+        duration = time.perf_counter() - started
+        user = getattr(request, 'user', None)
+        if _unresolved(user) and not settings.DEBUG:
+            user = await request.auser()
+        self.report(request, response, stats, duration, user)
+        return response
+
+    def report(self, request, response, stats, duration, user):
+        if _shows_timing(user):
+            queries = f'{stats.count} {"query" if stats.count == 1 else "queries"}'
+            timing = f'db;dur={stats.duration * 1000:.1f};desc="{queries}", app;dur={duration * 1000:.1f}'
+            response['Server-Timing'] = (f'{response["Server-Timing"]}, {timing}'
+                                         if response.has_header('Server-Timing') else timing)
+
+        if duration * 1000 > SLOW_REQUEST_MS or stats.count > SLOW_REQUEST_QUERIES:
+            repeated = ''.join(f'\n  {count}x {shape[:300]}' for shape, count in stats.repeated(REPEATED_SHOWN))
+            logger.warning('Slow request %s %s: %s in %.0f ms, %d queries in %.0f ms%s',
+                           request.method, request.path, response.status_code, duration * 1000,
+                           stats.count, stats.duration * 1000, repeated)
@@ -0,0 +1,28 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.services.archive import archive_carts, archive_orders
+
+
+class Command(BaseCommand):
+    help = 'Move old orders and closed carts from the hot tables to the archive tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders-older-than', type=int, default=settings.ARCHIVE_ORDERS_AFTER_DAYS,
+                            help='Archive orders created more than this many days ago')
+        parser.add_argument('--carts-older-than', type=int, default=settings.ARCHIVE_CARTS_AFTER_DAYS,
+                            help='Archive ordered and abandoned carts untouched for this many days')
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows moved per transaction')
+        parser.add_argument('--max-batches', type=int, default=None,
+                            help='Stop after this many batches of each kind, to bound a single run')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        orders = archive_orders(now - timedelta(days=options['orders_older_than']),
+                                batch_size=options['batch_size'], max_batches=options['max_batches'])
+        carts = archive_carts(now - timedelta(days=options['carts_older_than']),
+                              batch_size=options['batch_size'], max_batches=options['max_batches'])
+        self.stdout.write(self.style.SUCCESS(f'Archived {orders} orders and {carts} carts'))
@@ -0,0 +1,63 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.core.signals import request_finished, request_started
+from django.db import connections
+
+
+class Command(BaseCommand):
+    help = ('Time a request-sized unit of database work with the configured connection handling '
+            '(DB_CONN_MAX_AGE, DB_POOL) against a new connection per request')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+        parser.add_argument('--requests', type=int, default=200, help='Simulated requests per mode')
+        parser.add_argument('--queries', type=int, default=3, help='Queries per simulated request')
+
+    def simulate(self, connection, total, queries):
+        latencies = []
+        for _ in range(total):
+            started = time.perf_counter()
+            # the same signals a real request sends, they close or recycle connections
+            request_started.send(sender=self.__class__)
+            with connection.cursor() as cursor:
+                for _ in range(queries):
+                    cursor.execute('SELECT 1')
+                    cursor.fetchone()
+            request_finished.send(sender=self.__class__)
+            latencies.append(time.perf_counter() - started)
+        return latencies
+
+    def report(self, label, latencies):
+        latencies = sorted(latencies)
+        mean = statistics.mean(latencies) * 1000
+        self.stdout.write(f'{label:<24}{mean:>10.2f}{statistics.median(latencies) * 1000:>10.2f}'
+                          f'{latencies[int(len(latencies) * 0.95) - 1] * 1000:>10.2f}')
+        return mean
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        configured = connection.settings_dict
+        total, queries = options['requests'], options['queries']
+
+        self.stdout.write(f'{total} requests of {queries} queries, CONN_MAX_AGE={configured["CONN_MAX_AGE"]}, '
+                          f'health checks {"on" if configured["CONN_HEALTH_CHECKS"] else "off"}, '
+                          f'pool {"on" if configured.get("OPTIONS", {}).get("pool") else "off"}')
+        self.stdout.write(f'{"mode":<24}{"mean ms":>10}{"p50 ms":>10}{"p95 ms":>10}')
+
+        connection.close()
+        unpooled = {**configured, 'CONN_MAX_AGE': 0, 'OPTIONS': {
+            key: value for key, value in configured.get('OPTIONS', {}).items() if key != 'pool'}}
+        connection.settings_dict = unpooled
+        try:
+            baseline = self.report('connection per request', self.simulate(connection, total, queries))
+        finally:
+            connection.close()
+            connection.settings_dict = configured
+
+        # the first request pays for the connect either way
+        self.simulate(connection, 1, queries)
+        current = self.report('configured', self.simulate(connection, total, queries))
+        connection.close()
+        self.stdout.write(self.style.SUCCESS(f'Saved {baseline - current:.2f} ms per request'))
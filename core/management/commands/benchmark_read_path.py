@@ -0,0 +1,73 @@
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+
+# the sync endpoints and their async twins from core.async_views
+READ_PATHS = [
+    ('/api/products/', '/api/async/products/'),
+    ('/api/categories/', '/api/async/categories/'),
+    ('/api/cart/active-cart/', '/api/async/cart/active-cart/'),
+]
+
+
+class Command(BaseCommand):
+    help = ('Load the catalog and active cart read paths of a running server and compare the sync endpoints '
+            'with their async twins, e.g. gunicorn djangoEcommerce.wsgi against uvicorn djangoEcommerce.asgi')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--wsgi-url', default='http://127.0.0.1:8000',
+                            help='Server running djangoEcommerce.wsgi, hit on the sync endpoints')
+        parser.add_argument('--asgi-url', default='http://127.0.0.1:8001',
+                            help='Server running djangoEcommerce.asgi, hit on the async endpoints')
+        parser.add_argument('--email', required=True, help='User to log in as')
+        parser.add_argument('--password', required=True)
+        parser.add_argument('--concurrency', type=int, default=50, help='Concurrent clients')
+        parser.add_argument('--requests', type=int, default=1000, help='Requests per endpoint')
+
+    def login(self, base_url, email, password):
+        response = requests.post(f'{base_url}/api/auth/login/', json={'email': email, 'password': password})
+        if response.status_code != 200:
+            raise CommandError(f'Login on {base_url} failed: {response.status_code} {response.text}')
+        return response.json()['access']
+
+    def run(self, url, token, concurrency, total):
+        local = threading.local()
+
+        def fetch(_):
+            if not hasattr(local, 'session'):
+                local.session = requests.Session()
+                local.session.headers['Authorization'] = f'Bearer {token}'
+            started = time.perf_counter()
+            response = local.session.get(url)
+            return time.perf_counter() - started, response.status_code
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(fetch, range(total)))
+        elapsed = time.perf_counter() - started
+        latencies = sorted(latency for latency, _ in results)
+        errors = sum(1 for _, status in results if status >= 400)
+        return {
+            'rps': total / elapsed,
+            'p50': statistics.median(latencies) * 1000,
+            'p95': latencies[int(len(latencies) * 0.95) - 1] * 1000,
+            'errors': errors,
+        }
+
+    def handle(self, *args, **options):
+        tokens = {
+            'wsgi': self.login(options['wsgi_url'], options['email'], options['password']),
+            'asgi': self.login(options['asgi_url'], options['email'], options['password']),
+        }
+        self.stdout.write(f'{options["requests"]} requests per endpoint, {options["concurrency"]} concurrent clients')
+        self.stdout.write(f'{"endpoint":<32}{"server":<7}{"req/s":>9}{"p50 ms":>9}{"p95 ms":>9}{"errors":>8}')
+        for sync_path, async_path in READ_PATHS:
+            for server, url in (('wsgi', options['wsgi_url'] + sync_path), ('asgi', options['asgi_url'] + async_path)):
+                result = self.run(url, tokens[server], options['concurrency'], options['requests'])
+                path = sync_path if server == 'wsgi' else async_path
+                self.stdout.write(f'{path:<32}{server:<7}{result["rps"]:>9.1f}{result["p50"]:>9.1f}'
+                                  f'{result["p95"]:>9.1f}{result["errors"]:>8}')
@@ -0,0 +1,54 @@
+import multiprocessing
+import os
+import tempfile
+from datetime import timedelta
+
+# the workers' metrics go where the web processes' /metrics adds them up, the same default as gunicorn.conf.py.
+# prometheus_client picks its storage when first imported (by core.services.checkout_queue), so this comes first
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "djangoEcommerce-metrics"))
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+from django.core.management.base import BaseCommand  # noqa: E402
+from django.db import connections  # noqa: E402
+
+from core.services.checkout_queue import run_worker  # noqa: E402
+
+
+def _work(worker_id, options):
+    # every process needs its own database connection, never one inherited from the parent
+    connections.close_all()
+    run_worker(worker_id, batch_size=options['batch_size'], poll_interval=options['poll_interval'],
+               once=options['once'], stale_after=timedelta(seconds=options['stale_after']))
+
+
+class Command(BaseCommand):
+    help = 'Run a pool of worker processes that drain the asynchronous checkout queue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Number of worker processes')
+        parser.add_argument('--batch-size', type=int, default=50, help='Jobs claimed per round trip')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to wait when the queue is empty')
+        parser.add_argument('--stale-after', type=int, default=300,
+                            help='Seconds after which a job still processing is taken over by another worker')
+        parser.add_argument('--once', action='store_true', help='Exit once the queue is empty')
+
+    def handle(self, *args, **options):
+        if options['workers'] <= 1:
+            _work(0, options)
+            return
+
+        connections.close_all()
+        workers = [multiprocessing.Process(target=_work, args=(index, options), daemon=True)
+                   for index in range(options['workers'])]
+        for worker in workers:
+            worker.start()
+        self.stdout.write(f'Started {len(workers)} checkout workers')
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
+            for worker in workers:
+                worker.join()
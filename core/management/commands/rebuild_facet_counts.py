@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from core.facets import rebuild_facet_counts
+
+
+class Command(BaseCommand):
+    help = 'Recompute the precomputed product facet counts from scratch'
+
+    def handle(self, *args, **options):
+        rows = rebuild_facet_counts()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {rows} facet count rows'))
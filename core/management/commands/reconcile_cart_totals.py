@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Cart
+from core.services.cart import reconcile_totals
+
+
+class Command(BaseCommand):
+    help = 'Check the denormalized cart totals against a full recompute over the cart items'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='Overwrite mismatched totals with the recomputed values')
+        parser.add_argument('--status', help='Only check carts with this status, e.g. active')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        carts = Cart.objects.all()
+        if options['status']:
+            carts = carts.filter(status=options['status'])
+        mismatches = reconcile_totals(carts, fix=options['fix'], batch_size=options['batch_size'])
+        for cart_id, (stored_count, stored_subtotal), (actual_count, actual_subtotal) in mismatches:
+            self.stdout.write(f'cart {cart_id}: stored {stored_count} items / {stored_subtotal}, '
+                              f'actual {actual_count} items / {actual_subtotal}')
+        if not mismatches:
+            self.stdout.write(self.style.SUCCESS('All cart totals match'))
+        elif options['fix']:
+            self.stdout.write(self.style.SUCCESS(f'Fixed {len(mismatches)} carts'))
+        else:
+            self.stdout.write(self.style.WARNING(f'{len(mismatches)} carts out of sync, rerun with --fix to repair'))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from core.rollups import rebuild_sales_rollups, roll_up_sales
+
+
+class Command(BaseCommand):
+    help = 'Fold the orders created since the last run into the daily sales rollups'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Orders rolled up per transaction')
+        parser.add_argument('--max-batches', type=int, default=None, help='Stop after this many batches')
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Drop the rollups and recompute them from the orders in the hot tables')
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            orders = rebuild_sales_rollups(batch_size=options['batch_size'])
+        else:
+            orders = roll_up_sales(batch_size=options['batch_size'], max_batches=options['max_batches'])
+        self.stdout.write(self.style.SUCCESS(f'Rolled up {orders} orders'))
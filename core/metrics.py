@@ -0,0 +1,152 @@
+"""
+Prometheus metrics and the `/metrics` endpoint.
+
+`MetricsMiddleware` observes every request's latency, labelled with the view
+that served it: `basename.action` for DRF viewsets (`cart.add_item`,
+`product.list`), the URL name otherwise. Requests sampled by
+core.instrumentation also record their query count. The in-process cache
+tier's counters are folded in after each request, and the checkout view and
+worker count their outcomes in `checkouts_total`.
+
+With `PROMETHEUS_MULTIPROC_DIR` set (gunicorn.conf.py and the
+process_checkout_jobs command both do it, to the same default directory),
+every process writes its values to memory-mapped files in that directory and
+`/metrics` aggregates all of them, so one scrape covers every gunicorn worker
+and checkout worker on the node.
+
+The middleware runs sync or async, whichever the chain around it is.
+
+With `METRICS_TOKEN` set the endpoint requires it as a bearer token. Without
+one it only answers requests made straight from a loopback or private address
+(not relayed by a proxy, which adds X-Forwarded-For), unless DEBUG is on.
+"""
+import hmac
+import ipaddress
+import os
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseForbidden
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+METRICS_TOKEN = getattr(settings, 'METRICS_TOKEN', '')
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Time spent answering a request', ['view', 'method', 'status'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10),
+)
+REQUEST_QUERIES = Histogram(
+    'http_request_db_queries', 'SQL queries run by a sampled request', ['view'],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 250),
+)
+CACHE_REQUESTS = Counter('cache_l1_requests_total', 'Lookups in the in-process cache tier', ['result'])
+CACHE_EVICTIONS = Counter('cache_l1_evictions_total', 'Entries evicted from the in-process cache tier')
+CACHE_INVALIDATIONS = Counter('cache_l1_invalidations_total',
+                              'Entries dropped from the in-process cache tier after an invalidation')
+CHECKOUTS = Counter('checkouts_total', 'Checkout attempts by outcome', ['mode', 'result'])
+
+_cache_stats = {}
+_cache_stats_lock = threading.Lock()
+
+
+def record_checkout(mode, result):
+    """`mode` is sync or async, `result` succeeded or the reason it failed."""
+    CHECKOUTS.labels(mode, result).inc()
+
+
+def _sync_cache_stats():
+    # the cache counts in plain ints, only the difference since the last request is exported
+    if not hasattr(cache, 'stats'):
+        return
+    stats = cache.stats()
+    with _cache_stats_lock:
+        deltas = {name: stats[name] - _cache_stats.get(name, 0)
+                  for name in ('hits', 'misses', 'evictions', 'invalidations')}
+        _cache_stats.update(stats)
+    if deltas['hits']:
+        CACHE_REQUESTS.labels('hit').inc(deltas['hits'])
+    if deltas['misses']:
+        CACHE_REQUESTS.labels('miss').inc(deltas['misses'])
+    if deltas['evictions']:
+        CACHE_EVICTIONS.inc(deltas['evictions'])
+    if deltas['invalidations']:
+        CACHE_INVALIDATIONS.inc(deltas['invalidations'])
+
+
+def view_label(request):
+    match = request.resolver_match
+    if match is None:
+        # requests that never reached a view (404, redirects) share one label
+        return 'unmatched'
+    view_func = match.func
+    actions = getattr(view_func, 'actions', None)
+    if actions:
+        basename = view_func.initkwargs.get('basename') or view_func.cls.__name__
+        return f'{basename}.{actions.get(request.method.lower(), request.method.lower())}'
+    if match.url_name:
+        return match.url_name
+    return getattr(view_func, '__name__', 'unknown')
+
+
+class MetricsMiddleware:
+    # no process_view: Django would run it through sync_to_async on every ASGI request
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = time.perf_counter()
+        response = self.get_response(request)
+        self.observe(request, response, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        self.observe(request, response, time.perf_counter() - started)
+        return response
+
+    def observe(self, request, response, duration):
+        view = view_label(request)
+        REQUEST_LATENCY.labels(view, request.method, response.status_code).observe(duration)
+        stats = getattr(request, 'query_stats', None)
+        if stats is not None:
+            REQUEST_QUERIES.labels(view).observe(stats.count)
+        _sync_cache_stats()
+
+
+def _internal(request):
+    if 'X-Forwarded-For' in request.headers:
+        return False
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return address.is_loopback or address.is_private
+
+
+def _allowed(request):
+    if METRICS_TOKEN:
+        return hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}')
+    return settings.DEBUG or _internal(request)
+
+
+def metrics_view(request):
+    if not _allowed(request):
+        return HttpResponseForbidden()
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,77 @@
+from django.db import migrations
+
+POSTGRESQL_FORWARD = [
+    """
+    ALTER TABLE core_product ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(summary, '')), 'B') ||
+        setweight(to_tsvector('english', coalesce(description, '')), 'C')
+    ) STORED
+    """,
+    "CREATE INDEX product_search_vector_idx ON core_product USING gin (search_vector)",
+]
+
+POSTGRESQL_BACKWARD = [
+    "DROP INDEX IF EXISTS product_search_vector_idx",
+    "ALTER TABLE core_product DROP COLUMN IF EXISTS search_vector",
+]
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS core_product_fts USING fts5(
+        title, summary, description,
+        content='core_product', content_rowid='id', tokenize='porter unicode61'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS core_product_fts_ai AFTER INSERT ON core_product BEGIN
+        INSERT INTO core_product_fts(rowid, title, summary, description)
+        VALUES (new.id, new.title, new.summary, new.description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS core_product_fts_ad AFTER DELETE ON core_product BEGIN
+        INSERT INTO core_product_fts(core_product_fts, rowid, title, summary, description)
+        VALUES ('delete', old.id, old.title, old.summary, old.description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS core_product_fts_au AFTER UPDATE OF title, summary, description ON core_product
+    BEGIN
+        INSERT INTO core_product_fts(core_product_fts, rowid, title, summary, description)
+        VALUES ('delete', old.id, old.title, old.summary, old.description);
+        INSERT INTO core_product_fts(rowid, title, summary, description)
+        VALUES (new.id, new.title, new.summary, new.description);
+    END
+    """,
+    "INSERT INTO core_product_fts(core_product_fts) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARD = [
+    "DROP TRIGGER IF EXISTS core_product_fts_ai",
+    "DROP TRIGGER IF EXISTS core_product_fts_ad",
+    "DROP TRIGGER IF EXISTS core_product_fts_au",
+    "DROP TABLE IF EXISTS core_product_fts",
+]
+
+
+def _run(statements):
+    def run(apps, schema_editor):
+        vendor = schema_editor.connection.vendor
+        for statement in statements.get(vendor, []):
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_product_created_at_id_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            _run({'postgresql': POSTGRESQL_FORWARD, 'sqlite': SQLITE_FORWARD}),
+            _run({'postgresql': POSTGRESQL_BACKWARD, 'sqlite': SQLITE_BACKWARD}),
+        ),
+    ]
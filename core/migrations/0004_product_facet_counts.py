@@ -0,0 +1,31 @@
+# Generated by Django 5.0.6 on 2026-10-18 08:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_product_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductFacetCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.PositiveSmallIntegerField(help_text='Price Bucket', verbose_name='Price Bucket')),
+                ('count', models.IntegerField(default=0, help_text='Count', verbose_name='Count')),
+                ('category', models.ForeignKey(blank=True, help_text='Category', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='facet_counts', to='core.category', verbose_name='Category')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='productfacetcount',
+            constraint=models.UniqueConstraint(fields=('category', 'bucket'), name='unique_facet_category_bucket'),
+        ),
+        migrations.AddConstraint(
+            model_name='productfacetcount',
+            constraint=models.UniqueConstraint(condition=models.Q(('category__isnull', True)), fields=('bucket',), name='unique_facet_all_bucket'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.0.6 on 2026-10-18 08:39
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def merge_duplicate_items(apps, schema_editor):
+    # fold repeated (cart, product) lines into the oldest one before the constraint goes on
+    CartItem = apps.get_model('core', 'CartItem')
+    duplicates = (CartItem.objects.values('cart_id', 'product_id')
+                  .annotate(lines=Count('id')).filter(lines__gt=1))
+    for duplicate in duplicates:
+        items = list(CartItem.objects.filter(cart_id=duplicate['cart_id'], product_id=duplicate['product_id'])
+                     .order_by('id'))
+        keep, extra = items[0], items[1:]
+        keep.quantity = sum(item.quantity for item in items)
+        keep.price = sum(item.price for item in items)
+        keep.save(update_fields=['quantity', 'price'])
+        CartItem.objects.filter(id__in=[item.id for item in extra]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_product_facet_counts'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_items, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(fields=('cart', 'product'), name='unique_cart_item_product'),
+        ),
+    ]
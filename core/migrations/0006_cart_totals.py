@@ -0,0 +1,38 @@
+# Generated by Django 5.0.6 on 2026-10-18 08:41
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_totals(apps, schema_editor):
+    Cart = apps.get_model('core', 'Cart')
+    CartItem = apps.get_model('core', 'CartItem')
+    items = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+    Cart.objects.update(
+        item_count=Coalesce(Subquery(items.annotate(total=Sum('quantity')).values('total')), Value(0)),
+        subtotal=Coalesce(Subquery(items.annotate(total=Sum('price')).values('total')), Value(Decimal(0))),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_cart_item_unique_product'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='item_count',
+            field=models.IntegerField(default=0, help_text='Item Count', verbose_name='Item Count'),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='subtotal',
+            field=models.DecimalField(decimal_places=2, default=0, help_text='Subtotal', max_digits=10, verbose_name='Subtotal'),
+        ),
+        migrations.RunPython(backfill_totals, migrations.RunPython.noop),
+    ]
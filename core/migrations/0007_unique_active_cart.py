@@ -0,0 +1,29 @@
+# Generated by Django 5.0.6 on 2026-10-18 08:43
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def abandon_extra_active_carts(apps, schema_editor):
+    # keep the cart `.filter(...).first()` has been returning, the others were unreachable anyway
+    Cart = apps.get_model('core', 'Cart')
+    users = (Cart.objects.filter(status='active').values('user_id')
+             .annotate(carts=Count('id')).filter(carts__gt=1).values_list('user_id', flat=True))
+    for user_id in users:
+        keep = Cart.objects.filter(user_id=user_id, status='active').order_by('id').first()
+        Cart.objects.filter(user_id=user_id, status='active').exclude(pk=keep.pk).update(status='abandoned')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_cart_totals'),
+    ]
+
+    operations = [
+        migrations.RunPython(abandon_extra_active_carts, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cart',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'active')), fields=('user',), name='unique_active_cart_per_user'),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.0.6 on 2026-10-18 08:44
+
+from decimal import Decimal
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_order_lines(apps, schema_editor):
+    """
+    Orders placed before lines existed only kept their products and the total quantity and
+    price. Each product gets a line: the quantity is split evenly, the first products taking
+    the remainder, and the price in proportion to product price times quantity, the rounding
+    left on the last line. Line totals therefore add up to the order's.
+    """
+    Order = apps.get_model('core', 'Order')
+    OrderLine = apps.get_model('core', 'OrderLine')
+    orders = Order.objects.filter(lines__isnull=True).prefetch_related('products').order_by('pk')
+    for order in orders.iterator(chunk_size=1000):
+        products = sorted(order.products.all(), key=lambda product: product.pk)
+        if not products:
+            continue
+        share, rest = divmod(order.quantity, len(products))
+        quantities = [share + (index < rest) for index in range(len(products))]
+        weights = [product.price * quantity for product, quantity in zip(products, quantities)]
+        total = sum(weights)
+        lines, left = [], order.price
+        for index, (product, quantity, weight) in enumerate(zip(products, quantities, weights)):
+            if index == len(products) - 1:
+                price = left
+            elif total:
+                price = (order.price * weight / total).quantize(Decimal('0.01'))
+            else:
+                price = (order.price / len(products)).quantize(Decimal('0.01'))
+            left -= price
+            lines.append(OrderLine(order=order, product=product, quantity=quantity, price=price))
+        OrderLine.objects.bulk_create(lines)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_unique_active_cart'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderLine',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.IntegerField(default=1, help_text='Quantity', verbose_name='Quantity')),
+                ('price', models.DecimalField(decimal_places=2, default=0, help_text='Price', max_digits=10, verbose_name='Price')),
+                ('created_at', models.DateTimeField(auto_now_add=True, help_text='Created At', verbose_name='Created At')),
+                ('order', models.ForeignKey(help_text='Order', on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='core.order', verbose_name='Order')),
+                ('product', models.ForeignKey(blank=True, help_text='Product', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='order_lines', to='core.product', verbose_name='Product')),
+            ],
+        ),
+        migrations.RunPython(backfill_order_lines, migrations.RunPython.noop),
+    ]
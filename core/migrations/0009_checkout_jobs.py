@@ -0,0 +1,43 @@
+# Generated by Django 5.0.6 on 2026-10-18 08:45
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_order_lines'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cart',
+            name='status',
+            field=models.CharField(choices=[('active', 'active'), ('checkout', 'checkout'), ('ordered', 'ordered'), ('abandoned', 'abandoned')], default='active', help_text='Status', max_length=255, verbose_name='Status'),
+        ),
+        migrations.CreateModel(
+            name='CheckoutJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('idempotency_key', models.CharField(help_text='Idempotency Key', max_length=255, verbose_name='Idempotency Key')),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('processing', 'processing'), ('succeeded', 'succeeded'), ('failed', 'failed')], default='pending', help_text='Status', max_length=255, verbose_name='Status')),
+                ('error', models.TextField(blank=True, default='', help_text='Error', verbose_name='Error')),
+                ('claimed_by', models.CharField(blank=True, help_text='Claimed By', max_length=255, null=True, verbose_name='Claimed By')),
+                ('attempts', models.IntegerField(default=0, help_text='Attempts', verbose_name='Attempts')),
+                ('created_at', models.DateTimeField(auto_now_add=True, help_text='Created At', verbose_name='Created At')),
+                ('updated_at', models.DateTimeField(auto_now=True, help_text='Updated At', verbose_name='Updated At')),
+                ('cart', models.ForeignKey(blank=True, help_text='Cart', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='checkout_jobs', to='core.cart', verbose_name='Cart')),
+                ('order', models.ForeignKey(blank=True, help_text='Order', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='checkout_jobs', to='core.order', verbose_name='Order')),
+                ('user', models.ForeignKey(help_text='User', on_delete=django.db.models.deletion.CASCADE, related_name='checkout_jobs', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'id'], name='checkout_job_status_idx'), models.Index(fields=['claimed_by'], name='checkout_job_claimed_by_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='checkoutjob',
+            constraint=models.UniqueConstraint(fields=('user', 'idempotency_key'), name='unique_checkout_job_key'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.0.6 on 2026-10-18 08:47
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_checkout_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(help_text='Key', max_length=255, verbose_name='Key')),
+                ('fingerprint', models.CharField(help_text='Fingerprint', max_length=64, verbose_name='Fingerprint')),
+                ('status_code', models.IntegerField(blank=True, help_text='Status Code', null=True, verbose_name='Status Code')),
+                ('body', models.JSONField(blank=True, help_text='Body', null=True, verbose_name='Body')),
+                ('headers', models.JSONField(blank=True, default=dict, help_text='Headers', verbose_name='Headers')),
+                ('locked_until', models.DateTimeField(help_text='Locked Until', verbose_name='Locked Until')),
+                ('expires_at', models.DateTimeField(help_text='Expires At', verbose_name='Expires At')),
+                ('created_at', models.DateTimeField(auto_now_add=True, help_text='Created At', verbose_name='Created At')),
+                ('user', models.ForeignKey(help_text='User', on_delete=django.db.models.deletion.CASCADE, related_name='idempotency_records', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['expires_at'], name='idempotency_expires_at_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='idempotencyrecord',
+            constraint=models.UniqueConstraint(fields=('user', 'key'), name='unique_idempotency_record_key'),
+        ),
+    ]
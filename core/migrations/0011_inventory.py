@@ -0,0 +1,50 @@
+# Generated by Django 5.0.6 on 2026-10-18 08:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_idempotency_records'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.IntegerField(help_text='Shard', verbose_name='Shard')),
+                ('quantity', models.IntegerField(default=0, help_text='Quantity', verbose_name='Quantity')),
+                ('product', models.ForeignKey(help_text='Product', on_delete=django.db.models.deletion.CASCADE, related_name='stock_counters', to='core.product', verbose_name='Product')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StockReservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.IntegerField(help_text='Shard', verbose_name='Shard')),
+                ('quantity', models.IntegerField(help_text='Quantity', verbose_name='Quantity')),
+                ('status', models.CharField(choices=[('held', 'held'), ('committed', 'committed'), ('released', 'released')], default='held', help_text='Status', max_length=255, verbose_name='Status')),
+                ('expires_at', models.DateTimeField(help_text='Expires At', verbose_name='Expires At')),
+                ('created_at', models.DateTimeField(auto_now_add=True, help_text='Created At', verbose_name='Created At')),
+                ('updated_at', models.DateTimeField(auto_now=True, help_text='Updated At', verbose_name='Updated At')),
+                ('cart', models.ForeignKey(blank=True, help_text='Cart', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='stock_reservations', to='core.cart', verbose_name='Cart')),
+                ('order', models.ForeignKey(blank=True, help_text='Order', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='stock_reservations', to='core.order', verbose_name='Order')),
+                ('product', models.ForeignKey(help_text='Product', on_delete=django.db.models.deletion.CASCADE, related_name='stock_reservations', to='core.product', verbose_name='Product')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='stockcounter',
+            constraint=models.UniqueConstraint(fields=('product', 'shard'), name='unique_stock_counter_shard'),
+        ),
+        migrations.AddConstraint(
+            model_name='stockcounter',
+            constraint=models.CheckConstraint(check=models.Q(('quantity__gte', 0)), name='stock_counter_quantity_gte_0'),
+        ),
+        migrations.AddIndex(
+            model_name='stockreservation',
+            index=models.Index(fields=['status', 'expires_at'], name='stock_reservation_expiry_idx'),
+        ),
+    ]
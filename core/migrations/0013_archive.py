@@ -0,0 +1,42 @@
+# Generated by Django 5.0.6 on 2026-10-18 08:52
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_order_user_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedCart',
+            fields=[
+                ('id', models.BigIntegerField(help_text='ID of the original cart', primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('active', 'active'), ('checkout', 'checkout'), ('ordered', 'ordered'), ('abandoned', 'abandoned')], help_text='Status', max_length=255, verbose_name='Status')),
+                ('item_count', models.IntegerField(default=0, help_text='Item Count', verbose_name='Item Count')),
+                ('subtotal', models.DecimalField(decimal_places=2, default=0, help_text='Subtotal', max_digits=10, verbose_name='Subtotal')),
+                ('items', models.JSONField(default=list, help_text='Items', verbose_name='Items')),
+                ('created_at', models.DateTimeField(help_text='Created At', verbose_name='Created At')),
+                ('updated_at', models.DateTimeField(help_text='Updated At', verbose_name='Updated At')),
+                ('archived_at', models.DateTimeField(auto_now_add=True, help_text='Archived At', verbose_name='Archived At')),
+                ('user', models.ForeignKey(blank=True, help_text='User', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='archived_carts', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedOrder',
+            fields=[
+                ('id', models.BigIntegerField(help_text='ID of the original order', primary_key=True, serialize=False, verbose_name='ID')),
+                ('data', models.JSONField(help_text='The order as RetrieveOrderSerializer rendered it', verbose_name='Data')),
+                ('created_at', models.DateTimeField(help_text='Created At', verbose_name='Created At')),
+                ('archived_at', models.DateTimeField(auto_now_add=True, help_text='Archived At', verbose_name='Archived At')),
+                ('user', models.ForeignKey(blank=True, help_text='User', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='archived_orders', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'created_at', 'id'], name='archived_order_user_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.0.6 on 2026-10-18 08:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(help_text='Name', max_length=255, unique=True, verbose_name='Name')),
+                ('last_id', models.BigIntegerField(default=0, help_text='Last ID', verbose_name='Last ID')),
+                ('updated_at', models.DateTimeField(auto_now=True, help_text='Updated At', verbose_name='Updated At')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SalesRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(help_text='Day', verbose_name='Day')),
+                ('dimension', models.CharField(choices=[('total', 'total'), ('product', 'product'), ('category', 'category')], help_text='Dimension', max_length=255, verbose_name='Dimension')),
+                ('key', models.BigIntegerField(default=0, help_text='Product or category id', verbose_name='Key')),
+                ('orders', models.IntegerField(default=0, help_text='Orders', verbose_name='Orders')),
+                ('units', models.IntegerField(default=0, help_text='Units', verbose_name='Units')),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, help_text='Revenue', max_digits=14, verbose_name='Revenue')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='salesrollup',
+            constraint=models.UniqueConstraint(fields=('dimension', 'day', 'key'), name='unique_sales_rollup_day_key'),
+        ),
+    ]
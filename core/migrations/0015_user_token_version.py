@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-18 08:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_sales_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='token_version',
+            field=models.IntegerField(default=0, help_text='Token Version', verbose_name='Token Version'),
+        ),
+    ]
@@ -1,4 +1,6 @@
 # from django.contrib.auth.models import AbstractUser
+from decimal import Decimal
+
 from django.db import models
 # from django.utils.translation import gettext_lazy as _
 from custom_user.models import AbstractEmailUser
@@ -8,6 +10,8 @@ class User(AbstractEmailUser):
     first_name = models.CharField(max_length=255, blank=True, null=True, default='', verbose_name='First Name')
     last_name = models.CharField(max_length=255, blank=True, null=True, default='', verbose_name='Last Name')
     phone = models.CharField(max_length=255, blank=True, null=True, default='', verbose_name='Phone')
+    # bumped when the password, is_active or permissions change, see core.authentication
+    token_version = models.IntegerField(default=0, verbose_name='Token Version', help_text='Token Version')
 
     def __str__(self):
         return self.email
@@ -58,9 +62,32 @@ class Product(models.Model):
     def __str__(self):
         return self.title
 
+    class Meta:
+        indexes = [
+            # backs the keyset pagination of the product list
+            models.Index(fields=['created_at', 'id'], name='product_created_at_id_idx'),
+        ]
+
+
+class ProductFacetCount(models.Model):
+    # precomputed facet counts, see core.facets. A null category holds the counts over all products.
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='facet_counts', null=True,
+                                 blank=True, verbose_name='Category', help_text='Category')
+    bucket = models.PositiveSmallIntegerField(verbose_name='Price Bucket', help_text='Price Bucket')
+    count = models.IntegerField(default=0, verbose_name='Count', help_text='Count')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['category', 'bucket'], name='unique_facet_category_bucket'),
+            models.UniqueConstraint(fields=['bucket'], condition=models.Q(category__isnull=True),
+                                    name='unique_facet_all_bucket'),
+        ]
+
 
 CART_STATUS = [
     ('active', 'active'),
+    # handed to the checkout queue, frozen until a worker orders it
+    ('checkout', 'checkout'),
     ('ordered', 'ordered'),
     ('abandoned', 'abandoned'),
 ]
@@ -71,12 +98,23 @@ class Cart(models.Model):
                               help_text='Status')
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='carts', null=True, blank=True,
                              verbose_name='User', help_text='User')
+    # running totals over the items, maintained by core.services.cart
+    item_count = models.IntegerField(default=0, verbose_name='Item Count', help_text='Item Count')
+    subtotal = models.DecimalField(decimal_places=2, max_digits=10, default=0, verbose_name='Subtotal',
+                                   help_text='Subtotal')
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Created At', help_text='Created At')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='Updated At', help_text='Updated At')
 
     def __str__(self):
         return self.user.email
 
+    class Meta:
+        constraints = [
+            # also the index behind every active cart lookup
+            models.UniqueConstraint(fields=['user'], condition=models.Q(status='active'),
+                                    name='unique_active_cart_per_user'),
+        ]
+
 
 class CartItem(models.Model):
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='items', verbose_name='Cart',
@@ -88,6 +126,12 @@ class CartItem(models.Model):
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Created At', help_text='Created At')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='Updated At', help_text='Updated At')
 
+    class Meta:
+        constraints = [
+            # one line per product, adding the same product again bumps the quantity (see core.services.cart)
+            models.UniqueConstraint(fields=['cart', 'product'], name='unique_cart_item_product'),
+        ]
+
 
 class Order(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='orders', null=True, blank=True)
@@ -96,3 +140,187 @@ class Order(models.Model):
     quantity = models.IntegerField(default=1, verbose_name='Quantity', help_text='Quantity')
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Created At', help_text='Created At')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='Updated At', help_text='Updated At')
+
+    class Meta:
+        indexes = [
+            # backs the keyset pagination of a user's order history
+            models.Index(fields=['user', 'created_at', 'id'], name='order_user_created_at_id_idx'),
+        ]
+
+
+class OrderLine(models.Model):
+    # snapshot of a cart item at checkout, independent of later price changes
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='lines', verbose_name='Order',
+                              help_text='Order')
+    product = models.ForeignKey(Product, on_delete=models.SET_NULL, related_name='order_lines', null=True,
+                                blank=True, verbose_name='Product', help_text='Product')
+    quantity = models.IntegerField(default=1, verbose_name='Quantity', help_text='Quantity')
+    price = models.DecimalField(decimal_places=2, max_digits=10, default=0, verbose_name='Price', help_text='Price')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Created At', help_text='Created At')
+
+    @property
+    def unit_price(self):
+        return (self.price / self.quantity).quantize(Decimal('0.01')) if self.quantity else self.price
+
+
+CHECKOUT_JOB_STATUS = [
+    ('pending', 'pending'),
+    ('processing', 'processing'),
+    ('succeeded', 'succeeded'),
+    ('failed', 'failed'),
+]
+
+
+class CheckoutJob(models.Model):
+    # queued asynchronous checkout, drained by the process_checkout_jobs command
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='checkout_jobs', verbose_name='User',
+                             help_text='User')
+    cart = models.ForeignKey(Cart, on_delete=models.SET_NULL, related_name='checkout_jobs', null=True, blank=True,
+                             verbose_name='Cart', help_text='Cart')
+    idempotency_key = models.CharField(max_length=255, verbose_name='Idempotency Key', help_text='Idempotency Key')
+    status = models.CharField(choices=CHECKOUT_JOB_STATUS, max_length=255, default='pending', verbose_name='Status',
+                              help_text='Status')
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, related_name='checkout_jobs', null=True, blank=True,
+                              verbose_name='Order', help_text='Order')
+    error = models.TextField(blank=True, default='', verbose_name='Error', help_text='Error')
+    claimed_by = models.CharField(max_length=255, null=True, blank=True, verbose_name='Claimed By',
+                                  help_text='Claimed By')
+    attempts = models.IntegerField(default=0, verbose_name='Attempts', help_text='Attempts')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Created At', help_text='Created At')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Updated At', help_text='Updated At')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'idempotency_key'], name='unique_checkout_job_key'),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'id'], name='checkout_job_status_idx'),
+            models.Index(fields=['claimed_by'], name='checkout_job_claimed_by_idx'),
+        ]
+
+
+class IdempotencyRecord(models.Model):
+    # response recorded for an (user, Idempotency-Key) pair, see core.idempotency
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='idempotency_records', verbose_name='User',
+                             help_text='User')
+    key = models.CharField(max_length=255, verbose_name='Key', help_text='Key')
+    fingerprint = models.CharField(max_length=64, verbose_name='Fingerprint', help_text='Fingerprint')
+    status_code = models.IntegerField(null=True, blank=True, verbose_name='Status Code', help_text='Status Code')
+    body = models.JSONField(null=True, blank=True, verbose_name='Body', help_text='Body')
+    headers = models.JSONField(default=dict, blank=True, verbose_name='Headers', help_text='Headers')
+    locked_until = models.DateTimeField(verbose_name='Locked Until', help_text='Locked Until')
+    expires_at = models.DateTimeField(verbose_name='Expires At', help_text='Expires At')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Created At', help_text='Created At')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='unique_idempotency_record_key'),
+        ]
+        indexes = [
+            models.Index(fields=['expires_at'], name='idempotency_expires_at_idx'),
+        ]
+
+
+class StockCounter(models.Model):
+    # one of several rows holding a product's stock, see core.services.inventory
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_counters',
+                                verbose_name='Product', help_text='Product')
+    shard = models.IntegerField(verbose_name='Shard', help_text='Shard')
+    quantity = models.IntegerField(default=0, verbose_name='Quantity', help_text='Quantity')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'shard'], name='unique_stock_counter_shard'),
+            models.CheckConstraint(check=models.Q(quantity__gte=0), name='stock_counter_quantity_gte_0'),
+        ]
+
+
+STOCK_RESERVATION_STATUS = [
+    ('held', 'held'),
+    ('committed', 'committed'),
+    ('released', 'released'),
+]
+
+
+class StockReservation(models.Model):
+    # stock taken from one counter shard for a cart, given back unless committed before it expires
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_reservations',
+                                verbose_name='Product', help_text='Product')
+    shard = models.IntegerField(verbose_name='Shard', help_text='Shard')
+    quantity = models.IntegerField(verbose_name='Quantity', help_text='Quantity')
+    cart = models.ForeignKey(Cart, on_delete=models.SET_NULL, related_name='stock_reservations', null=True,
+                             blank=True, verbose_name='Cart', help_text='Cart')
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, related_name='stock_reservations', null=True,
+                              blank=True, verbose_name='Order', help_text='Order')
+    status = models.CharField(choices=STOCK_RESERVATION_STATUS, max_length=255, default='held',
+                              verbose_name='Status', help_text='Status')
+    expires_at = models.DateTimeField(verbose_name='Expires At', help_text='Expires At')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Created At', help_text='Created At')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Updated At', help_text='Updated At')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'expires_at'], name='stock_reservation_expiry_idx'),
+        ]
+
+
+class ArchivedOrder(models.Model):
+    # an order moved out of the hot tables by the archive_records command, see core.services.archive
+    id = models.BigIntegerField(primary_key=True, verbose_name='ID', help_text='ID of the original order')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_orders', null=True, blank=True,
+                             verbose_name='User', help_text='User')
+    data = models.JSONField(verbose_name='Data', help_text='The order as RetrieveOrderSerializer rendered it')
+    created_at = models.DateTimeField(verbose_name='Created At', help_text='Created At')
+    archived_at = models.DateTimeField(auto_now_add=True, verbose_name='Archived At', help_text='Archived At')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at', 'id'], name='archived_order_user_idx'),
+        ]
+
+
+class ArchivedCart(models.Model):
+    # a closed cart moved out of the hot tables, items kept as JSON
+    id = models.BigIntegerField(primary_key=True, verbose_name='ID', help_text='ID of the original cart')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_carts', null=True, blank=True,
+                             verbose_name='User', help_text='User')
+    status = models.CharField(choices=CART_STATUS, max_length=255, verbose_name='Status', help_text='Status')
+    item_count = models.IntegerField(default=0, verbose_name='Item Count', help_text='Item Count')
+    subtotal = models.DecimalField(decimal_places=2, max_digits=10, default=0, verbose_name='Subtotal',
+                                   help_text='Subtotal')
+    items = models.JSONField(default=list, verbose_name='Items', help_text='Items')
+    created_at = models.DateTimeField(verbose_name='Created At', help_text='Created At')
+    updated_at = models.DateTimeField(verbose_name='Updated At', help_text='Updated At')
+    archived_at = models.DateTimeField(auto_now_add=True, verbose_name='Archived At', help_text='Archived At')
+
+
+SALES_ROLLUP_DIMENSION = [
+    ('total', 'total'),
+    ('product', 'product'),
+    ('category', 'category'),
+]
+
+
+class SalesRollup(models.Model):
+    # sales per day, see core.rollups. `key` is the product or category id, 0 for the day's totals.
+    # Not a foreign key so the history survives products and categories being deleted.
+    day = models.DateField(verbose_name='Day', help_text='Day')
+    dimension = models.CharField(choices=SALES_ROLLUP_DIMENSION, max_length=255, verbose_name='Dimension',
+                                 help_text='Dimension')
+    key = models.BigIntegerField(default=0, verbose_name='Key', help_text='Product or category id')
+    orders = models.IntegerField(default=0, verbose_name='Orders', help_text='Orders')
+    units = models.IntegerField(default=0, verbose_name='Units', help_text='Units')
+    revenue = models.DecimalField(decimal_places=2, max_digits=14, default=0, verbose_name='Revenue',
+                                  help_text='Revenue')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['dimension', 'day', 'key'], name='unique_sales_rollup_day_key'),
+        ]
+
+
+class RollupWatermark(models.Model):
+    # the last order folded into a rollup
+    name = models.CharField(max_length=255, unique=True, verbose_name='Name', help_text='Name')
+    last_id = models.BigIntegerField(default=0, verbose_name='Last ID', help_text='Last ID')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Updated At', help_text='Updated At')
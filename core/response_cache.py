@@ -0,0 +1,169 @@
+"""
+Versioned response cache for the read-only catalog endpoints.
+
+Each cached response is keyed on the view, action, serializer class, host,
+path, query string and the current version of every model it depends on.
+Signals in core.signals bump a model's version when it changes, which orphans
+all the entries built from the old data without having to find them.
+
+Each bump also records when it happened. A miss on a dependency bumped within
+the replica lag bound (`READ_YOUR_WRITES_WINDOW`, see core.routers) is built
+from the primary, since a replica may still hold the rows of the previous
+version; any other miss reads from the replicas like the rest of the catalog.
+
+Entries carry a strong ETag so a client revalidating with `If-None-Match`
+gets a 304 straight from the cache.
+
+The versions live under `response-version:`, apart from the entries: the
+in-process cache tier (core.cache_backends) invalidates a whole prefix at a
+time, and every bump would otherwise drop all the cached responses with it.
+Entries are written with `add`, they never change under the same key.
+"""
+import hashlib
+import json
+import time
+from contextlib import nullcontext
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.http import parse_etags
+from rest_framework.response import Response
+from rest_framework.status import HTTP_200_OK, HTTP_304_NOT_MODIFIED
+from rest_framework.utils.encoders import JSONEncoder
+
+from core.routers import READ_YOUR_WRITES_WINDOW, primary_reads
+
+RESPONSE_CACHE_TIMEOUT = getattr(settings, 'RESPONSE_CACHE_TIMEOUT', 60 * 15)
+
+VERSION_KEY = 'response-version:{}'
+BUMPED_KEY = 'response-version:bumped:{}'
+
+
+def _state_keys(names):
+    return {name: VERSION_KEY.format(name) for name in names}, [BUMPED_KEY.format(name) for name in names]
+
+
+def _bumped_recently(found, bumped_keys):
+    return any(time.time() - found[key] < READ_YOUR_WRITES_WINDOW for key in bumped_keys if key in found)
+
+
+def get_version_state(names):
+    """
+    The current version of each of `names`, and whether one of them was bumped recently
+    enough that a replica may not have the change yet. One cache read when all are known.
+    """
+    keys, bumped_keys = _state_keys(names)
+    found = cache.get_many([*keys.values(), *bumped_keys])
+    recent = _bumped_recently(found, bumped_keys)
+    versions = {}
+    for name, key in keys.items():
+        if key not in found:
+            # seed from the clock so an evicted version can never come back as an old value,
+            # and as just bumped since nothing says when it last changed
+            cache.add(BUMPED_KEY.format(name), time.time(), READ_YOUR_WRITES_WINDOW)
+            cache.add(key, time.time_ns(), timeout=None)
+            found[key] = cache.get(key)
+            recent = True
+        versions[name] = found[key]
+    return versions, recent
+
+
+async def aget_version_state(names):
+    """`get_version_state` for async views."""
+    keys, bumped_keys = _state_keys(names)
+    found = await cache.aget_many([*keys.values(), *bumped_keys])
+    recent = _bumped_recently(found, bumped_keys)
+    versions = {}
+    for name, key in keys.items():
+        if key not in found:
+            await cache.aadd(BUMPED_KEY.format(name), time.time(), READ_YOUR_WRITES_WINDOW)
+            await cache.aadd(key, time.time_ns(), timeout=None)
+            found[key] = await cache.aget(key)
+            recent = True
+        versions[name] = found[key]
+    return versions, recent
+
+
+def get_versions(names):
+    return get_version_state(names)[0]
+
+
+def building_reads(recent):
+    """Where a miss reads from: the primary right after a bump, the replicas otherwise."""
+    return primary_reads() if recent else nullcontext()
+
+
+def make_key(prefix, parts):
+    digest = hashlib.sha256(json.dumps(parts, default=str).encode()).hexdigest()
+    return f'response-cache:{prefix}:{digest}'
+
+
+def make_entry(data):
+    body = json.dumps(data, cls=JSONEncoder, sort_keys=True).encode()
+    return {'etag': '"%s"' % hashlib.sha256(body).hexdigest(), 'data': data}
+
+
+def etag_matches(request, etag):
+    if_none_match = request.headers.get('If-None-Match')
+    return bool(if_none_match) and (etag in parse_etags(if_none_match) or if_none_match.strip() == '*')
+
+
+def bump_version(name):
+    # before the version moves, so a miss on the new version always knows it is recent
+    cache.set(BUMPED_KEY.format(name), time.time(), READ_YOUR_WRITES_WINDOW)
+    key = VERSION_KEY.format(name)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns(), timeout=None)
+
+
+class CachedResponseMixin:
+    """
+    Serve `cached_actions` from the cache. `cache_dependencies` names the model
+    versions (see `bump_version`) the responses are built from.
+    """
+    cached_actions = ('list', 'retrieve')
+    cache_dependencies = ()
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        # runs after authentication and permission checks, so only the handler itself is skipped on a hit
+        if request.method == 'GET' and self.action in self.cached_actions:
+            self.get = partial(self.cached_handler, self.get)
+
+    def get_response_cache_key(self, request, kwargs, versions):
+        parts = [
+            self.basename,
+            self.action,
+            '{0.__module__}.{0.__qualname__}'.format(self.get_serializer_class()),
+            request.get_host(),
+            request.path,
+            sorted((key, sorted(values)) for key, values in request.query_params.lists()),
+            sorted(kwargs.items()),
+            sorted(versions.items()),
+        ]
+        return make_key(f'{self.basename}:{self.action}', parts)
+
+    def cached_handler(self, handler, request, *args, **kwargs):
+        versions, recent = get_version_state(self.cache_dependencies)
+        key = self.get_response_cache_key(request, kwargs, versions)
+        entry = cache.get(key)
+        if entry is None:
+            with building_reads(recent):
+                response = handler(request, *args, **kwargs)
+            if response.status_code != HTTP_200_OK:
+                return response
+            entry = make_entry(response.data)
+            cache.add(key, entry, RESPONSE_CACHE_TIMEOUT)
+        else:
+            response = None
+
+        etag = entry['etag']
+        if etag_matches(request, etag):
+            return Response(status=HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        if response is None:
+            response = Response(entry['data'])
+        response['ETag'] = etag
+        return response
@@ -0,0 +1,153 @@
+"""
+Daily sales rollups.
+
+`SalesRollup` holds orders, units and revenue per day for the whole shop,
+per product and per category. `roll_up_sales` folds in the orders created
+since the `RollupWatermark` in batches and moves the watermark in the same
+transaction, so every order is counted exactly once however often or
+concurrently it runs. Checkout itself does not touch the rollups: a per-day
+totals row written by every order would be the hottest row in the database.
+
+Orders younger than `SALES_ROLLUP_LAG` seconds are left for the next run, so a
+checkout that took a lower id but commits late is not skipped. Categories are
+attributed by the product's categories at the time the order is rolled up;
+an order counts once in each category it has products in.
+
+core.services.archive only moves orders the watermark has passed, so the
+rollups already hold them. `rebuild_sales_rollups` recounts the archived
+orders from their stored payload along with the hot ones.
+"""
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from core.models import ArchivedOrder, Order, OrderLine, Product, RollupWatermark, SalesRollup
+
+SALES_ROLLUP_LAG = getattr(settings, 'SALES_ROLLUP_LAG', 60)
+
+WATERMARK = 'sales'
+
+ProductCategory = Product.categories.through
+
+
+def _hot_lines(order_ids):
+    return list(OrderLine.objects.filter(order_id__in=order_ids, product__isnull=False).values_list(
+        'order_id', 'product_id', 'quantity', 'price'))
+
+
+def _deltas(orders, lines):
+    """
+    `{(dimension, day, key): [orders, units, revenue]}` for a batch of `(id, created_at, quantity, price)`
+    and their lines as `(order_id, product_id, quantity, price)`.
+    """
+    days = {order_id: timezone.localdate(created_at) for order_id, created_at, _, _ in orders}
+    categories = defaultdict(set)
+    for product_id, category_id in ProductCategory.objects.filter(
+            product_id__in={line[1] for line in lines}).values_list('product_id', 'category_id'):
+        categories[product_id].add(category_id)
+
+    deltas = defaultdict(lambda: [set(), 0, Decimal(0)])
+
+    def add(dimension, day, key, order_id, units, revenue):
+        delta = deltas[(dimension, day, key)]
+        delta[0].add(order_id)
+        delta[1] += units
+        delta[2] += revenue
+
+    for order_id, _, quantity, price in orders:
+        add('total', days[order_id], 0, order_id, quantity, price)
+    for order_id, product_id, quantity, price in lines:
+        add('product', days[order_id], product_id, order_id, quantity, price)
+        for category_id in categories[product_id]:
+            add('category', days[order_id], category_id, order_id, quantity, price)
+    return {key: [len(order_ids), units, revenue] for key, (order_ids, units, revenue) in deltas.items()}
+
+
+def _apply(deltas):
+    existing = {
+        (row.dimension, row.day, row.key): row
+        for row in SalesRollup.objects.filter(dimension__in={key[0] for key in deltas},
+                                              day__in={key[1] for key in deltas},
+                                              key__in={key[2] for key in deltas})
+    }
+    to_create, to_update = [], []
+    for (dimension, day, key), (orders, units, revenue) in deltas.items():
+        row = existing.get((dimension, day, key))
+        if row is None:
+            to_create.append(SalesRollup(dimension=dimension, day=day, key=key, orders=orders, units=units,
+                                         revenue=revenue))
+        else:
+            row.orders += orders
+            row.units += units
+            row.revenue += revenue
+            to_update.append(row)
+    SalesRollup.objects.bulk_create(to_create)
+    SalesRollup.objects.bulk_update(to_update, ['orders', 'units', 'revenue'])
+
+
+def roll_up_sales(batch_size=1000, max_batches=None, lag=SALES_ROLLUP_LAG):
+    """Fold the orders past the watermark into the rollups. Returns how many orders were rolled up."""
+    RollupWatermark.objects.get_or_create(name=WATERMARK)
+    cutoff = timezone.now() - timedelta(seconds=lag)
+    rolled = batches = 0
+    while max_batches is None or batches < max_batches:
+        with transaction.atomic():
+            # concurrent runs queue here instead of counting the same orders twice
+            watermark = RollupWatermark.objects.select_for_update().get(name=WATERMARK)
+            orders = list(Order.objects.filter(id__gt=watermark.last_id, created_at__lt=cutoff).order_by('id')
+                          .values_list('id', 'created_at', 'quantity', 'price')[:batch_size])
+            if not orders:
+                break
+            _apply(_deltas(orders, _hot_lines([order[0] for order in orders])))
+            watermark.last_id = orders[-1][0]
+            watermark.save(update_fields=['last_id', 'updated_at'])
+        rolled += len(orders)
+        batches += 1
+    return rolled
+
+
+def _roll_up_archived(batch_size):
+    rolled = 0
+    last_id = 0
+    while True:
+        batch = list(ArchivedOrder.objects.filter(id__gt=last_id).order_by('id')
+                     .values_list('id', 'created_at', 'data')[:batch_size])
+        if not batch:
+            return rolled
+        last_id = batch[-1][0]
+        orders, lines = [], []
+        for order_id, created_at, data in batch:
+            # the payload of RetrieveOrderSerializer, decimals rendered as strings
+            orders.append((order_id, created_at, data['quantity'], Decimal(str(data['price']))))
+            lines.extend((order_id, line['product'], line['quantity'], Decimal(str(line['price'])))
+                         for line in data['lines'] if line['product'] is not None)
+        _apply(_deltas(orders, lines))
+        rolled += len(batch)
+
+
+def rebuild_sales_rollups(batch_size=1000):
+    """Recompute the rollups from scratch, from the archived and the hot orders."""
+    RollupWatermark.objects.get_or_create(name=WATERMARK)
+    with transaction.atomic():
+        # holds off roll_up_sales and the archiver until the rebuild is done
+        RollupWatermark.objects.select_for_update().get(name=WATERMARK)
+        SalesRollup.objects.all().delete()
+        rolled = _roll_up_archived(batch_size)
+        RollupWatermark.objects.filter(name=WATERMARK).update(last_id=0)
+        return rolled + roll_up_sales(batch_size=batch_size)
+
+
+def sales_report(dimension, start, end, keys=None):
+    """Rollup rows of `dimension` between `start` and `end` inclusive, plus the sums over the range."""
+    rows = SalesRollup.objects.filter(dimension=dimension, day__gte=start, day__lte=end)
+    if keys:
+        rows = rows.filter(key__in=keys)
+    days = list(rows.order_by('day', 'key').values('day', 'key', 'orders', 'units', 'revenue'))
+    totals = list(rows.values('key').annotate(orders=Sum('orders'), units=Sum('units'), revenue=Sum('revenue'))
+                  .order_by('-revenue', 'key'))
+    return {'days': days, 'totals': totals}
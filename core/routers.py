@@ -0,0 +1,169 @@
+"""
+Database router sending catalog and order-history reads to the read replicas.
+
+Replicas are listed in `settings.REPLICA_DATABASES` as `{alias: weight}` and
+picked by smooth weighted round-robin, so a replica of weight 2 gets every
+other read of a weight 1 one rather than two reads in a row. Only reads made
+while serving a GET or HEAD request go to a replica: writes, reads inside a
+transaction on the primary, reads of a request that writes (an admin saving a
+product reads the old row first) and reads outside a request (management
+commands, workers) stay on the primary.
+
+Replicas lag behind the primary, so a user who has just written (added to
+the cart, checked out) would not see it in their next reads. A write made on
+behalf of an authenticated user pins them to the primary for
+`READ_YOUR_WRITES_WINDOW` seconds. The pin lives in the shared cache, so it
+holds for the user's next requests whichever worker serves them.
+`ReadYourWritesMiddleware` makes the current request's user known to the
+router.
+
+Responses stored in the response cache are built inside `primary_reads()`
+for `READ_YOUR_WRITES_WINDOW` seconds after one of their model versions is
+bumped: the cache key carries the versions bumped on commit on the primary, so
+rows read from a lagging replica would be cached under the new version. The
+window therefore has to cover the replica lag.
+"""
+import itertools
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+READ_YOUR_WRITES_WINDOW = getattr(settings, 'READ_YOUR_WRITES_WINDOW', 5)
+
+PIN_KEY = 'db-pin:{}'
+
+# (app_label, model_name) of the catalog and order-history tables
+REPLICA_MODELS = {
+    ('core', 'category'),
+    ('core', 'product'),
+    ('core', 'product_categories'),
+    ('core', 'productfacetcount'),
+    ('core', 'order'),
+    ('core', 'order_products'),
+    ('core', 'orderline'),
+    ('core', 'archivedorder'),
+}
+
+_request_state = ContextVar('db_router_request_state', default=None)
+_primary_reads = ContextVar('db_router_primary_reads', default=False)
+
+
+@contextmanager
+def primary_reads():
+    """Send every read made inside the block to the primary."""
+    token = _primary_reads.set(True)
+    try:
+        yield
+    finally:
+        _primary_reads.reset(token)
+
+
+def pin_to_primary(user_id):
+    """Send the reads of `user_id` to the primary for the next `READ_YOUR_WRITES_WINDOW` seconds."""
+    cache.set(PIN_KEY.format(user_id), True, READ_YOUR_WRITES_WINDOW)
+
+
+def _current_user_id():
+    state = _request_state.get()
+    if state is None:
+        return None
+    user = getattr(state['request'], 'user', None)
+    if user is None or not user.is_authenticated:
+        return None
+    return user.pk
+
+
+def _reads_primary():
+    state = _request_state.get()
+    if state is None or state['request'].method not in ('GET', 'HEAD') or _primary_reads.get():
+        return True
+    if state['pinned'] is None:
+        user_id = _current_user_id()
+        if user_id is None:
+            return False
+        # looked up once per request
+        state['pinned'] = bool(cache.get(PIN_KEY.format(user_id)))
+    return state['pinned']
+
+
+def _weighted_cycle(weights):
+    """Smooth weighted round-robin over `{alias: weight}`, one full period precomputed."""
+    total = sum(weights.values())
+    current = dict.fromkeys(weights, 0)
+    sequence = []
+    for _ in range(total):
+        for alias, weight in weights.items():
+            current[alias] += weight
+        alias = max(current, key=current.get)
+        current[alias] -= total
+        sequence.append(alias)
+    return itertools.cycle(sequence)
+
+
+class ReplicaRouter:
+    def __init__(self, replicas=None):
+        replicas = getattr(settings, 'REPLICA_DATABASES', {}) if replicas is None else replicas
+        self.replicas = {alias: weight for alias, weight in replicas.items() if weight > 0}
+        self._cycle = _weighted_cycle(self.replicas) if self.replicas else None
+
+    def db_for_read(self, model, **hints):
+        if self._cycle is None or 'instance' in hints:
+            # related lookups follow the object they start from
+            return None
+        if (model._meta.app_label, model._meta.model_name) not in REPLICA_MODELS:
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block or _reads_primary():
+            return DEFAULT_DB_ALIAS
+        return next(self._cycle)
+
+    def db_for_write(self, model, **hints):
+        state = _request_state.get()
+        if self._cycle is not None and state is not None and not state['pinned']:
+            user_id = _current_user_id()
+            if user_id is not None:
+                pin_to_primary(user_id)
+                state['pinned'] = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *self.replicas}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get the schema through replication
+        if db in self.replicas:
+            return False
+        return None
+
+
+class ReadYourWritesMiddleware:
+    """Expose the current request to `ReplicaRouter`, which reads its user once authenticated."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = _request_state.set({'request': request, 'pinned': None})
+        try:
+            return self.get_response(request)
+        finally:
+            _request_state.reset(token)
+
+    async def __acall__(self, request):
+        token = _request_state.set({'request': request, 'pinned': None})
+        try:
+            return await self.get_response(request)
+        finally:
+            _request_state.reset(token)
@@ -0,0 +1,128 @@
+"""
+Full-text search over `Product.title`, `summary` and `description`.
+
+On PostgreSQL the index is a generated `search_vector` tsvector column with a
+GIN index (see migration 0003), so the database keeps it current on every
+write. On SQLite an external-content FTS5 table is kept in sync by triggers.
+Either way a product save updates only its own index entry.
+"""
+import re
+
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.db.models import Q
+
+from core.models import Product
+
+SEARCH_CONFIG = 'english'
+
+SQLITE_FTS_TABLE = 'core_product_fts'
+
+SQLITE_FTS_SQL = [
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {SQLITE_FTS_TABLE} USING fts5(
+        title, summary, description,
+        content='core_product', content_rowid='id', tokenize='porter unicode61'
+    )
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS core_product_fts_ai AFTER INSERT ON core_product BEGIN
+        INSERT INTO {SQLITE_FTS_TABLE}(rowid, title, summary, description)
+        VALUES (new.id, new.title, new.summary, new.description);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS core_product_fts_ad AFTER DELETE ON core_product BEGIN
+        INSERT INTO {SQLITE_FTS_TABLE}({SQLITE_FTS_TABLE}, rowid, title, summary, description)
+        VALUES ('delete', old.id, old.title, old.summary, old.description);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS core_product_fts_au AFTER UPDATE OF title, summary, description ON core_product
+    BEGIN
+        INSERT INTO {SQLITE_FTS_TABLE}({SQLITE_FTS_TABLE}, rowid, title, summary, description)
+        VALUES ('delete', old.id, old.title, old.summary, old.description);
+        INSERT INTO {SQLITE_FTS_TABLE}(rowid, title, summary, description)
+        VALUES (new.id, new.title, new.summary, new.description);
+    END
+    """,
+]
+
+SQLITE_FTS_TRIGGERS = ('core_product_fts_ai', 'core_product_fts_ad', 'core_product_fts_au')
+
+
+def ensure_sqlite_index(using=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    Recreate the FTS5 triggers if they are missing.
+
+    SQLite migrations that alter `core_product` rebuild the table and silently
+    drop its triggers, so this runs after every `migrate` and rebuilds the
+    index when it had to reinstall them.
+    """
+    conn = connections[using]
+    if conn.vendor != 'sqlite':
+        return
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name IN (%s, %s, %s)",
+            SQLITE_FTS_TRIGGERS
+        )
+        if len(cursor.fetchall()) == len(SQLITE_FTS_TRIGGERS):
+            return
+        if 'core_product' not in conn.introspection.table_names(cursor):
+            return
+        for statement in SQLITE_FTS_SQL:
+            cursor.execute(statement)
+        cursor.execute(f"INSERT INTO {SQLITE_FTS_TABLE}({SQLITE_FTS_TABLE}) VALUES ('rebuild')")
+
+
+def _fts5_query(query):
+    # quote every term so user input can never be parsed as FTS5 syntax
+    terms = re.findall(r'\w+', query)
+    return ' '.join(f'"{term}"' for term in terms)
+
+
+def _search_postgresql(query, limit):
+    from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVectorField
+    from django.db.models.expressions import RawSQL
+
+    vector = RawSQL('"core_product"."search_vector"', (), output_field=SearchVectorField())
+    search_query = SearchQuery(query, config=SEARCH_CONFIG, search_type='websearch')
+    return list(
+        Product.objects.prefetch_related('categories')
+        .annotate(search=vector, rank=SearchRank(vector, search_query))
+        .filter(search=search_query)
+        .order_by('-rank', '-id')[:limit]
+    )
+
+
+def _search_sqlite(query, limit):
+    match = _fts5_query(query)
+    if not match:
+        return []
+    with connection.cursor() as cursor:
+        # bm25 weights follow the column order: title, summary, description
+        cursor.execute(
+            f"SELECT rowid FROM {SQLITE_FTS_TABLE} WHERE {SQLITE_FTS_TABLE} MATCH %s "
+            f"ORDER BY bm25({SQLITE_FTS_TABLE}, 10.0, 5.0, 1.0) LIMIT %s",
+            [match, limit]
+        )
+        ids = [row[0] for row in cursor.fetchall()]
+    products = Product.objects.prefetch_related('categories').in_bulk(ids)
+    return [products[pk] for pk in ids if pk in products]
+
+
+def search_products(query, limit=20):
+    """Return up to `limit` products matching `query`, best match first."""
+    query = (query or '').strip()
+    if not query:
+        return []
+    if connection.vendor == 'postgresql':
+        return _search_postgresql(query, limit)
+    if connection.vendor == 'sqlite':
+        return _search_sqlite(query, limit)
+    # no index for other backends, fall back to a plain scan
+    return list(
+        Product.objects.prefetch_related('categories').filter(
+            Q(title__icontains=query) | Q(summary__icontains=query) | Q(description__icontains=query)
+        ).order_by('-created_at', '-id')[:limit]
+    )
@@ -3,12 +3,14 @@ from dj_rest_auth.registration.serializers import RegisterSerializer
 from dj_rest_auth.serializers import LoginSerializer, UserDetailsSerializer, UserModel
 from django.contrib.auth import get_user_model
 from rest_framework import serializers
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from allauth.account.models import EmailAddress
 from allauth.account import app_settings as allauth_account_settings
 
 from django.utils.translation import gettext_lazy as _
 
-from core.models import Product, Category, Cart, CartItem, Address, Order, User
+from core.authentication import TOKEN_VERSION_CLAIM
+from core.models import Product, Category, Cart, CartItem, Address, Order, User, OrderLine, CheckoutJob
 
 
 # class UserSerializer(serializers.ModelSerializer):
@@ -66,7 +68,7 @@ class GetCartSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Cart
-        fields = ['id', 'status', 'items']
+        fields = ['id', 'status', 'item_count', 'subtotal', 'items']
 
 
 class CreateOrderSerializer(serializers.ModelSerializer):
@@ -80,12 +82,25 @@ class CreateOrderSerializer(serializers.ModelSerializer):
         fields = ['user', 'products', 'price', 'quantity']
 
 
+class OrderLineSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = OrderLine
+        fields = ['product', 'quantity', 'price']
+
+
 class RetrieveOrderSerializer(serializers.ModelSerializer):
     products = ListProductSerializer(many=True)
+    lines = OrderLineSerializer(many=True)
 
     class Meta:
         model = Order
-        fields = ['id', 'products', 'price', 'quantity', 'created_at']
+        fields = ['id', 'products', 'lines', 'price', 'quantity', 'created_at']
+
+
+class CheckoutJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = CheckoutJob
+        fields = ['id', 'status', 'order', 'error', 'created_at', 'updated_at']
 
 
 class ListOrderSerializer(serializers.ModelSerializer):
@@ -110,6 +125,29 @@ class AddItemToCartSerializer(serializers.ModelSerializer):
         fields = ['cart', 'product', 'quantity', 'price']
 
 
+class CartItemQuantitySerializer(serializers.Serializer):
+    # plain ids, the cart service resolves the product itself
+    product = serializers.IntegerField(min_value=1)
+    quantity = serializers.IntegerField(min_value=1, default=1)
+
+
+class CartBatchOperationSerializer(serializers.Serializer):
+    op = serializers.ChoiceField(choices=['add', 'set', 'remove'])
+    product = serializers.IntegerField(min_value=1)
+    quantity = serializers.IntegerField(min_value=0, required=False)
+
+    def validate(self, attrs):
+        if attrs['op'] == 'add' and not attrs.get('quantity'):
+            raise serializers.ValidationError({'quantity': _('Adding requires a quantity of at least 1.')})
+        if attrs['op'] == 'set' and 'quantity' not in attrs:
+            raise serializers.ValidationError({'quantity': _('This field is required.')})
+        return attrs
+
+
+class CartBatchSerializer(serializers.Serializer):
+    operations = CartBatchOperationSerializer(many=True, allow_empty=False, max_length=200)
+
+
 class AddressSerializer(serializers.ModelSerializer):
     user = serializers.HiddenField(default=serializers.CurrentUserDefault())
 
@@ -124,6 +162,15 @@ class UserLoginSerializer(LoginSerializer):
     password = serializers.CharField(required=True, write_only=True)
 
 
+class TokenClaimsSerializer(TokenObtainPairSerializer):
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        # copied into every access token refreshed from it, checked by CachedJWTCookieAuthentication
+        token[TOKEN_VERSION_CLAIM] = user.token_version
+        return token
+
+
 class UserRegistrationSerializer(RegisterSerializer):
     username = None
 
@@ -0,0 +1,95 @@
+"""
+Cold storage for old orders and closed carts.
+
+`archive_orders` and `archive_carts` move rows older than a cutoff out of the
+hot tables in bounded batches: each batch is copied into `ArchivedOrder` /
+`ArchivedCart` as one JSON document per row and deleted from the hot tables
+in the same transaction, so a row is always in exactly one place. The hot
+tables and their indexes stay about as large as the retention window rather
+than growing forever.
+
+An archived order keeps the payload of `RetrieveOrderSerializer`, so
+`OrderViewSet.retrieve` can return it unchanged. Only orders the sales rollup
+watermark has passed are archived, so none leaves the hot tables uncounted
+(see core.rollups).
+"""
+import json
+
+from django.db import transaction
+from django.db.models import Prefetch
+from rest_framework.utils.encoders import JSONEncoder
+
+from core.models import ArchivedCart, ArchivedOrder, Cart, CartItem, Order, OrderLine, Product, RollupWatermark
+from core.rollups import WATERMARK
+from core.serializers import RetrieveOrderSerializer
+
+# carts that can no longer change
+CLOSED_CART_STATUSES = ('ordered', 'abandoned')
+
+
+def _json(data):
+    return json.loads(json.dumps(data, cls=JSONEncoder))
+
+
+def _in_batches(queryset, archive_batch, batch_size, max_batches):
+    """Run `archive_batch` over `queryset` in id order, one transaction per batch. Returns the rows moved."""
+    moved = batches = 0
+    last_id = 0
+    while max_batches is None or batches < max_batches:
+        with transaction.atomic():
+            batch = list(queryset.filter(id__gt=last_id).order_by('id')[:batch_size])
+            if not batch:
+                break
+            archive_batch(batch)
+        last_id = batch[-1].id
+        moved += len(batch)
+        batches += 1
+    return moved
+
+
+def _archive_orders(orders):
+    # waits for a running rollup rebuild, which must see each order in exactly one of the two tables
+    RollupWatermark.objects.select_for_update().filter(name=WATERMARK).first()
+    ArchivedOrder.objects.bulk_create([
+        ArchivedOrder(id=order.id, user_id=order.user_id, data=_json(RetrieveOrderSerializer(order).data),
+                      created_at=order.created_at)
+        for order in orders
+    ], ignore_conflicts=True)
+    Order.objects.filter(id__in=[order.id for order in orders]).delete()
+
+
+def archive_orders(before, batch_size=500, max_batches=None):
+    """
+    Move the orders created before `before` and already rolled up into the sales rollups
+    to the archive. Returns how many were moved.
+    """
+    rolled_up_to = RollupWatermark.objects.filter(name=WATERMARK).values_list('last_id', flat=True).first() or 0
+    orders = Order.objects.filter(created_at__lt=before, id__lte=rolled_up_to).prefetch_related(
+        Prefetch('products', queryset=Product.objects.prefetch_related('categories').order_by('id')),
+        Prefetch('lines', queryset=OrderLine.objects.order_by('id')),
+    )
+    return _in_batches(orders, _archive_orders, batch_size, max_batches)
+
+
+def _archive_carts(carts):
+    ArchivedCart.objects.bulk_create([
+        ArchivedCart(id=cart.id, user_id=cart.user_id, status=cart.status, item_count=cart.item_count,
+                     subtotal=cart.subtotal, created_at=cart.created_at, updated_at=cart.updated_at,
+                     items=_json([{'product': item.product_id, 'quantity': item.quantity, 'price': item.price}
+                                  for item in cart.items.all()]))
+        for cart in carts
+    ], ignore_conflicts=True)
+    Cart.objects.filter(id__in=[cart.id for cart in carts]).delete()
+
+
+def archive_carts(before, batch_size=500, max_batches=None):
+    """Move the ordered and abandoned carts last touched before `before` to the archive."""
+    carts = Cart.objects.filter(status__in=CLOSED_CART_STATUSES, updated_at__lt=before).prefetch_related(
+        Prefetch('items', queryset=CartItem.objects.order_by('id'))
+    )
+    return _in_batches(carts, _archive_carts, batch_size, max_batches)
+
+
+def get_archived_order(user, order_id):
+    """The archived payload of one of `user`'s orders, or None."""
+    return ArchivedOrder.objects.filter(user=user, pk=order_id).values_list('data', flat=True).first()
@@ -0,0 +1,263 @@
+"""
+Cart mutations.
+
+Adding a product is a single `INSERT ... ON CONFLICT DO UPDATE` against the
+unique `(cart, product)` constraint, so concurrent adds to the same line are
+merged by the database instead of racing on a read-modify-write in Python.
+
+A batch of add/set/remove operations is folded per product first and then
+written with at most one DELETE, one bulk INSERT and one bulk UPDATE.
+
+Every mutation also moves `Cart.item_count` and `Cart.subtotal` by the same
+delta with an F() update, so reading the totals never aggregates the items.
+`reconcile_totals` recomputes them from scratch to catch any drift. That update
+only matches a cart still active and raises `CartNotActive` otherwise, which
+rolls the mutation back: a cart checked out meanwhile is never written to.
+"""
+from decimal import Decimal
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, OuterRef, Prefetch, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from core.models import Cart, CartItem, Product
+
+UPSERT_ITEM_SQL = """
+    INSERT INTO core_cartitem (cart_id, product_id, quantity, price, created_at, updated_at)
+    VALUES (%s, %s, %s, %s, %s, %s)
+    ON CONFLICT (cart_id, product_id) DO UPDATE SET
+        quantity = core_cartitem.quantity + EXCLUDED.quantity,
+        price = core_cartitem.price + EXCLUDED.price,
+        updated_at = EXCLUDED.updated_at
+    RETURNING id, quantity, price
+"""
+
+PRICE_QUANTUM = Decimal('0.01')
+
+
+class CartNotActive(Exception):
+    pass
+
+
+class UnknownProducts(Exception):
+    def __init__(self, product_ids):
+        super().__init__(product_ids)
+        self.product_ids = sorted(product_ids)
+
+
+def with_items(carts):
+    """
+    Load the items of `carts` the way GetCartSerializer reads them: the products joined
+    in and their categories prefetched, three queries however many items there are.
+    """
+    items = CartItem.objects.select_related('product').prefetch_related('product__categories').order_by('id')
+    return carts.prefetch_related(Prefetch('items', queryset=items))
+
+
+def get_active_cart(user):
+    return Cart.objects.filter(user=user, status='active').first()
+
+
+def get_active_cart_for_read(user):
+    return with_items(Cart.objects.filter(user=user, status='active')).first()
+
+
+def get_or_create_active_cart(user):
+    cart = get_active_cart(user)
+    if cart is None:
+        try:
+            with transaction.atomic():
+                cart = Cart.objects.create(user=user, status='active')
+        except IntegrityError:
+            # a concurrent request created it first, there is only ever one active cart per user
+            cart = Cart.objects.get(user=user, status='active')
+    return cart
+
+
+def _move_totals(cart, quantity, price):
+    # also row-locks the cart until the transaction ends, so a checkout waits for the mutation or the other way round
+    if not Cart.objects.filter(pk=cart.pk, status='active').update(item_count=F('item_count') + quantity,
+                                                                  subtotal=F('subtotal') + price):
+        raise CartNotActive()
+
+
+def _upsert_item(cart, product_id, quantity, price):
+    now = connection.ops.adapt_datetimefield_value(timezone.now())
+    with connection.cursor() as cursor:
+        cursor.execute(UPSERT_ITEM_SQL, [cart.id, product_id, quantity, price, now, now])
+        item_id, total_quantity, total_price = cursor.fetchone()
+    # sqlite hands the decimal column back as a float
+    total_price = Decimal(str(total_price)).quantize(PRICE_QUANTUM)
+    return CartItem(id=item_id, cart=cart, product_id=product_id, quantity=total_quantity, price=total_price)
+
+
+def _update_or_create_item(cart, product_id, quantity, price):
+    # backends without ON CONFLICT: increment in place, insert if the line does not exist yet
+    lines = CartItem.objects.filter(cart=cart, product_id=product_id)
+    if not lines.update(quantity=F('quantity') + quantity, price=F('price') + price):
+        try:
+            with transaction.atomic():
+                return CartItem.objects.create(cart=cart, product_id=product_id, quantity=quantity, price=price)
+        except IntegrityError:
+            # another request inserted the line in the meantime
+            lines.update(quantity=F('quantity') + quantity, price=F('price') + price)
+    return lines.get()
+
+
+@transaction.atomic
+def add_item(cart, product_id, quantity):
+    """
+    Add `quantity` of a product to `cart` and return the resulting line.
+
+    Raises `Product.DoesNotExist` for an unknown product and `CartNotActive` if the cart
+    was checked out.
+    """
+    unit_price = Product.objects.values_list('price', flat=True).get(pk=product_id)
+    price = unit_price * quantity
+    if connection.vendor in ('postgresql', 'sqlite'):
+        item = _upsert_item(cart, product_id, quantity, price)
+    else:
+        item = _update_or_create_item(cart, product_id, quantity, price)
+    _move_totals(cart, quantity, price)
+    return item
+
+
+@transaction.atomic
+def set_item_quantity(cart, product_id, quantity):
+    """
+    Set the quantity of a line already in `cart`, repricing it at the current product price.
+
+    Raises `CartItem.DoesNotExist` if the product is not in the cart and `CartNotActive`
+    if the cart was checked out.
+    """
+    item = CartItem.objects.select_for_update().select_related('product').get(cart=cart, product_id=product_id)
+    price = item.product.price * quantity
+    quantity_delta, price_delta = quantity - item.quantity, price - item.price
+    item.quantity, item.price = quantity, price
+    item.save(update_fields=['quantity', 'price', 'updated_at'])
+    _move_totals(cart, quantity_delta, price_delta)
+    return item
+
+
+@transaction.atomic
+def remove_item(cart, product_id):
+    """
+    Remove a product from `cart`.
+
+    Raises `CartItem.DoesNotExist` if the product is not in the cart and `CartNotActive`
+    if the cart was checked out.
+    """
+    item = CartItem.objects.select_for_update().get(cart=cart, product_id=product_id)
+    CartItem.objects.filter(pk=item.pk).delete()
+    _move_totals(cart, -item.quantity, -item.price)
+
+
+def _fold_operations(operations):
+    """
+    Collapse the operations into one target per product: ('set', quantity) when the
+    final quantity is known, ('add', quantity) when it is relative to what is stored.
+    """
+    targets = {}
+    for operation in operations:
+        product_id = operation['product']
+        kind, quantity = targets.get(product_id, ('add', 0))
+        if operation['op'] == 'add':
+            targets[product_id] = (kind, quantity + operation['quantity'])
+        elif operation['op'] == 'set':
+            targets[product_id] = ('set', operation['quantity'])
+        else:
+            targets[product_id] = ('set', 0)
+    return targets
+
+
+@transaction.atomic
+def apply_batch(cart, operations):
+    """
+    Apply a list of `{'op': 'add' | 'set' | 'remove', 'product': id, 'quantity': n}`
+    operations to `cart` in one transaction and return it reloaded with its items.
+
+    Raises `UnknownProducts` before writing anything if an id does not exist and
+    `CartNotActive` if the cart was checked out.
+    """
+    targets = _fold_operations(operations)
+    products = Product.objects.only('id', 'price').in_bulk(list(targets))
+    missing = set(targets) - set(products)
+    if missing:
+        raise UnknownProducts(missing)
+
+    # lock the lines so the totals delta is computed against what is actually replaced
+    lines = {item.product_id: item for item in
+             CartItem.objects.select_for_update().filter(cart=cart, product_id__in=list(targets))}
+
+    now = timezone.now()
+    to_delete, to_create, to_update = [], [], []
+    quantity_delta, price_delta = 0, Decimal(0)
+    for product_id, (kind, quantity) in targets.items():
+        unit_price = products[product_id].price
+        line = lines.get(product_id)
+        if kind == 'set' and quantity == 0:
+            if line is not None:
+                to_delete.append(line.id)
+                quantity_delta -= line.quantity
+                price_delta -= line.price
+        elif line is None:
+            if quantity:
+                to_create.append(CartItem(cart=cart, product_id=product_id, quantity=quantity,
+                                          price=unit_price * quantity, created_at=now, updated_at=now))
+                quantity_delta += quantity
+                price_delta += unit_price * quantity
+        elif kind == 'set':
+            quantity_delta += quantity - line.quantity
+            price_delta += unit_price * quantity - line.price
+            line.quantity = quantity
+            line.price = unit_price * quantity
+            line.updated_at = now
+            to_update.append(line)
+        elif quantity:
+            quantity_delta += quantity
+            price_delta += unit_price * quantity
+            # relative changes stay relative so a concurrent add-item is not overwritten
+            line.quantity = F('quantity') + quantity
+            line.price = F('price') + unit_price * quantity
+            line.updated_at = now
+            to_update.append(line)
+
+    if to_delete:
+        CartItem.objects.filter(id__in=to_delete).delete()
+    if to_create:
+        CartItem.objects.bulk_create(to_create)
+    if to_update:
+        CartItem.objects.bulk_update(to_update, ['quantity', 'price', 'updated_at'])
+    _move_totals(cart, quantity_delta, price_delta)
+    return with_items(Cart.objects.filter(pk=cart.pk)).get()
+
+
+def reconcile_totals(carts=None, fix=False, batch_size=1000):
+    """
+    Compare the stored totals of `carts` (all carts by default) with a full recompute
+    over their items. Returns `(cart_id, stored, actual)` for every mismatch and, with
+    `fix`, overwrites the stored values.
+    """
+    carts = Cart.objects.all() if carts is None else carts
+    items = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+    carts = carts.annotate(
+        actual_count=Coalesce(Subquery(items.annotate(total=Sum('quantity')).values('total')), Value(0)),
+        actual_subtotal=Coalesce(Subquery(items.annotate(total=Sum('price')).values('total')), Value(Decimal(0))),
+    ).order_by('pk').values_list('pk', 'item_count', 'subtotal', 'actual_count', 'actual_subtotal')
+
+    mismatches = []
+    last_pk = 0
+    while True:
+        # keyset batches keep memory flat on large tables
+        batch = list(carts.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            break
+        last_pk = batch[-1][0]
+        for pk, item_count, subtotal, actual_count, actual_subtotal in batch:
+            actual_subtotal = Decimal(str(actual_subtotal)).quantize(PRICE_QUANTUM)
+            if item_count != actual_count or subtotal != actual_subtotal:
+                mismatches.append((pk, (item_count, subtotal), (actual_count, actual_subtotal)))
+                if fix:
+                    Cart.objects.filter(pk=pk).update(item_count=actual_count, subtotal=actual_subtotal)
+    return mismatches
@@ -0,0 +1,185 @@
+"""
+Cache-backed store for each user's active cart.
+
+The cache holds `{'id': cart_id, 'data': GetCartSerializer data}` per user, so
+reading the active cart is a single cache hit and a mutation does not have to
+look the cart up first. Mutations write to the database through
+core.services.cart and drop the cached contents; the next read loads them from
+the committed rows.
+
+The cached id is only a hint: the totals update of every mutation only matches
+an active cart (see core.services.cart), so an id left behind by a checkout on
+another worker is caught, forgotten and looked up again instead of written to.
+
+Entries also carry the user's cart generation, bumped after every committed
+change. A refresh that read the database before a later change commits stores
+the old generation, and readers ignore it rather than serve the older cart.
+
+Works with any Django cache backend: the local-memory one in tests and a
+shared one (Redis) across workers in production.
+"""
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from core.models import Cart, CartItem
+from core.serializers import GetCartSerializer
+from core.services import cart as cart_service
+
+CART_STORE_TIMEOUT = getattr(settings, 'CART_STORE_TIMEOUT', 60 * 30)
+
+ACTIVE_CART_KEY = 'cart-store:active:{}'
+GENERATION_KEY = 'cart-store:generation:{}'
+
+
+def _key(user):
+    return ACTIVE_CART_KEY.format(user.pk)
+
+
+def _generation_key(user):
+    return GENERATION_KEY.format(user.pk)
+
+
+def _generation(user):
+    key = _generation_key(user)
+    generation = cache.get(key)
+    if generation is None:
+        # seeded from the clock so a lost counter never comes back at a value an old entry carries
+        cache.add(key, time.time_ns(), CART_STORE_TIMEOUT)
+        generation = cache.get(key)
+    return generation
+
+
+def _bump_generation(user):
+    try:
+        cache.incr(_generation_key(user))
+    except ValueError:
+        # nothing to outdate without a counter, the next refresh seeds a new one
+        pass
+
+
+def _remember(user, cart_id, data=None, generation=None):
+    cache.set(_key(user), {'id': cart_id, 'data': data, 'generation': generation}, CART_STORE_TIMEOUT)
+
+
+def _fresh_data(found, user):
+    entry = found.get(_key(user))
+    if entry is None or entry['data'] is None or entry.get('generation') != found.get(_generation_key(user)):
+        return None
+    return entry['data']
+
+
+def _cart_ref(user, cart_id):
+    # enough of a Cart for the service layer to write against, without loading the row
+    return Cart(pk=cart_id, user=user, status='active')
+
+
+def refresh(user):
+    """Reload the active cart from the database into the cache and return its data."""
+    # read before the rows, so a change committing in between outdates what is stored here
+    generation = _generation(user)
+    cart = cart_service.get_active_cart_for_read(user)
+    if cart is None:
+        cache.delete(_key(user))
+        return None
+    data = GetCartSerializer(cart).data
+    _remember(user, cart.pk, data, generation)
+    return data
+
+
+def _forgotten(user):
+    _bump_generation(user)
+    cache.delete(_key(user))
+
+
+def forget(user):
+    # once now and again after commit, so a read in between cannot bring back the old cart
+    cache.delete(_key(user))
+    transaction.on_commit(lambda: _forgotten(user))
+
+
+def _written(user, cart_id):
+    # drop the stale contents now, the bump after commit outdates whatever a read in between stores
+    _remember(user, cart_id)
+    transaction.on_commit(lambda: _bump_generation(user))
+
+
+def get_active_cart(user):
+    """The serialized active cart of `user`, created if they have none."""
+    data = _fresh_data(cache.get_many([_key(user), _generation_key(user)]), user)
+    if data is not None:
+        return data
+    data = refresh(user)
+    if data is None:
+        generation = _generation(user)
+        cart = cart_service.get_or_create_active_cart(user)
+        data = GetCartSerializer(cart).data
+        _remember(user, cart.pk, data, generation)
+    return data
+
+
+async def aget_active_cart(user):
+    """`get_active_cart` for async views: a cache hit never leaves the event loop."""
+    data = _fresh_data(await cache.aget_many([_key(user), _generation_key(user)]), user)
+    if data is not None:
+        return data
+    # a miss may create the cart, leave that to the sync path
+    return await sync_to_async(get_active_cart)(user)
+
+
+def find_active_cart(user):
+    """A reference to the active cart of `user`, or None if they have none."""
+    entry = cache.get(_key(user))
+    if entry is not None:
+        return _cart_ref(user, entry['id'])
+    cart = cart_service.get_active_cart(user)
+    if cart is not None:
+        _remember(user, cart.pk)
+    return cart
+
+
+def _write(user, cart, write, create=False):
+    """
+    Run `write(cart)` against the active cart of `user` and return its result. `cart`
+    (or the cached id) is checked by the write itself and replaced by the current active
+    cart if it was checked out meanwhile. Raises `CartItem.DoesNotExist` if there is no
+    active cart and not `create`.
+    """
+    if cart is None:
+        cart = find_active_cart(user)
+    while True:
+        if cart is None:
+            if not create:
+                raise CartItem.DoesNotExist()
+            cart = cart_service.get_or_create_active_cart(user)
+        try:
+            result = write(cart)
+        except (cart_service.CartNotActive, CartItem.DoesNotExist) as exc:
+            # the write was rolled back; a missing line may be in the cart that replaced this one
+            current = cart_service.get_active_cart(user)
+            if isinstance(exc, CartItem.DoesNotExist) and (current is None or current.pk == cart.pk):
+                raise
+            cache.delete(_key(user))
+            cart = current
+            continue
+        _written(user, cart.pk)
+        return result
+
+
+def add_item(user, product_id, quantity):
+    return _write(user, None, lambda cart: cart_service.add_item(cart, product_id, quantity), create=True)
+
+
+def apply_batch(user, operations):
+    return _write(user, None, lambda cart: cart_service.apply_batch(cart, operations), create=True)
+
+
+def set_item_quantity(user, cart, product_id, quantity):
+    return _write(user, cart, lambda cart: cart_service.set_item_quantity(cart, product_id, quantity))
+
+
+def remove_item(user, cart, product_id):
+    _write(user, cart, lambda cart: cart_service.remove_item(cart, product_id))
@@ -0,0 +1,68 @@
+"""
+Checkout of the active cart.
+
+The stock for the items is reserved first, in a short transaction of its own
+(see core.services.inventory), so the inventory counters are not locked while
+the order is written. Everything else happens in one transaction with the cart
+row locked, so a failure leaves the cart active and untouched, hands the
+reserved stock back, and a concurrent checkout of the same cart cannot create
+a second order. The query count is fixed: lock the cart, read its items,
+insert the order, bulk insert the lines and the order-product links, commit
+the reservations, close the cart.
+"""
+from django.db import transaction
+from django.utils import timezone
+
+from core.models import Cart, CartItem, Order, OrderLine
+from core.services import inventory
+
+
+class NoActiveCart(Exception):
+    pass
+
+
+class EmptyCart(Exception):
+    pass
+
+
+def checkout(user):
+    """
+    Turn the active cart of `user` into an order and return it. Raises
+    `inventory.OutOfStock` or `inventory.InventoryBusy` when the stock cannot be reserved.
+    """
+    items = list(CartItem.objects.filter(cart__user=user, cart__status='active').values_list(
+        'cart_id', 'product_id', 'quantity'))
+    cart_id = items[0][0] if items else None
+    if cart_id is not None:
+        inventory.reserve_cart(cart_id, {product_id: quantity for _, product_id, quantity in items})
+    try:
+        with transaction.atomic():
+            cart = Cart.objects.select_for_update().filter(user=user, status='active').first()
+            if cart is None:
+                raise NoActiveCart()
+            return checkout_cart(cart)
+    except Exception:
+        if cart_id is not None:
+            inventory.release_cart(cart_id)
+        raise
+
+
+def checkout_cart(cart):
+    """Order the items of a cart already locked by the caller."""
+    items = list(cart.items.order_by('id').values_list('product_id', 'quantity', 'price'))
+    if not items:
+        raise EmptyCart()
+
+    # the cart keeps running totals (see core.services.cart), so nothing needs summing here
+    order = Order.objects.create(user_id=cart.user_id, price=cart.subtotal, quantity=cart.item_count)
+    OrderLine.objects.bulk_create([
+        OrderLine(order=order, product_id=product_id, quantity=quantity, price=price)
+        for product_id, quantity, price in items
+    ])
+    Order.products.through.objects.bulk_create([
+        Order.products.through(order_id=order.pk, product_id=product_id)
+        for product_id in {product_id for product_id, _, _ in items}
+    ])
+    inventory.commit_cart(cart.pk, order, {product_id: quantity for product_id, quantity, _ in items})
+    Cart.objects.filter(pk=cart.pk).update(status='ordered', updated_at=timezone.now())
+    return order
@@ -0,0 +1,179 @@
+"""
+Asynchronous checkout backed by the `CheckoutJob` table.
+
+`enqueue` freezes the active cart (status `checkout`) and records a job keyed
+by the client's Idempotency-Key, so a retried request finds the job it already
+created instead of ordering twice. Workers started by the
+`process_checkout_jobs` command claim pending jobs in batches and run the
+regular checkout on each one. The job is marked done in the same transaction
+that creates the order, so a crashed worker leaves the job to be claimed again
+rather than half applied.
+
+Every write to a claimed job is conditional on the worker's claim token, so a
+worker whose job was taken over after it went stale cannot overwrite the
+outcome of the worker that took it, nor release the stock its order committed.
+The claim is refreshed as each job of a batch starts.
+"""
+import logging
+import os
+import time
+import uuid
+from datetime import timedelta
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from core.metrics import record_checkout
+from core.models import Cart, CartItem, CheckoutJob
+from core.routers import pin_to_primary
+from core.services import checkout as checkout_service, inventory
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue(user, idempotency_key):
+    """
+    Queue a checkout of the active cart and return `(job, created)`.
+
+    Raises `checkout.NoActiveCart` or `checkout.EmptyCart` when there is nothing to order,
+    and `inventory.OutOfStock` or `inventory.InventoryBusy` when the stock cannot be reserved.
+    The stock is reserved right away so the client learns about it from this request,
+    the worker commits the reservation.
+    """
+    job = CheckoutJob.objects.filter(user=user, idempotency_key=idempotency_key).first()
+    if job is not None:
+        return job, False
+    try:
+        with transaction.atomic():
+            cart = Cart.objects.select_for_update().filter(user=user, status='active').first()
+            if cart is None:
+                raise checkout_service.NoActiveCart()
+            if not cart.item_count:
+                raise checkout_service.EmptyCart()
+            # under the cart lock, so a concurrent enqueue of the same cart cannot replace or release these holds;
+            # the counter rows stay locked only until the job row below is written
+            inventory.reserve_cart(cart.pk, dict(cart.items.values_list('product_id', 'quantity')))
+            Cart.objects.filter(pk=cart.pk).update(status='checkout', updated_at=timezone.now())
+            job = CheckoutJob.objects.create(user=user, cart=cart, idempotency_key=idempotency_key)
+    except (IntegrityError, checkout_service.NoActiveCart):
+        # the same key raced us here and already froze the cart, nothing of ours was kept
+        job = CheckoutJob.objects.filter(user=user, idempotency_key=idempotency_key).first()
+        if job is not None:
+            return job, False
+        raise
+    return job, True
+
+
+def _claimable(now, stale_after):
+    return CheckoutJob.objects.filter(
+        Q(status='pending') | Q(status='processing', updated_at__lt=now - stale_after)
+    )
+
+
+def claim_jobs(worker_id, batch_size, stale_after=timedelta(minutes=5)):
+    """
+    Atomically take up to `batch_size` jobs for this worker. Jobs left `processing` for
+    longer than `stale_after` belonged to a worker that died and are taken over.
+    """
+    token = f'{worker_id}:{uuid.uuid4().hex}'
+    now = timezone.now()
+    claimable = _claimable(now, stale_after).order_by('id')
+    with transaction.atomic():
+        if connection.features.has_select_for_update_skip_locked:
+            # workers skip each other's rows instead of queueing on them
+            claimable = claimable.select_for_update(skip_locked=True)
+        ids = list(claimable.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return []
+        # conditional on the state we read, so a job is never handed to two workers
+        _claimable(now, stale_after).filter(id__in=ids).update(status='processing', claimed_by=token,
+                                                                updated_at=now)
+    return list(CheckoutJob.objects.filter(claimed_by=token, status='processing').order_by('id'))
+
+
+def _claimed(job):
+    return CheckoutJob.objects.filter(pk=job.pk, claimed_by=job.claimed_by, status='processing')
+
+
+def _fail(job, error, result):
+    with transaction.atomic():
+        if not _claimed(job).update(status='failed', error=error, attempts=job.attempts + 1,
+                                    updated_at=timezone.now()):
+            # taken over by another worker, the outcome is theirs to record
+            return
+        record_checkout('async', result)
+        if job.cart_id is None:
+            return
+        inventory.release_cart(job.cart_id)
+        # give the cart back so it can be fixed and checked out again, unless a new one was started meanwhile
+        try:
+            with transaction.atomic():
+                Cart.objects.filter(pk=job.cart_id, status='checkout').update(status='active')
+        except IntegrityError:
+            Cart.objects.filter(pk=job.cart_id, status='checkout').update(status='abandoned')
+
+
+def _retry_later(job, error, result):
+    # the cart stays frozen and its stock held, the next claim runs the checkout again
+    if _claimed(job).update(status='pending', claimed_by=None, error=error, attempts=job.attempts + 1,
+                            updated_at=timezone.now()):
+        record_checkout('async', result)
+
+
+def process_job(job):
+    """
+    Run the checkout of a claimed job. Returns True when an order was created. A job
+    whose stock counters stay locked goes back to pending instead of failing.
+    """
+    # the rest of the batch waited behind the jobs before this one, renew the claim before it looks stale
+    if not _claimed(job).update(updated_at=timezone.now()):
+        return False
+    try:
+        with transaction.atomic():
+            # the row lock keeps a takeover out until this transaction is over
+            if not _claimed(job).select_for_update().exists():
+                return False
+            cart = Cart.objects.select_for_update().filter(pk=job.cart_id, status='checkout').first()
+            if cart is None:
+                raise checkout_service.NoActiveCart()
+            order = checkout_service.checkout_cart(cart)
+            _claimed(job).update(
+                status='succeeded', order=order, error='', attempts=job.attempts + 1, updated_at=timezone.now()
+            )
+    except checkout_service.NoActiveCart:
+        _fail(job, 'Cart is no longer waiting for checkout', 'no_cart')
+        return False
+    except checkout_service.EmptyCart:
+        _fail(job, 'Cart is empty', 'empty_cart')
+        return False
+    except inventory.OutOfStock as exc:
+        _fail(job, 'Not enough stock for products {}'.format(', '.join(map(str, exc.product_ids))), 'out_of_stock')
+        return False
+    except inventory.InventoryBusy:
+        _retry_later(job, 'Stock is busy', 'busy')
+        return False
+    except Exception as exc:
+        logger.exception('Checkout job %s failed', job.pk)
+        _fail(job, str(exc) or exc.__class__.__name__, 'error')
+        return False
+    record_checkout('async', 'succeeded')
+    # the worker wrote the order outside the user's requests, make their next reads see it
+    pin_to_primary(job.user_id)
+    return True
+
+
+def run_worker(worker_id, batch_size=50, poll_interval=1.0, once=False, stale_after=timedelta(minutes=5)):
+    """Drain the queue batch by batch. With `once`, return as soon as it is empty."""
+    worker_id = f'{worker_id}@{os.getpid()}'
+    processed = 0
+    while True:
+        jobs = claim_jobs(worker_id, batch_size, stale_after=stale_after)
+        if not jobs:
+            if once:
+                return processed
+            time.sleep(poll_interval)
+            continue
+        for job in jobs:
+            process_job(job)
+            processed += 1
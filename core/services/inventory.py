@@ -0,0 +1,275 @@
+"""
+Stock kept in several counter rows per product.
+
+A product's stock is spread over `INVENTORY_SHARDS` `StockCounter` rows. A
+reservation plans what to take from each row over a snapshot of the counters,
+starting from a random shard, and takes all of it with one conditional
+`UPDATE ... WHERE quantity >= n`; if a counter moved meanwhile it goes again
+with the counters of its products locked. Concurrent buyers of the same
+product therefore mostly lock different rows instead of queueing on one, the
+number of queries does not grow with the number of products, and each row
+lock is held only for the short transaction that writes the reservation, not
+for the whole checkout. On PostgreSQL that transaction also
+gives up after `INVENTORY_LOCK_TIMEOUT_MS` waiting on a row lock and is retried.
+
+Reserved stock is recorded as `StockReservation` rows, committed to the order
+at checkout or handed back to their shard when released or expired (see the
+`release_expired_reservations` command). Products without counter rows are not
+stock-tracked and can always be ordered.
+"""
+import random
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import timedelta
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.utils import timezone
+
+from core.models import CartItem, StockCounter, StockReservation
+
+INVENTORY_SHARDS = getattr(settings, 'INVENTORY_SHARDS', 8)
+INVENTORY_RESERVATION_TTL = getattr(settings, 'INVENTORY_RESERVATION_TTL', 60 * 15)
+INVENTORY_LOCK_TIMEOUT_MS = getattr(settings, 'INVENTORY_LOCK_TIMEOUT_MS', 200)
+
+RESERVE_ATTEMPTS = 3
+
+
+class OutOfStock(Exception):
+    def __init__(self, product_ids):
+        super().__init__(product_ids)
+        self.product_ids = sorted(product_ids)
+
+
+class InventoryBusy(Exception):
+    pass
+
+
+def set_stock(product_id, quantity, shards=INVENTORY_SHARDS):
+    """Replace the available stock of a product, spread evenly over `shards` counter rows."""
+    share, rest = divmod(quantity, shards)
+    with transaction.atomic():
+        StockCounter.objects.filter(product_id=product_id).delete()
+        StockCounter.objects.bulk_create([
+            StockCounter(product_id=product_id, shard=shard, quantity=share + (shard < rest))
+            for shard in range(shards)
+        ])
+
+
+def available(product_ids):
+    """Available stock per product id. Untracked products are left out."""
+    stock = defaultdict(int)
+    for product_id, quantity in StockCounter.objects.filter(product_id__in=product_ids).values_list(
+            'product_id', 'quantity'):
+        stock[product_id] += quantity
+    return dict(stock)
+
+
+@contextmanager
+def _lock_timeout():
+    """Give up waiting on a row lock after `INVENTORY_LOCK_TIMEOUT_MS` inside the block."""
+    if connection.vendor != 'postgresql':
+        yield
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT current_setting('lock_timeout')")
+        previous = cursor.fetchone()[0]
+        cursor.execute('SET LOCAL lock_timeout = %s', [f'{INVENTORY_LOCK_TIMEOUT_MS}ms'])
+    yield
+    # SET LOCAL outlives a released savepoint, put the caller's limit back (a rolled back one undoes it anyway)
+    with connection.cursor() as cursor:
+        cursor.execute('SET LOCAL lock_timeout = %s', [previous])
+
+
+def _counters(product_ids, lock=False):
+    """The counter rows of the products as `{product_id: [(counter_id, shard, quantity)]}`."""
+    counters = StockCounter.objects.filter(product_id__in=product_ids)
+    if lock:
+        # in id order, so two buyers going through here cannot deadlock
+        counters = counters.select_for_update().order_by('id')
+    rows = defaultdict(list)
+    for counter_id, product_id, shard, quantity in counters.values_list('id', 'product_id', 'shard', 'quantity'):
+        rows[product_id].append((counter_id, shard, quantity))
+    return rows
+
+
+def _plan(counters, quantities):
+    """
+    Spread what each product needs over its counters. Returns `{counter_id: (product_id,
+    shard, take)}` and the products that do not have enough.
+    """
+    takes, short = {}, []
+    for product_id in sorted(counters):
+        needed = quantities[product_id]
+        shards = sorted(counters[product_id], key=lambda row: row[1])
+        # start at a random shard so concurrent buyers of the same product land on different rows
+        start = random.randrange(len(shards))
+        for counter_id, shard, quantity in shards[start:] + shards[:start]:
+            if not needed:
+                break
+            take = min(needed, quantity)
+            if take > 0:
+                takes[counter_id] = (product_id, shard, take)
+                needed -= take
+        if needed:
+            short.append(product_id)
+    return takes, short
+
+
+def _by_counter(amounts):
+    return Case(*[When(pk=counter_id, then=Value(amount)) for counter_id, amount in amounts.items()],
+                default=Value(0))
+
+
+def _decrement(takes):
+    """Take the planned amounts in one UPDATE, each only if its counter still has it. Returns the rows updated."""
+    if not takes:
+        return 0
+    return StockCounter.objects.filter(
+        reduce(or_, [Q(pk=counter_id, quantity__gte=take) for counter_id, (_, _, take) in takes.items()])
+    ).update(quantity=F('quantity') - _by_counter({counter_id: take for counter_id, (_, _, take) in takes.items()}))
+
+
+def _take(takes):
+    """Take the planned amounts, all or nothing. False if a counter no longer has its share."""
+    if not takes:
+        return True
+    savepoint = transaction.savepoint()
+    if _decrement(takes) == len(takes):
+        transaction.savepoint_commit(savepoint)
+        return True
+    transaction.savepoint_rollback(savepoint)
+    return False
+
+
+def _reserve(cart_id, quantities, **fields):
+    takes, short = _plan(_counters(list(quantities)), quantities)
+    if short or not _take(takes):
+        # the snapshot was stale, go again over the current counts with nobody else moving them
+        takes, short = _plan(_counters(list(quantities), lock=True), quantities)
+        if short:
+            # raised inside the caller's transaction, so nothing taken above is kept
+            raise OutOfStock(short)
+        _decrement(takes)
+
+    expires_at = timezone.now() + timedelta(seconds=INVENTORY_RESERVATION_TTL)
+    reservations = [StockReservation(product_id=product_id, shard=shard, quantity=take, cart_id=cart_id,
+                                     expires_at=expires_at, **fields) for product_id, shard, take in takes.values()]
+    StockReservation.objects.bulk_create(reservations)
+    return reservations
+
+
+def reserve(cart_id, quantities, replace=False):
+    """
+    Hold `{product_id: quantity}` for a cart in a short transaction of its own and return
+    the reservations, after releasing what the cart held before if `replace`. Raises
+    `OutOfStock` if a product does not have enough stock left and `InventoryBusy` if the
+    counter rows stay locked by other buyers.
+    """
+    for attempt in range(RESERVE_ATTEMPTS):
+        try:
+            with transaction.atomic(), _lock_timeout():
+                if replace:
+                    _release(StockReservation.objects.filter(cart_id=cart_id, status='held'))
+                return _reserve(cart_id, quantities)
+        except DatabaseError:
+            # lock timeout or deadlock between shards, nothing was kept
+            if attempt == RESERVE_ATTEMPTS - 1:
+                raise InventoryBusy()
+
+
+def reserve_cart(cart_id, quantities=None):
+    """Hold the stock for the items of a cart, replacing whatever it held before."""
+    if quantities is None:
+        quantities = dict(CartItem.objects.filter(cart_id=cart_id).values_list('product_id', 'quantity'))
+    return reserve(cart_id, quantities, replace=True)
+
+
+def _give_back(rows):
+    returned = defaultdict(int)
+    for product_id, shard, quantity in rows:
+        returned[(product_id, shard)] += quantity
+    counters, first = {}, {}
+    for counter_id, product_id, shard in StockCounter.objects.filter(
+            product_id__in={product_id for product_id, _ in returned}).order_by('product_id', 'shard').values_list(
+            'id', 'product_id', 'shard'):
+        counters[(product_id, shard)] = counter_id
+        first.setdefault(product_id, counter_id)
+    amounts = defaultdict(int)
+    for (product_id, shard), quantity in returned.items():
+        # a shard rebuilt away by set_stock meanwhile hands its stock to the product's first one
+        counter_id = counters.get((product_id, shard), first.get(product_id))
+        if counter_id is not None:
+            amounts[counter_id] += quantity
+    if amounts:
+        StockCounter.objects.filter(pk__in=list(amounts)).update(quantity=F('quantity') + _by_counter(amounts))
+
+
+def _release(reservations):
+    rows = list(reservations.select_for_update().values_list('id', 'product_id', 'shard', 'quantity'))
+    if rows:
+        StockReservation.objects.filter(id__in=[row[0] for row in rows]).update(status='released',
+                                                                                updated_at=timezone.now())
+        _give_back([row[1:] for row in rows])
+    return len(rows)
+
+
+@transaction.atomic
+def release_cart(cart_id):
+    """Hand the stock still held for a cart back to the counters."""
+    return _release(StockReservation.objects.filter(cart_id=cart_id, status='held'))
+
+
+def release_expired(batch_size=1000):
+    """Release every held reservation past its expiry, in batches. Returns how many were released."""
+    released = 0
+    now = timezone.now()
+    while True:
+        with transaction.atomic():
+            expired = StockReservation.objects.filter(status='held', expires_at__lte=now).order_by('id')
+            if connection.features.has_select_for_update_skip_locked:
+                # a checkout committing one of them right now keeps it
+                expired = expired.select_for_update(skip_locked=True)
+            ids = list(expired.values_list('id', flat=True)[:batch_size])
+            if not ids:
+                return released
+            released += _release(StockReservation.objects.filter(id__in=ids, status='held'))
+
+
+def commit_cart(cart_id, order, quantities):
+    """
+    Turn the stock held for a cart into stock sold with `order`. Runs inside the checkout
+    transaction; if the holds no longer match the items (the cart changed, or they expired)
+    the stock is taken again right there, raising `OutOfStock` or `InventoryBusy` like `reserve`.
+    """
+    tracked = set(StockCounter.objects.filter(product_id__in=list(quantities))
+                  .values_list('product_id', flat=True).distinct())
+    needed = {product_id: quantities[product_id] for product_id in tracked}
+    held = list(StockReservation.objects.filter(cart_id=cart_id, status='held').values_list(
+        'id', 'product_id', 'quantity'))
+    held_quantities = defaultdict(int)
+    for _, product_id, quantity in held:
+        held_quantities[product_id] += quantity
+
+    if dict(held_quantities) == needed:
+        if not held:
+            return
+        ids = [row[0] for row in held]
+        savepoint = transaction.savepoint()
+        if StockReservation.objects.filter(id__in=ids, status='held').update(
+                status='committed', order=order, updated_at=timezone.now()) == len(ids):
+            transaction.savepoint_commit(savepoint)
+            return
+        # some were swept while we got here, their stock is back on the counters
+        transaction.savepoint_rollback(savepoint)
+
+    try:
+        # a savepoint, so a lock timeout leaves the checkout transaction usable for the caller
+        with transaction.atomic(), _lock_timeout():
+            release_cart(cart_id)
+            _reserve(cart_id, needed, status='committed', order=order)
+    except DatabaseError:
+        raise InventoryBusy()
@@ -0,0 +1,151 @@
+from collections import Counter
+
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from core import facets
+from core.authentication import CACHED_FIELDS, REVOKING_FIELDS, bump_token_version, forget_user
+from core.models import Category, Product, User
+from core.response_cache import bump_version
+
+
+@receiver(pre_save, sender=Product)
+def remember_product_price(sender, instance, raw=False, **kwargs):
+    # the facet store needs to know which price bucket the product is moving out of
+    instance._facet_old_price = None
+    if instance.pk and not raw:
+        instance._facet_old_price = (Product.objects.filter(pk=instance.pk)
+                                     .values_list('price', flat=True).first())
+
+
+@receiver(post_save, sender=Product)
+def update_facets_on_product_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    new_bucket = facets.bucket_for(instance.price)
+    old_price = getattr(instance, '_facet_old_price', None)
+    if created or old_price is None:
+        # categories are linked afterwards and counted by the m2m handler
+        facets.apply_delta(new_bucket, [], 1)
+        return
+    old_bucket = facets.bucket_for(old_price)
+    if old_bucket == new_bucket:
+        return
+    category_ids = list(instance.categories.values_list('id', flat=True))
+    facets.apply_delta(old_bucket, category_ids, -1)
+    facets.apply_delta(new_bucket, category_ids, 1)
+
+
+@receiver(pre_delete, sender=Product)
+def update_facets_on_product_delete(sender, instance, **kwargs):
+    # the category links are removed by the cascade without an m2m_changed signal
+    category_ids = list(instance.categories.values_list('id', flat=True))
+    facets.apply_delta(facets.bucket_for(instance.price), category_ids, -1)
+
+
+@receiver(m2m_changed, sender=Product.categories.through)
+def update_facets_on_category_links(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # remember what is about to be unlinked, post_clear no longer knows
+        if reverse:
+            instance._facet_cleared = list(instance.products.values_list('price', flat=True))
+        else:
+            instance._facet_cleared = list(instance.categories.values_list('id', flat=True))
+        return
+
+    if action == 'post_clear':
+        cleared = getattr(instance, '_facet_cleared', [])
+        if reverse:
+            _apply_category_delta(instance.pk, cleared, -1)
+        else:
+            _apply_link_delta(instance.price, cleared, -1)
+        return
+
+    if action not in ('post_add', 'post_remove') or not pk_set:
+        return
+    delta = 1 if action == 'post_add' else -1
+    if reverse:
+        # category.products.add(...): one category, many products
+        prices = Product.objects.filter(pk__in=pk_set).values_list('price', flat=True)
+        _apply_category_delta(instance.pk, prices, delta)
+    else:
+        _apply_link_delta(instance.price, pk_set, delta)
+
+
+def _apply_link_delta(price, category_ids, delta):
+    facets.apply_delta(facets.bucket_for(price), category_ids, delta, include_all=False)
+
+
+def _apply_category_delta(category_id, prices, delta):
+    # one update per bucket rather than per product
+    for bucket, count in Counter(facets.bucket_for(price) for price in prices).items():
+        facets.apply_delta(bucket, [category_id], delta * count, include_all=False)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(m2m_changed, sender=Product.categories.through)
+def invalidate_product_responses(sender, **kwargs):
+    # bump after commit, otherwise a concurrent read could cache the old rows under the new version
+    transaction.on_commit(lambda: bump_version('product'))
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category_responses(sender, **kwargs):
+    transaction.on_commit(lambda: bump_version('category'))
+
+
+@receiver(pre_save, sender=User)
+def bump_token_version_on_revoking_change(sender, instance, raw=False, update_fields=None, **kwargs):
+    instance._revoked_version = None
+    if raw or instance.pk is None:
+        return
+    if update_fields is not None and not set(update_fields) & set(REVOKING_FIELDS):
+        # e.g. last_login on every login, nothing to compare
+        return
+    stored = User.objects.filter(pk=instance.pk).values(*REVOKING_FIELDS, 'token_version').first()
+    if stored is None:
+        return
+    # never write back a version older than the stored one, that would revive revoked tokens
+    instance.token_version = stored['token_version']
+    if any(getattr(instance, field) != stored[field] for field in REVOKING_FIELDS):
+        instance._revoked_version = stored['token_version']
+        instance.token_version += 1
+
+
+@receiver(post_save, sender=User)
+def invalidate_cached_user(sender, instance, raw=False, update_fields=None, **kwargs):
+    revoked = getattr(instance, '_revoked_version', None)
+    if revoked is None and update_fields is not None and not set(update_fields) & set(CACHED_FIELDS):
+        # e.g. last_login on every login, the cached row is still right
+        return
+    if revoked is not None and update_fields is not None and 'token_version' not in update_fields:
+        User.objects.filter(pk=instance.pk).update(token_version=instance.token_version)
+    forget_user(instance.pk, *{instance.token_version, revoked} - {None})
+
+
+@receiver(post_delete, sender=User)
+def forget_deleted_user(sender, instance, **kwargs):
+    forget_user(instance.pk, instance.token_version)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+def bump_token_version_on_permission_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        # group.user_set.clear(): remember who is about to lose the group
+        instance._token_cleared = list(instance.user_set.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        user_ids = [instance.pk]
+        instance.token_version += 1
+    elif action == 'post_clear':
+        user_ids = getattr(instance, '_token_cleared', [])
+    else:
+        user_ids = list(pk_set or ())
+    if user_ids:
+        bump_token_version(user_ids)
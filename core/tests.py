@@ -1,3 +1,1106 @@
-from django.test import TestCase
+from base64 import b64encode
+from datetime import timedelta
+from decimal import Decimal
+from importlib import import_module
+from unittest import mock, skipUnless
+from urllib.parse import urlencode
 
-# Create your tests here.
+from django.apps import apps
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.checks import run_checks
+from django.core.handlers.asgi import ASGIHandler
+from django.db import OperationalError, connection, transaction
+from django.http import QueryDict
+from django.test import AsyncClient, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.request import Request
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from core.authentication import USER_KEY, CachedJWTCookieAuthentication, get_cached_user
+from core.cache_backends import LocalStore, TieredCache
+from core.facets import parse_filters
+from core.models import ArchivedCart, ArchivedOrder, Cart, CartItem, Category, CheckoutJob, IdempotencyRecord, Order, \
+    OrderLine, Product, SalesRollup, StockCounter, StockReservation, User
+from core.pagination import KeysetPagination
+from core.response_cache import BUMPED_KEY, bump_version, get_versions
+from core.rollups import rebuild_sales_rollups, roll_up_sales
+from core.routers import ReadYourWritesMiddleware, ReplicaRouter, primary_reads
+from core.search import SQLITE_FTS_TRIGGERS, ensure_sqlite_index, search_products
+from core.serializers import TokenClaimsSerializer
+from core.services import archive, cart as cart_service, cart_store, checkout as checkout_service, checkout_queue, \
+    inventory
+from core.throttling import TokenBucketThrottle, take
+
+
+class ActiveCartQueryCountTests(TestCase):
+    """GET /cart/active-cart/ must cost the same number of queries however big the cart is."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email='buyer@example.com', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.cart = Cart.objects.create(user=self.user, status='active')
+        self.categories = [Category.objects.create(name=f'Category {i}') for i in range(3)]
+
+    def add_products(self, count):
+        for _ in range(count):
+            product = Product.objects.create(title='Product', price=Decimal('9.99'))
+            product.categories.set(self.categories)
+            CartItem.objects.create(cart=self.cart, product=product, quantity=1, price=product.price)
+
+    def assert_active_cart_queries(self, expected_items):
+        # measure the database read path, not the cart store
+        cache.clear()
+        # cart, items joined with their products, product categories
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/cart/active-cart/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['items']), expected_items)
+        for item in response.data['items']:
+            self.assertEqual(len(item['product']['categories']), len(self.categories))
+
+    def test_query_count_is_constant(self):
+        self.add_products(1)
+        self.assert_active_cart_queries(1)
+        self.add_products(20)
+        self.assert_active_cart_queries(21)
+
+
+class OrderHistoryTests(TestCase):
+    """The order endpoints only see the user's own orders and retrieve costs a fixed number of queries."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(email='buyer@example.com', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.categories = [Category.objects.create(name=f'Category {i}') for i in range(3)]
+
+    def create_order(self, user, products):
+        order = Order.objects.create(user=user, price=Decimal('9.99') * products, quantity=products)
+        for _ in range(products):
+            product = Product.objects.create(title='Product', price=Decimal('9.99'))
+            product.categories.set(self.categories)
+            order.products.add(product)
+            OrderLine.objects.create(order=order, product=product, quantity=1, price=product.price)
+        return order
+
+    def test_orders_are_scoped_to_the_user(self):
+        other = User.objects.create_user(email='other@example.com', password='password')
+        own = self.create_order(self.user, 1)
+        foreign = self.create_order(other, 1)
+        response = self.client.get('/api/orders/')
+        self.assertEqual([order['id'] for order in response.data['results']], [own.id])
+        self.assertEqual(self.client.get(f'/api/orders/{foreign.id}/').status_code, 404)
+
+    def test_retrieve_query_count_is_constant(self):
+        for size in (1, 50):
+            order = self.create_order(self.user, size)
+            # order, products, product categories, lines
+            with self.assertNumQueries(4):
+                response = self.client.get(f'/api/orders/{order.id}/')
+            self.assertEqual(len(response.data['products']), size)
+            self.assertEqual(len(response.data['lines']), size)
+
+    def test_legacy_orders_get_lines(self):
+        backfill_order_lines = import_module('core.migrations.0008_order_lines').backfill_order_lines
+        cheap = Product.objects.create(title='Cheap', price=Decimal('1.00'))
+        dear = Product.objects.create(title='Dear', price=Decimal('2.00'))
+        order = Order.objects.create(user=self.user, price=Decimal('10.00'), quantity=5)
+        order.products.set([cheap, dear])
+        lined = self.create_order(self.user, 1)
+        backfill_order_lines(apps, None)
+        self.assertEqual(list(order.lines.order_by('id').values_list('product_id', 'quantity', 'price')),
+                         [(cheap.id, 3, Decimal('4.29')), (dear.id, 2, Decimal('5.71'))])
+        self.assertEqual(lined.lines.count(), 1)
+
+
+class BundleTests(TestCase):
+    """GET /users/me/bundle/ answers the client's startup calls within a fixed query budget."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email='buyer@example.com', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        category = Category.objects.create(name='Category')
+        cart = Cart.objects.create(user=self.user, status='active')
+        for _ in range(10):
+            product = Product.objects.create(title='Product', price=Decimal('9.99'))
+            product.categories.set([category])
+            CartItem.objects.create(cart=cart, product=product, quantity=1, price=product.price)
+            Order.objects.create(user=self.user, price=product.price, quantity=1)
+
+    def test_query_budget(self):
+        # addresses, recent orders, and the active cart with its items and their categories
+        with self.assertNumQueries(5):
+            response = self.client.get('/api/users/me/bundle/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.data), {'profile', 'addresses', 'cart', 'orders'})
+        self.assertEqual(len(response.data['cart']['items']), 10)
+        self.assertEqual(len(response.data['orders']), 5)
+
+    def test_include(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/users/me/bundle/?include=profile,orders')
+        self.assertEqual(set(response.data), {'profile', 'orders'})
+        self.assertEqual(self.client.get('/api/users/me/bundle/?include=wishlist').status_code, 400)
+
+
+class CachedAuthenticationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email='buyer@example.com', password='password')
+
+    def client_for(self, user):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {TokenClaimsSerializer.get_token(user).access_token}')
+        return client
+
+    def test_cached_user_leaves_out_the_password(self):
+        token = TokenClaimsSerializer.get_token(self.user).access_token
+        CachedJWTCookieAuthentication().get_user(AccessToken(str(token)))
+        self.assertNotIn(self.user.password, cache.get(USER_KEY.format(self.user.pk, 0)))
+        self.assertIn('password', get_cached_user(self.user.pk, 0).get_deferred_fields())
+        with self.assertNumQueries(0):
+            user = CachedJWTCookieAuthentication().get_user(AccessToken(str(token)))
+            user = CachedJWTCookieAuthentication().get_user(token)
+        self.assertEqual((user.email, user.is_active, user.token_version), ('buyer@example.com', True, 0))
+
+    def test_password_change_revokes_tokens(self):
+        client = self.client_for(self.user)
+        self.assertEqual(client.get('/api/users/me/').status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.set_password('changed')
+            self.user.save()
+        self.assertEqual(client.get('/api/users/me/').status_code, 401)
+        self.user.refresh_from_db()
+        self.assertEqual(self.client_for(self.user).get('/api/users/me/').status_code, 200)
+
+    def test_profile_edit_keeps_tokens(self):
+        client = self.client_for(self.user)
+        self.assertEqual(client.get('/api/users/me/').status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.first_name = 'Renamed'
+            self.user.save()
+        response = client.get('/api/users/me/')
+        self.assertEqual((response.status_code, response.data['first_name']), (200, 'Renamed'))
+
+    def test_deactivation_revokes_cached_user(self):
+        client = self.client_for(self.user)
+        self.assertEqual(client.get('/api/users/me/').status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            user = get_cached_user(self.user.pk, 0)
+            user.is_active = False
+            # saving the cached instance writes only what it loaded, and still bumps the version
+            user.save()
+        self.assertEqual(client.get('/api/users/me/').status_code, 401)
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.is_active, self.user.token_version, self.user.check_password('password')),
+                         (False, 1, True))
+
+    def test_login_keeps_cached_user(self):
+        token = TokenClaimsSerializer.get_token(self.user).access_token
+        CachedJWTCookieAuthentication().get_user(token)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.last_login = timezone.now()
+            self.user.save(update_fields=['last_login'])
+        self.assertIsNotNone(cache.get(USER_KEY.format(self.user.pk, 0)))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.first_name = 'Renamed'
+            self.user.save(update_fields=['first_name'])
+        self.assertIsNone(cache.get(USER_KEY.format(self.user.pk, 0)))
+
+
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email='buyer@example.com', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.product = Product.objects.create(title='Product', price=Decimal('9.99'))
+
+    def test_bump_version(self):
+        before = get_versions(['product'])['product']
+        bump_version('product')
+        self.assertEqual(get_versions(['product'])['product'], before + 1)
+        cache.delete('response-version:product')
+        # a lost version is reseeded from the clock, never back at an old value
+        bump_version('product')
+        self.assertGreater(get_versions(['product'])['product'], before + 1)
+
+    def test_served_from_cache_with_etag(self):
+        response = self.client.get(f'/api/products/{self.product.id}/')
+        etag = response['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(f'/api/products/{self.product.id}/')
+        self.assertEqual((response.status_code, response['ETag']), (200, etag))
+        response = self.client.get(f'/api/products/{self.product.id}/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response['ETag']), (304, etag))
+
+    def test_save_invalidates(self):
+        etag = self.client.get(f'/api/products/{self.product.id}/')['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.title = 'Renamed'
+            self.product.save()
+        response = self.client.get(f'/api/products/{self.product.id}/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['title'], 'Renamed')
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_misses_read_the_primary_only_after_a_bump(self):
+        url = f'/api/products/{self.product.id}/'
+        with mock.patch('core.response_cache.primary_reads', wraps=primary_reads) as pinned:
+            # versions seen for the first time may have just changed
+            self.client.get(url)
+            self.assertEqual(pinned.call_count, 1)
+            # past the replica lag bound a miss goes through the router as usual
+            cache.delete_many([BUMPED_KEY.format('product'), BUMPED_KEY.format('category')])
+            self.client.get('/api/products/')
+            self.assertEqual(pinned.call_count, 1)
+            with self.captureOnCommitCallbacks(execute=True):
+                self.product.save()
+            self.client.get(url)
+            self.assertEqual(pinned.call_count, 2)
+
+class AsyncViewTests(TestCase):
+    """The /api/async/ read paths answer like their DRF twins without leaving the event loop."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email='buyer@example.com', password='password')
+        self.headers = {'Authorization': f'Bearer {TokenClaimsSerializer.get_token(self.user).access_token}'}
+        self.category = Category.objects.create(name='Category')
+        self.products = [Product.objects.create(title=f'Product {i}', price=Decimal('9.99')) for i in range(3)]
+        for product in self.products:
+            product.categories.add(self.category)
+        self.client = AsyncClient()
+
+    @override_settings(DEBUG=True)
+    def test_middleware_chain_stays_async(self):
+        # Django logs every middleware it has to run through sync_to_async
+        with self.assertNoLogs('django.request', 'DEBUG'):
+            ASGIHandler()
+
+    async def test_requires_authentication(self):
+        response = await self.client.get('/api/async/products/')
+        self.assertEqual(response.status_code, 401)
+        self.assertIn('WWW-Authenticate', response)
+        response = await self.client.get('/api/async/products/', headers={'Authorization': 'Bearer garbage'})
+        self.assertEqual(response.status_code, 401)
+        response = await self.client.post('/api/async/products/', headers=self.headers)
+        self.assertEqual(response.status_code, 405)
+
+    async def test_catalog(self):
+        response = await self.client.get('/api/async/products/', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(sorted(product['id'] for product in body['results']),
+                         [product.id for product in self.products])
+        self.assertEqual(body['results'][0]['categories'][0]['name'], 'Category')
+        self.assertIn('facets', body)
+
+        response = await self.client.get(f'/api/async/products/{self.products[0].id}/', headers=self.headers)
+        self.assertEqual(response.json()['title'], 'Product 0')
+        response = await self.client.get('/api/async/products/0/', headers=self.headers)
+        self.assertEqual(response.status_code, 404)
+
+        response = await self.client.get('/api/async/categories/', headers=self.headers)
+        self.assertEqual(response.json(), [{'id': self.category.id, 'name': 'Category'}])
+        response = await self.client.get(f'/api/async/categories/{self.category.id}/', headers=self.headers)
+        self.assertEqual(response.json()['name'], 'Category')
+
+    async def test_etag(self):
+        etag = (await self.client.get('/api/async/categories/', headers=self.headers))['ETag']
+        response = await self.client.get('/api/async/categories/', headers={**self.headers, 'If-None-Match': etag})
+        self.assertEqual((response.status_code, response['ETag']), (304, etag))
+
+    async def test_active_cart(self):
+        response = await self.client.get('/api/async/cart/active-cart/', headers=self.headers)
+        self.assertEqual((response.status_code, response.json()['items']), (200, []))
+        cart = await Cart.objects.aget(user=self.user, status='active')
+        self.assertEqual(response.json()['id'], cart.id)
+
+class ReplicaRouterTests(SimpleTestCase):
+    """Catalog reads are spread over the replicas, a user who just wrote reads from the primary."""
+
+    def setUp(self):
+        cache.clear()
+        self.router = ReplicaRouter({'replica1': 2, 'replica2': 1})
+        self.factory = RequestFactory()
+
+    def serve(self, method, user, view):
+        request = getattr(self.factory, method)('/api/products/')
+        request.user = user
+        return ReadYourWritesMiddleware(view)(request)
+
+    def read(self, model=Product, method='get', user=None):
+        return self.serve(method, user or AnonymousUser(), lambda request: self.router.db_for_read(model))
+
+    def test_weighted_round_robin(self):
+        self.assertEqual([self.read() for _ in range(6)],
+                         ['replica1', 'replica2', 'replica1', 'replica1', 'replica2', 'replica1'])
+
+    def test_primary_reads(self):
+        self.assertEqual(self.read(model=Cart), 'default')
+        self.assertEqual(self.read(method='post'), 'default')
+        # no request: management commands and workers
+        self.assertEqual(self.router.db_for_read(Product), 'default')
+
+    def test_cacheable_responses_are_built_from_the_primary(self):
+        def view(request):
+            with primary_reads():
+                return self.router.db_for_read(Product)
+        self.assertEqual(self.serve('get', AnonymousUser(), view), 'default')
+
+    def test_read_your_writes(self):
+        writer, other = User(pk=1), User(pk=2)
+        self.assertNotEqual(self.read(user=writer), 'default')
+        self.serve('post', writer, lambda request: self.router.db_for_write(CartItem))
+        self.assertEqual(self.read(user=writer), 'default')
+        self.assertNotEqual(self.read(user=other), 'default')
+
+
+class TieredCacheTests(SimpleTestCase):
+    """Hot keys are answered by the process, invalidations reach the other processes."""
+
+    def setUp(self):
+        cache.clear()
+        options = {'L1_PREFIXES': ['hot:'], 'L1_MAX_ENTRIES': 2, 'L1_TIMEOUT': 60, 'L1_CHECK_INTERVAL': 0}
+        self.worker = TieredCache('shared', {'OPTIONS': options})
+        self.worker._store = LocalStore(2)
+        # a second process sharing the same L2
+        self.other = TieredCache('shared', {'OPTIONS': options})
+        self.other._store = LocalStore(2)
+
+    def test_local_hits_and_evictions(self):
+        self.worker.set('hot:a', {'value': 1})
+        self.worker.get('hot:a')['value'] = 2
+        self.assertEqual(self.worker.get('hot:a'), {'value': 1})
+        self.worker.set('hot:b', 1)
+        self.worker.set('hot:c', 1)
+        self.worker.set('cold:d', 1)
+        self.assertEqual(self.worker.stats()['hits'], 2)
+        self.assertEqual(self.worker.stats()['evictions'], 1)
+        self.assertEqual(self.worker.stats()['entries'], 2)
+        # evicted locally, still in the shared cache
+        self.assertEqual(self.worker.get('hot:a'), {'value': 1})
+
+    def test_invalidation_reaches_other_processes(self):
+        self.worker.set('hot:a', 1)
+        self.assertEqual(self.other.get('hot:a'), 1)
+        self.worker.delete('hot:a')
+        self.assertIsNone(self.other.get('hot:a'))
+        self.worker.set('hot:n', 1)
+        self.assertEqual(self.other.get('hot:n'), 1)
+        self.worker.incr('hot:n')
+        self.assertEqual(self.other.get('hot:n'), 2)
+        self.worker.set('hot:n', 3)
+        self.assertEqual(self.other.get('hot:n'), 3)
+        self.assertEqual(self.other.stats()['invalidations'], 3)
+
+    def test_invalidation_is_per_prefix(self):
+        options = {'L1_PREFIXES': ['hot:', 'counter:'], 'L1_MAX_ENTRIES': 10, 'L1_TIMEOUT': 60,
+                   'L1_CHECK_INTERVAL': 0}
+        worker, other = TieredCache('shared', {'OPTIONS': options}), TieredCache('shared', {'OPTIONS': options})
+        worker._store, other._store = LocalStore(10), LocalStore(10)
+        worker.add('hot:a', 1)
+        worker.set('counter:a', 1)
+        self.assertEqual((other.get('hot:a'), other.get('counter:a')), (1, 1))
+        worker.incr('counter:a')
+        # added, not overwritten: the other process keeps its copy
+        worker.add('hot:b', 1)
+        hits = other.stats()['hits']
+        self.assertEqual((other.get('hot:a'), other.get('counter:a')), (1, 2))
+        self.assertEqual(other.stats()['hits'], hits + 1)
+
+
+class QueryInstrumentationTests(TestCase):
+    """Sampled requests report their queries in Server-Timing and slow ones are logged."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email='buyer@example.com', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        cart = Cart.objects.create(user=self.user, status='active')
+        for _ in range(3):
+            product = Product.objects.create(title='Product', price=Decimal('9.99'))
+            CartItem.objects.create(cart=cart, product=product, quantity=1, price=product.price)
+
+    @mock.patch('core.instrumentation.SQL_SAMPLE_RATE', 1)
+    def test_server_timing(self):
+        self.assertFalse(self.client.get('/api/cart/active-cart/').has_header('Server-Timing'))
+        User.objects.filter(pk=self.user.pk).update(is_staff=True)
+        self.user.is_staff = True
+        cache.clear()
+        response = self.client.get('/api/cart/active-cart/')
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="3 queries", app;dur=[\d.]+$')
+
+    @mock.patch('core.instrumentation.SQL_SAMPLE_RATE', 1)
+    @mock.patch('core.instrumentation.SLOW_REQUEST_QUERIES', 2)
+    def test_slow_request_log(self):
+        with self.assertLogs('core.instrumentation', 'WARNING') as logs:
+            self.client.get('/api/cart/active-cart/')
+        self.assertIn('GET /api/cart/active-cart/: 200', logs.output[0])
+        self.assertIn('3 queries', logs.output[0])
+
+    @mock.patch('core.instrumentation.SQL_SAMPLE_RATE', 1)
+    async def test_async_request(self):
+        await User.objects.filter(pk=self.user.pk).aupdate(is_staff=True)
+        self.user.is_staff = True
+        token = TokenClaimsSerializer.get_token(self.user).access_token
+        response = await AsyncClient().get('/api/async/cart/active-cart/', headers={'Authorization': f'Bearer {token}'})
+        self.assertEqual(len(response.json()['items']), 3)
+        # the user, then the cart, its items and their categories through the async ORM
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="4 queries", app;dur=[\d.]+$')
+
+    @mock.patch('core.instrumentation.SQL_SAMPLE_RATE', 0)
+    def test_unsampled(self):
+        self.assertFalse(self.client.get('/api/cart/active-cart/').has_header('Server-Timing'))
+
+
+class MetricsTests(TestCase):
+    """Requests are observed under their viewset and action and exported in Prometheus format."""
+
+    def test_metrics(self):
+        user = User.objects.create_user(email='buyer@example.com', password='password')
+        client = APIClient()
+        client.force_authenticate(user)
+        client.post('/api/cart/checkout/')
+        response = client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('http_request_duration_seconds_count{method="POST",status="404",view="cart.checkout"}', body)
+        self.assertIn('checkouts_total{mode="sync",result="no_cart"}', body)
+
+    async def test_async_request(self):
+        user = await User.objects.acreate(email='buyer@example.com')
+        token = TokenClaimsSerializer.get_token(user).access_token
+        await AsyncClient().get('/api/async/categories/', headers={'Authorization': f'Bearer {token}'})
+        body = (await AsyncClient().get('/metrics')).content.decode()
+        self.assertIn('http_request_duration_seconds_count{method="GET",status="200",view="async-category-list"}', body)
+
+    def test_access(self):
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.5').status_code, 200)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='93.184.216.34').status_code, 403)
+        # relayed by the proxy: REMOTE_ADDR is the proxy's private address
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.5',
+                                         HTTP_X_FORWARDED_FOR='93.184.216.34').status_code, 403)
+        with self.settings(DEBUG=True):
+            self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='93.184.216.34').status_code, 200)
+        with mock.patch('core.metrics.METRICS_TOKEN', 'secret'):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+            self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='93.184.216.34',
+                                             HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+
+class TokenBucketTests(SimpleTestCase):
+    """Buckets keep their credit until they are full again and cannot be reset by spoofing the client IP."""
+
+    def setUp(self):
+        cache.clear()
+        self.now = 1_000_000.0
+        patcher = mock.patch('time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def allowed(self, requests, interval=500, burst=10):
+        # the cache expires keys on the same fake clock
+        return sum(not take('throttle:test', interval, burst) for _ in range(requests))
+
+    def test_credit_survives_the_initial_key_ttl(self):
+        # 120/min with a burst of 10, a request every 0.25s (240/min)
+        allowed = 0
+        for _ in range(240):
+            allowed += self.allowed(1)
+            self.now += 0.25
+        # the burst plus a minute of refill
+        self.assertLessEqual(allowed, 10 + 120 + 1)
+
+    def test_idle_bucket_refills(self):
+        self.assertEqual(self.allowed(20), 10)
+        self.now += 5
+        self.assertEqual(self.allowed(20), 10)
+
+    def test_forwarded_for_is_not_trusted_blindly(self):
+        throttle = TokenBucketThrottle()
+        factory = RequestFactory()
+        ips = set()
+        for spoofed in ('1.1.1.1', '2.2.2.2'):
+            request = factory.post('/', HTTP_X_FORWARDED_FOR=f'{spoofed}, 10.0.0.7', REMOTE_ADDR='10.0.0.1')
+            ips.add(throttle.get_ident(request))
+        self.assertEqual(ips, {'10.0.0.7'})
+
+
+class ArchiveTests(TestCase):
+    """Old orders and closed carts move to the archive tables and archived orders stay retrievable."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(email='buyer@example.com', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.product = Product.objects.create(title='Product', price=Decimal('9.99'))
+        self.old = timezone.now() - timedelta(days=400)
+
+    def create_order(self, user, created_at):
+        order = Order.objects.create(user=user, price=self.product.price, quantity=1)
+        order.products.add(self.product)
+        OrderLine.objects.create(order=order, product=self.product, quantity=1, price=self.product.price)
+        Order.objects.filter(pk=order.pk).update(created_at=created_at)
+        return order
+
+    def test_archive_orders(self):
+        old = self.create_order(self.user, self.old)
+        recent = self.create_order(self.user, timezone.now())
+        before = self.client.get(f'/api/orders/{old.id}/').json()
+        # not counted in the sales rollups yet
+        self.assertEqual(archive.archive_orders(timezone.now() - timedelta(days=365)), 0)
+        roll_up_sales(lag=0)
+        self.assertEqual(archive.archive_orders(timezone.now() - timedelta(days=365)), 1)
+        self.assertEqual(list(Order.objects.values_list('id', flat=True)), [recent.id])
+        self.assertTrue(ArchivedOrder.objects.filter(pk=old.id).exists())
+        # answered from the archive exactly as it was before
+        response = self.client.get(f'/api/orders/{old.id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), before)
+
+    def test_archived_retrieve_is_scoped_and_validated(self):
+        other = User.objects.create_user(email='other@example.com', password='password')
+        foreign = self.create_order(other, self.old)
+        roll_up_sales(lag=0)
+        archive.archive_orders(timezone.now() - timedelta(days=365))
+        self.assertEqual(self.client.get(f'/api/orders/{foreign.id}/').status_code, 404)
+        self.assertEqual(self.client.get('/api/orders/abc/').status_code, 404)
+
+    def test_archive_carts_skips_open_carts(self):
+        closed = Cart.objects.create(user=self.user, status='abandoned')
+        CartItem.objects.create(cart=closed, product=self.product, quantity=2, price=Decimal('19.98'))
+        active = Cart.objects.create(user=self.user, status='active')
+        Cart.objects.update(updated_at=self.old)
+        self.assertEqual(archive.archive_carts(timezone.now() - timedelta(days=90)), 1)
+        self.assertEqual(list(Cart.objects.values_list('id', flat=True)), [active.id])
+        self.assertEqual(ArchivedCart.objects.get(pk=closed.id).items[0]['quantity'], 2)
+
+
+class SalesRollupTests(TestCase):
+    """A rebuild recounts the archived orders along with the hot ones."""
+
+    def test_rebuild_keeps_archived_history(self):
+        user = User.objects.create_user(email='buyer@example.com', password='password')
+        category = Category.objects.create(name='Category')
+        product = Product.objects.create(title='Product', price=Decimal('9.99'))
+        product.categories.set([category])
+        old = timezone.now() - timedelta(days=400)
+        for created_at in (old, old, timezone.now() - timedelta(hours=1)):
+            order = Order.objects.create(user=user, price=Decimal('19.98'), quantity=2)
+            order.products.add(product)
+            OrderLine.objects.create(order=order, product=product, quantity=2, price=Decimal('19.98'))
+            Order.objects.filter(pk=order.pk).update(created_at=created_at)
+        self.assertEqual(roll_up_sales(lag=0), 3)
+        self.assertEqual(archive.archive_orders(timezone.now() - timedelta(days=365)), 2)
+        before = list(SalesRollup.objects.order_by('dimension', 'day', 'key').values_list(
+            'dimension', 'day', 'key', 'orders', 'units', 'revenue'))
+        self.assertEqual(rebuild_sales_rollups(), 3)
+        after = list(SalesRollup.objects.order_by('dimension', 'day', 'key').values_list(
+            'dimension', 'day', 'key', 'orders', 'units', 'revenue'))
+        self.assertEqual(after, before)
+        self.assertEqual(SalesRollup.objects.get(dimension='category', day=timezone.localdate(old)).orders, 2)
+
+
+class CheckoutQueueTests(TestCase):
+    """Workers claim jobs once, a stale claim is taken over and the stale worker cannot undo the outcome."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email='buyer@example.com', password='password')
+        self.product = Product.objects.create(title='Product', price=Decimal('9.99'))
+        inventory.set_stock(self.product.id, 5, shards=2)
+        self.cart = Cart.objects.create(user=self.user, status='active')
+        cart_service.add_item(self.cart, self.product.id, 2)
+        self.job, _ = checkout_queue.enqueue(self.user, 'key')
+
+    def stock(self):
+        return inventory.available([self.product.id])[self.product.id]
+
+    def test_claim_and_process(self):
+        [job] = checkout_queue.claim_jobs('first', 10)
+        self.assertEqual(checkout_queue.claim_jobs('second', 10), [])
+        self.assertTrue(checkout_queue.process_job(job))
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'succeeded')
+        self.assertEqual(job.order.quantity, 2)
+        self.assertEqual(self.stock(), 3)
+
+    def test_stale_claim_is_taken_over(self):
+        [stale] = checkout_queue.claim_jobs('first', 10)
+        CheckoutJob.objects.update(updated_at=timezone.now() - timedelta(minutes=10))
+        [job] = checkout_queue.claim_jobs('second', 10)
+        self.assertFalse(checkout_queue.process_job(stale))
+        self.assertTrue(checkout_queue.process_job(job))
+        # the first worker failing late changes neither the job nor the committed stock
+        checkout_queue._fail(stale, 'Cart is no longer waiting for checkout', 'no_cart')
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'succeeded')
+        self.assertEqual(self.stock(), 3)
+
+    def test_failure_gives_the_cart_and_stock_back(self):
+        CartItem.objects.filter(cart=self.cart).delete()
+        [job] = checkout_queue.claim_jobs('first', 10)
+        self.assertFalse(checkout_queue.process_job(job))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error), ('failed', 'Cart is empty'))
+        self.assertEqual(Cart.objects.get(pk=self.cart.pk).status, 'active')
+        self.assertEqual(self.stock(), 5)
+
+    def test_enqueue_leaves_the_holds_of_another_job(self):
+        with self.assertRaises(checkout_service.NoActiveCart):
+            checkout_queue.enqueue(self.user, 'other key')
+        self.assertEqual(StockReservation.objects.filter(cart=self.cart, status='held').count(),
+                         StockReservation.objects.filter(cart=self.cart).count())
+        self.assertEqual(self.stock(), 3)
+        self.assertEqual(checkout_queue.enqueue(self.user, 'key'), (self.job, False))
+
+    def test_enqueue_out_of_stock_keeps_the_cart(self):
+        cart = Cart.objects.create(user=self.user, status='active')
+        cart_service.add_item(cart, self.product.id, 4)
+        with self.assertRaises(inventory.OutOfStock):
+            checkout_queue.enqueue(self.user, 'other key')
+        self.assertEqual(Cart.objects.get(pk=cart.pk).status, 'active')
+        self.assertFalse(CheckoutJob.objects.filter(idempotency_key='other key').exists())
+        self.assertEqual(self.stock(), 3)
+
+    def test_busy_stock_is_retried(self):
+        [job] = checkout_queue.claim_jobs('first', 10)
+        with mock.patch('core.services.inventory.commit_cart', side_effect=inventory.InventoryBusy):
+            self.assertFalse(checkout_queue.process_job(job))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.claimed_by, job.attempts), ('pending', None, 1))
+        # the cart is still frozen with its stock held
+        self.assertEqual(Cart.objects.get(pk=self.cart.pk).status, 'checkout')
+        self.assertEqual(self.stock(), 3)
+        [job] = checkout_queue.claim_jobs('second', 10)
+        self.assertTrue(checkout_queue.process_job(job))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('succeeded', 2))
+        self.assertEqual(self.stock(), 3)
+
+
+class InventoryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='buyer@example.com', password='password')
+        self.product = Product.objects.create(title='Product', price=Decimal('9.99'))
+        self.cart = Cart.objects.create(user=self.user, status='active')
+        inventory.set_stock(self.product.id, 7, shards=3)
+
+    def stock(self):
+        return inventory.available([self.product.id])[self.product.id]
+
+    def test_set_stock_spreads_over_shards(self):
+        self.assertEqual(sorted(StockCounter.objects.filter(product=self.product).values_list('shard', 'quantity')),
+                         [(0, 3), (1, 2), (2, 2)])
+        self.assertEqual(self.stock(), 7)
+
+    def test_reserve_takes_from_several_shards(self):
+        reservations = inventory.reserve(self.cart.id, {self.product.id: 6})
+        self.assertEqual(sum(reservation.quantity for reservation in reservations), 6)
+        self.assertGreater(len(reservations), 1)
+        self.assertEqual(self.stock(), 1)
+
+    def test_out_of_stock_keeps_nothing(self):
+        with self.assertRaises(inventory.OutOfStock) as raised:
+            inventory.reserve(self.cart.id, {self.product.id: 8})
+        self.assertEqual(raised.exception.product_ids, [self.product.id])
+        self.assertEqual(self.stock(), 7)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_release_expired(self):
+        inventory.reserve(self.cart.id, {self.product.id: 4})
+        self.assertEqual(inventory.release_expired(), 0)
+        StockReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertGreater(inventory.release_expired(batch_size=1), 0)
+        self.assertEqual(self.stock(), 7)
+        self.assertFalse(StockReservation.objects.filter(status='held').exists())
+
+    def test_commit_takes_the_stock_again_after_expiry(self):
+        inventory.reserve(self.cart.id, {self.product.id: 2})
+        StockReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        inventory.release_expired()
+        order = Order.objects.create(user=self.user, price=Decimal('19.98'), quantity=2)
+        inventory.commit_cart(self.cart.id, order, {self.product.id: 2})
+        self.assertEqual(self.stock(), 5)
+        self.assertEqual(sum(StockReservation.objects.filter(status='committed', order=order)
+                             .values_list('quantity', flat=True)), 2)
+
+    def test_busy_commit_leaves_the_checkout_transaction_usable(self):
+        order = Order.objects.create(user=self.user, price=Decimal('19.98'), quantity=2)
+        with transaction.atomic():
+            with mock.patch.object(inventory, '_reserve', side_effect=OperationalError('lock timeout')), \
+                    self.assertRaises(inventory.InventoryBusy):
+                inventory.commit_cart(self.cart.id, order, {self.product.id: 2})
+            self.assertEqual(self.stock(), 7)
+
+    def test_stale_snapshot_is_taken_again_under_lock(self):
+        counters = inventory._counters
+
+        def drained_after_snapshot(product_ids, lock=False):
+            rows = counters(product_ids, lock=lock)
+            if not lock:
+                StockCounter.objects.filter(product=self.product, shard=0).update(quantity=0)
+            return rows
+
+        with mock.patch.object(inventory, '_counters', side_effect=drained_after_snapshot):
+            reservations = inventory.reserve(self.cart.id, {self.product.id: 4})
+        self.assertEqual(sorted((reservation.shard, reservation.quantity) for reservation in reservations),
+                         [(1, 2), (2, 2)])
+        self.assertEqual(self.stock(), 0)
+
+    def test_release_returns_to_rebuilt_shards(self):
+        inventory.reserve(self.cart.id, {self.product.id: 7})
+        inventory.set_stock(self.product.id, 0, shards=1)
+        self.assertEqual(inventory.release_cart(self.cart.id), 3)
+        self.assertEqual(self.stock(), 7)
+
+    def cart_with(self, products):
+        user = User.objects.create_user(email=f'buyer-{products}@example.com', password='password')
+        cart = Cart.objects.create(user=user, status='active')
+        for _ in range(products):
+            product = Product.objects.create(title='Product', price=Decimal('9.99'))
+            inventory.set_stock(product.id, 5, shards=3)
+            cart_service.add_item(cart, product.id, 4)
+        return user
+
+    def test_checkout_query_count_does_not_grow_with_the_cart(self):
+        for products in (1, 20):
+            user = self.cart_with(products)
+            # the same however many products the cart holds
+            with self.assertNumQueries(22):
+                order = checkout_service.checkout(user)
+            self.assertEqual(order.quantity, 4 * products)
+            self.assertEqual(sum(StockReservation.objects.filter(order=order, status='committed')
+                                 .values_list('quantity', flat=True)), 4 * products)
+
+class CartStoreTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email='buyer@example.com', password='password')
+        self.product = Product.objects.create(title='Product', price=Decimal('9.99'))
+
+    def test_stale_cached_cart_is_not_written_to(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            cart_store.add_item(self.user, self.product.id, 1)
+        ordered = Cart.objects.get(user=self.user)
+        # checked out elsewhere, this process still has the id cached
+        Cart.objects.filter(pk=ordered.pk).update(status='ordered')
+        with self.captureOnCommitCallbacks(execute=True):
+            cart_store.add_item(self.user, self.product.id, 2)
+        self.assertEqual(list(ordered.items.values_list('quantity', flat=True)), [1])
+        active = Cart.objects.get(user=self.user, status='active')
+        self.assertEqual(list(active.items.values_list('quantity', flat=True)), [2])
+        self.assertEqual(cart_store.get_active_cart(self.user)['id'], active.pk)
+
+        stale = cart_store.find_active_cart(self.user)
+        Cart.objects.filter(pk=active.pk).update(status='ordered')
+        with self.assertRaises(CartItem.DoesNotExist):
+            cart_store.remove_item(self.user, stale, self.product.id)
+        self.assertEqual(active.items.count(), 1)
+
+    def test_add_item_query_count(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            cart_store.add_item(self.user, self.product.id, 1)
+        # savepoint, product price, upsert of the line, totals of the active cart, release
+        with self.assertNumQueries(5), self.captureOnCommitCallbacks(execute=True):
+            cart_store.add_item(self.user, self.product.id, 1)
+        # and the cart lookup with nothing cached
+        cache.clear()
+        with self.assertNumQueries(6), self.captureOnCommitCallbacks(execute=True):
+            item = cart_store.add_item(self.user, self.product.id, 1)
+        self.assertEqual(item.quantity, 3)
+        self.assertEqual(cart_store.get_active_cart(self.user)['items'][0]['quantity'], 3)
+
+    def test_outdated_refresh_is_not_served(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            cart_store.add_item(self.user, self.product.id, 1)
+        # a refresh that read the cart before the next change committed stores its data last
+        generation = cart_store._generation(self.user)
+        old = cart_store.get_active_cart(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            cart_store.add_item(self.user, self.product.id, 1)
+        cart_store._remember(self.user, old['id'], old, generation)
+        self.assertEqual(cart_store.get_active_cart(self.user)['items'][0]['quantity'], 2)
+
+
+class IdempotencyTests(TestCase):
+    """A retried request with the same Idempotency-Key gets the first response back without running again."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email='buyer@example.com', password='password')
+        self.product = Product.objects.create(title='Product', price=Decimal('9.99'))
+        inventory.set_stock(self.product.id, 5)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def add_item(self, key, quantity=1, product=None):
+        return self.client.post('/api/cart/add-item/', {'product': product or self.product.id, 'quantity': quantity},
+                                format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def checkout(self, key):
+        return self.client.post('/api/cart/checkout/', HTTP_IDEMPOTENCY_KEY=key)
+
+    def quantity(self):
+        return CartItem.objects.get(cart__user=self.user, cart__status='active').quantity
+
+    def test_add_item_is_replayed(self):
+        first = self.add_item('add')
+        second = self.add_item('add')
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertFalse(first.has_header('Idempotent-Replayed'))
+        self.assertEqual(self.quantity(), 1)
+        # another key is another request
+        self.add_item('other')
+        self.assertEqual(self.quantity(), 2)
+
+    def test_checkout_is_replayed(self):
+        self.add_item('add', quantity=2)
+        first = self.checkout('checkout')
+        self.assertEqual(first.status_code, 200)
+        second = self.checkout('checkout')
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(Order.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(inventory.available([self.product.id])[self.product.id], 3)
+
+    def test_key_reused_for_another_request(self):
+        self.add_item('add')
+        response = self.add_item('add', quantity=2)
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(self.quantity(), 1)
+        # the same key on another endpoint is another request too
+        self.assertEqual(self.checkout('add').status_code, 422)
+        self.assertFalse(Order.objects.filter(user=self.user).exists())
+
+    def test_waits_for_the_request_holding_the_key(self):
+        first = self.add_item('add')
+        record = IdempotencyRecord.objects.get(user=self.user, key='add')
+        # put the record back in flight, the original request stores its response while the retry waits
+        IdempotencyRecord.objects.filter(pk=record.pk).update(status_code=None, body=None)
+
+        def finish(delay):
+            IdempotencyRecord.objects.filter(pk=record.pk).update(status_code=record.status_code, body=record.body)
+
+        with mock.patch('core.idempotency.time.sleep', side_effect=finish) as sleep:
+            second = self.add_item('add')
+        sleep.assert_called_once()
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.quantity(), 1)
+
+    def test_gives_up_waiting(self):
+        self.add_item('add', quantity=2)
+        self.checkout('checkout')
+        IdempotencyRecord.objects.filter(user=self.user, key='checkout').update(status_code=None, body=None)
+        with mock.patch('core.idempotency.IDEMPOTENCY_WAIT_TIMEOUT', 0):
+            response = self.checkout('checkout')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(Order.objects.filter(user=self.user).count(), 1)
+
+    def test_client_errors_are_stored(self):
+        # a 4xx is the outcome of the request and is replayed as well, only 5xx responses free the key
+        response = self.checkout('checkout')
+        self.assertEqual(response.status_code, 404)
+        self.add_item('other')
+        response = self.checkout('checkout')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response['Idempotent-Replayed'], 'true')
+        self.assertFalse(Order.objects.filter(user=self.user).exists())
+
+        response = self.add_item('add', product=self.product.id + 1)
+        self.assertEqual(response.status_code, 404)
+        Product.objects.create(id=self.product.id + 1, title='Product', price=Decimal('9.99'))
+        response = self.add_item('add', product=self.product.id + 1)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.quantity(), 1)
+
+
+class FacetFilterTests(SimpleTestCase):
+    def test_prices_are_parsed(self):
+        self.assertEqual(parse_filters(QueryDict('category=3,1&min_price=10&max_price=')),
+                         ([1, 3], Decimal('10'), None))
+
+    def test_non_finite_prices_are_rejected(self):
+        for value in ('NaN', 'sNaN', 'Infinity', '-inf', 'abc'):
+            with self.subTest(value=value), self.assertRaises(ValidationError):
+                parse_filters(QueryDict(f'min_price={value}'))
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.products = [Product.objects.create(title=f'Product {i}', price=Decimal('9.99')) for i in range(7)]
+        # the middle ones share a timestamp, so page boundaries fall inside the tie
+        tied = timezone.now()
+        Product.objects.filter(pk__in=[product.pk for product in self.products[1:6]]).update(created_at=tied)
+        Product.objects.filter(pk=self.products[0].pk).update(created_at=tied - timedelta(seconds=1))
+        Product.objects.filter(pk=self.products[6].pk).update(created_at=tied + timedelta(seconds=1))
+        self.newest_first = [product.pk for product in reversed(self.products)]
+
+    def page(self, url):
+        paginator = KeysetPagination()
+        results = paginator.paginate_queryset(Product.objects.all(), Request(self.factory.get(url)))
+        return [product.pk for product in results], paginator.get_next_link(), paginator.get_previous_link()
+
+    def test_ties_are_broken_by_id(self):
+        pages, url = [], '/api/products/?page_size=2'
+        while url:
+            ids, url, previous = self.page(url)
+            pages.append(ids)
+        self.assertEqual(pages, [self.newest_first[i:i + 2] for i in range(0, 7, 2)])
+
+        # and back again from the last page
+        back, url = [], previous
+        while url:
+            ids, _, url = self.page(url)
+            back.append(ids)
+        self.assertEqual(back, pages[-2::-1])
+
+    def test_invalid_cursor(self):
+        def encoded(querystring):
+            return b64encode(querystring.encode()).decode()
+
+        created_at = timezone.now().isoformat()
+        for cursor in ('not base64', encoded('c=yesterday&i=1'), encoded(f'c={created_at}&i=one'),
+                       encoded(f'c={created_at}'), encoded(f'c={created_at}&i=1&r=x'), b64encode('é'.encode()).decode(),
+                       'é'):
+            with self.subTest(cursor=cursor), self.assertRaises(NotFound):
+                self.page(f'/api/products/?{urlencode({"cursor": cursor})}')
+
+    async def test_async_pagination(self):
+        paginator = KeysetPagination()
+        request = Request(self.factory.get('/api/products/?page_size=3'))
+        results = await paginator.apaginate_queryset(Product.objects.all(), request)
+        self.assertEqual([product.pk for product in results], self.newest_first[:3])
+
+        request = Request(self.factory.get(paginator.get_next_link()))
+        results = await paginator.apaginate_queryset(Product.objects.all(), request)
+        self.assertEqual([product.pk for product in results], self.newest_first[3:6])
+        self.assertIsNotNone(paginator.get_previous_link())
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.kettle = Product.objects.create(title='Copper kettle', summary='Boils water', price=Decimal('9.99'))
+        self.teapot = Product.objects.create(title='Teapot', description='Pairs well with a kettle',
+                                             price=Decimal('9.99'))
+
+    def found(self, query):
+        return [product.pk for product in search_products(query)]
+
+    def test_index_follows_writes(self):
+        # the title weighs more than the description
+        self.assertEqual(self.found('kettle'), [self.kettle.pk, self.teapot.pk])
+        mug = Product.objects.create(title='Mug', summary='For tea', price=Decimal('9.99'))
+        self.assertEqual(self.found('tea'), [mug.pk])
+
+        self.kettle.title = 'Copper pan'
+        self.kettle.save()
+        self.assertEqual(self.found('kettle'), [self.teapot.pk])
+        self.assertEqual(self.found('pan'), [self.kettle.pk])
+
+        self.teapot.delete()
+        self.assertEqual(self.found('kettle'), [])
+
+    @skipUnless(connection.vendor == 'sqlite', 'FTS5 triggers are SQLite only')
+    def test_missing_triggers_are_reinstalled(self):
+        with connection.cursor() as cursor:
+            # what a migration rebuilding core_product leaves behind
+            for trigger in SQLITE_FTS_TRIGGERS:
+                cursor.execute(f'DROP TRIGGER {trigger}')
+        mug = Product.objects.create(title='Mug', price=Decimal('9.99'))
+        self.assertEqual(self.found('mug'), [])
+
+        ensure_sqlite_index()
+        # the index is rebuilt with what was written meanwhile, and kept current again
+        self.assertEqual(self.found('mug'), [mug.pk])
+        cup = Product.objects.create(title='Cup', price=Decimal('9.99'))
+        self.assertEqual(self.found('cup'), [cup.pk])
+
+
+class CartServiceTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email='buyer@example.com', password='password')
+        self.products = [Product.objects.create(title=f'Product {i}', price=Decimal(f'{i + 1}.50')) for i in range(5)]
+        self.cart = Cart.objects.create(user=self.user, status='active')
+        for product, quantity in zip(self.products[:3], (2, 1, 3)):
+            cart_service.add_item(self.cart, product.id, quantity)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def lines(self):
+        return dict(self.cart.items.values_list('product_id', 'quantity'))
+
+    def test_batch(self):
+        first, second, third, fourth, fifth = (product.id for product in self.products)
+        response = self.client.post('/api/cart/batch/', {'operations': [
+            {'op': 'add', 'product': first, 'quantity': 1},
+            {'op': 'set', 'product': second, 'quantity': 5},
+            {'op': 'remove', 'product': third},
+            # not in the cart, nothing to remove
+            {'op': 'remove', 'product': fourth},
+            {'op': 'add', 'product': fifth, 'quantity': 2},
+            {'op': 'add', 'product': fifth, 'quantity': 1},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.lines(), {first: 3, second: 5, fifth: 3})
+        self.assertEqual(response.data['item_count'], 11)
+        self.assertEqual(Decimal(str(response.data['subtotal'])), Decimal('1.50') * 3 + Decimal('2.50') * 5
+                         + Decimal('5.50') * 3)
+        self.assertEqual(cart_service.reconcile_totals(), [])
+
+    def test_batch_with_unknown_product_changes_nothing(self):
+        response = self.client.post('/api/cart/batch/', {'operations': [
+            {'op': 'remove', 'product': self.products[0].id},
+            {'op': 'add', 'product': self.products[-1].id + 1, 'quantity': 1},
+        ]}, format='json')
+        self.assertEqual((response.status_code, response.data['products']), (404, [self.products[-1].id + 1]))
+        self.assertEqual(self.lines(), {self.products[0].id: 2, self.products[1].id: 1, self.products[2].id: 3})
+
+    def test_reconcile_totals(self):
+        other = Cart.objects.create(user=User.objects.create_user(email='other@example.com', password='password'),
+                                    status='active')
+        self.assertEqual(cart_service.reconcile_totals(), [])
+        # drift on a cart with items and on an empty one
+        Cart.objects.filter(pk=self.cart.pk).update(item_count=1, subtotal=Decimal('1.00'))
+        Cart.objects.filter(pk=other.pk).update(item_count=2)
+        expected = [(self.cart.pk, (1, Decimal('1.00')), (6, Decimal('16.00'))),
+                    (other.pk, (2, Decimal('0.00')), (0, Decimal('0.00')))]
+        self.assertEqual(cart_service.reconcile_totals(batch_size=1), expected)
+        # reporting alone leaves the totals as they are
+        self.assertEqual(cart_service.reconcile_totals(Cart.objects.filter(pk=self.cart.pk)), expected[:1])
+        self.assertEqual(cart_service.reconcile_totals(fix=True), expected)
+        self.assertEqual(cart_service.reconcile_totals(), [])
+        self.cart.refresh_from_db()
+        self.assertEqual((self.cart.item_count, self.cart.subtotal), (6, Decimal('16.00')))
+
+
+class ChecksTests(SimpleTestCase):
+    def check_ids(self, **kwargs):
+        return {message.id for message in run_checks(**kwargs)}
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_process_local_cache_is_a_deploy_warning(self):
+        self.assertNotIn('core.W103', self.check_ids())
+        self.assertIn('core.W103', self.check_ids(include_deployment_checks=True))
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache'}})
+    def test_redis_needs_its_package(self):
+        with mock.patch('core.checks.importlib.util.find_spec', return_value=None):
+            self.assertIn('core.E107', self.check_ids())
@@ -0,0 +1,111 @@
+"""
+Token-bucket throttling in the shared cache.
+
+Buckets are configured per route in `settings.TOKEN_BUCKETS`: the URL names
+they cover, a refill rate ("10/min") and a burst size. Each client (user id or
+IP, per bucket) gets its own bucket, kept as a single integer in the cache: the
+time in milliseconds at which the bucket will be full again (the GCRA form of
+a token bucket). Taking a token is one atomic `cache.incr` of that time by the
+refill interval. The bucket is full while that time is in the past, and it is
+empty once the time is more than `burst` intervals ahead. An idle bucket
+simply expires.
+
+The throttle runs in `APIView.initial`, before the view parses the body, so a
+rejected login or registration costs no query and no password hash. Safe
+methods and routes without a bucket are not throttled.
+"""
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.throttling import BaseThrottle
+
+BUCKET_KEY = 'throttle:{}:{}'
+
+PERIODS = {'s': 1, 'sec': 1, 'm': 60, 'min': 60, 'h': 3600, 'hour': 3600, 'd': 86400, 'day': 86400}
+
+
+def parse_rate(rate):
+    """'10/min' -> milliseconds between two tokens."""
+    count, period = rate.split('/')
+    return PERIODS[period] * 1000 / int(count)
+
+
+def _buckets():
+    routes = {}
+    for name, bucket in getattr(settings, 'TOKEN_BUCKETS', {}).items():
+        config = {
+            'name': name,
+            'interval': parse_rate(bucket['rate']),
+            'burst': bucket.get('burst', 1),
+            'key': bucket.get('key', 'user'),
+        }
+        for route in bucket['routes']:
+            routes[route] = config
+    return routes
+
+
+ROUTES = _buckets()
+
+
+def take(key, interval, burst, now=None):
+    """
+    Take a token from the bucket at `key`. Returns 0 when the request may go ahead,
+    otherwise the number of seconds until a token is available.
+    """
+    now = int(time.time() * 1000) if now is None else now
+    interval = int(math.ceil(interval))
+    capacity = interval * burst
+    # a full bucket needs no state, its key lives just as long as it takes to refill
+    if cache.add(key, now + interval, timeout=math.ceil(interval / 1000) + 1):
+        return 0
+    try:
+        full_at = cache.incr(key, interval)
+    except ValueError:
+        # expired between the add and the incr
+        cache.add(key, now + interval, timeout=math.ceil(interval / 1000) + 1)
+        return 0
+
+    if full_at - interval < now:
+        # the bucket had refilled already, the credit it built up while idle is capped at the burst
+        cache.set(key, now + interval, timeout=math.ceil(interval / 1000) + 1)
+        return 0
+    if full_at - now > capacity:
+        # give the token back so hammering an empty bucket does not push it further out
+        cache.decr(key, interval)
+        return (full_at - now - capacity) / 1000
+    # the key must outlive the credit it holds, otherwise it expires and the bucket starts over full
+    cache.touch(key, math.ceil((full_at - now) / 1000) + 1)
+    return 0
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """Throttle the routes listed in `settings.TOKEN_BUCKETS`, see the module docstring."""
+
+    def get_bucket(self, request):
+        if request.method in SAFE_METHODS:
+            return None
+        match = request._request.resolver_match
+        return ROUTES.get(match.url_name) if match else None
+
+    def get_client(self, request, bucket):
+        if bucket['key'] == 'user' and request.user and request.user.is_authenticated:
+            return f'user:{request.user.pk}'
+        return f'ip:{self.get_ident(request)}'
+
+    def allow_request(self, request, view):
+        self.wait_seconds = None
+        bucket = self.get_bucket(request)
+        if bucket is None:
+            return True
+        key = BUCKET_KEY.format(bucket['name'], self.get_client(request, bucket))
+        wait = take(key, bucket['interval'], bucket['burst'])
+        if wait:
+            self.wait_seconds = wait
+            return False
+        return True
+
+    def wait(self):
+        return self.wait_seconds
@@ -8,7 +8,7 @@ from rest_framework.routers import DefaultRouter
 from dj_rest_auth.views import (UserDetailsView,LoginView, LogoutView, PasswordChangeView, PasswordResetView,
                                 PasswordResetConfirmView)
 
-from core import views
+from core import async_views, views
 
 schema_view = get_schema_view(
    openapi.Info(
@@ -29,6 +29,7 @@ router.register(r'categories', views.CategoryViewSet, basename='category')
 router.register(r'cart', views.CartViewSet, basename='cart')
 router.register(r'orders', views.OrderViewSet, basename='order')
 router.register(r'users/me', views.AddressViewSet, basename='address')
+router.register(r'reports', views.ReportViewSet, basename='report')
 
 
 urlpatterns = [
@@ -51,6 +52,13 @@ urlpatterns = [
     # path('cart/', views.CreateCartView.as_view(), name='cart'),
     path('', include(router.urls)),
 
+    # async read path for ASGI deployments, see core.async_views
+    path('async/products/', async_views.product_list, name='async-product-list'),
+    path('async/products/<int:pk>/', async_views.product_detail, name='async-product-detail'),
+    path('async/categories/', async_views.category_list, name='async-category-list'),
+    path('async/categories/<int:pk>/', async_views.category_detail, name='async-category-detail'),
+    path('async/cart/active-cart/', async_views.active_cart, name='async-cart-active-cart'),
+
     path('swagger<format>/', schema_view.without_ui(cache_timeout=0), name='schema-json'),
     path('swagger/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
     path('redoc/', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
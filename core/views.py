@@ -1,18 +1,39 @@
-from django.contrib.auth import get_user_model
-from drf_yasg.openapi import Schema, TYPE_OBJECT
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db import IntegrityError
+from django.db.models import Prefetch
+from django.http import Http404
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from django.urls import reverse
+from drf_yasg.openapi import Schema, TYPE_OBJECT, Parameter, IN_QUERY, IN_HEADER, TYPE_STRING, TYPE_INTEGER, \
+    TYPE_NUMBER
 from drf_yasg.utils import swagger_auto_schema, no_body
-from rest_framework import generics, status, viewsets, views, mixins
+from rest_framework import viewsets
 from rest_framework.decorators import action
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.settings import api_settings
-from rest_framework.status import HTTP_201_CREATED, HTTP_200_OK, HTTP_204_NO_CONTENT, HTTP_404_NOT_FOUND
+from rest_framework.status import HTTP_201_CREATED, HTTP_200_OK, HTTP_204_NO_CONTENT, HTTP_404_NOT_FOUND, \
+    HTTP_400_BAD_REQUEST, HTTP_409_CONFLICT, HTTP_202_ACCEPTED, HTTP_503_SERVICE_UNAVAILABLE
 from rest_framework.viewsets import GenericViewSet
 
-from core.models import Product, Cart, Category, Order, CartItem, Address
-from core.serializers import GetCartSerializer, AddItemToCartSerializer, ListProductSerializer, \
+from core.models import Product, Cart, Category, Order, CartItem, Address, CheckoutJob, OrderLine
+from core.facets import facet_counts, filter_products, parse_filters
+from core.idempotency import IdempotentResponseMixin
+from core.metrics import record_checkout
+from core.pagination import KeysetPagination
+from core.rollups import sales_report
+from core.response_cache import CachedResponseMixin
+from core.search import search_products
+from core.serializers import CheckoutJobSerializer, GetCartSerializer, AddItemToCartSerializer, ListProductSerializer, \
     CreateCartSerializer, ListCategorySerializer, RetrieveCategorySerializer, RetrieveProductSerializer, \
-    CreateOrderSerializer, ListOrderSerializer, RetrieveOrderSerializer, AddressSerializer
+    ListOrderSerializer, RetrieveOrderSerializer, AddressSerializer, CartItemQuantitySerializer, CartBatchSerializer, \
+    GetUserSerializer
+from core.services import archive, cart as cart_service, cart_store, checkout as checkout_service, checkout_queue, \
+    inventory
 
 
 # class GetAllUsersView(generics.ListAPIView):
@@ -32,10 +53,15 @@ from core.serializers import GetCartSerializer, AddItemToCartSerializer, ListPro
 #     serializer_class = GetCategorySerializer
 
 
-class CartViewSet(GenericViewSet):
+IDEMPOTENCY_KEY_PARAMETER = Parameter('Idempotency-Key', IN_HEADER, type=TYPE_STRING, required=False,
+                                      description='Retries with the same key replay the first response')
+
+
+class CartViewSet(IdempotentResponseMixin, GenericViewSet):
     permission_classes = [IsAuthenticated]
     queryset = Cart.objects.all()
     serializer_class = CreateCartSerializer
+    idempotent_actions = ('add_item', 'checkout')
 
     def get_success_headers(self, data):
         try:
@@ -61,76 +87,133 @@ class CartViewSet(GenericViewSet):
     )
     @action(detail=False, methods=['get'], url_path='active-cart')
     def get_active_cart(self, request):
-        active_cart = Cart.objects.filter(user=request.user, status='active').first()
-        if active_cart:
-            serializer = GetCartSerializer(active_cart)
-            return Response(serializer.data)
-        else:
-            # create a new cart
-            new_cart = Cart.objects.create(user=request.user, status='active')
-            return Response(GetCartSerializer(new_cart).data)
+        return Response(cart_store.get_active_cart(request.user))
 
     @swagger_auto_schema(
         methods=['post'],
         operation_id='Add item to active cart',
         operation_description='Add an item to the active cart of the current user',
-        request_body=AddItemToCartSerializer,
+        request_body=CartItemQuantitySerializer,
+        manual_parameters=[IDEMPOTENCY_KEY_PARAMETER],
+        responses={HTTP_200_OK: AddItemToCartSerializer}
     )
     @action(detail=False, methods=['post'], url_path='add-item')
     def add_item(self, request):
-        # add the current user active cart id to the request data and calculate the price
-        cart = Cart.objects.filter(user=request.user, status='active').first()
-        if cart:
-            request.data['cart'] = cart.id
-        else:
-            cart = Cart.objects.create(user=request.user, status='active')
-            request.data['cart'] = cart.id
-        request.data['price'] = Product.objects.get(id=request.data['product']).price * request.data['quantity']
-        serializer = AddItemToCartSerializer(data=request.data)
+        serializer = CartItemQuantitySerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        # check if the item is already in the cart
-        if cart.items.filter(product=request.data['product']).exists():
-            # update the quantity
-            item = cart.items.get(product=request.data['product'])
-            item.quantity += request.data['quantity']
-            item.price += request.data['price']
-            item.save()
-            serializer.data['quantity'] = item.quantity
-            serializer.data['price'] = item.price
-            return Response(serializer.data)
+        try:
+            item = cart_store.add_item(request.user, serializer.validated_data['product'],
+                                       serializer.validated_data['quantity'])
+        except Product.DoesNotExist:
+            return Response({'message': 'Product not found'}, status=HTTP_404_NOT_FOUND)
+        return Response(AddItemToCartSerializer(item).data)
 
-        serializer.save(cart=cart)
-        return Response(serializer.data)
+    @swagger_auto_schema(
+        methods=['post'],
+        operation_id='Batch update active cart',
+        operation_description='Apply a list of add/set/remove operations to the active cart in one transaction '
+                              'and return the resulting cart',
+        request_body=CartBatchSerializer,
+        responses={HTTP_200_OK: GetCartSerializer}
+    )
+    @action(detail=False, methods=['post'], url_path='batch')
+    def batch(self, request):
+        serializer = CartBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            cart = cart_store.apply_batch(request.user, serializer.validated_data['operations'])
+        except cart_service.UnknownProducts as exc:
+            return Response({'message': 'Product not found', 'products': exc.product_ids},
+                            status=HTTP_404_NOT_FOUND)
+        except IntegrityError:
+            # a concurrent request created one of the new lines first, nothing was applied
+            return Response({'message': 'Cart was modified concurrently, retry the batch'},
+                            status=HTTP_409_CONFLICT)
+        return Response(GetCartSerializer(cart).data)
 
     @swagger_auto_schema(
         methods=['post'],
         operation_id='Checkout active cart',
         operation_description='Checkout the active cart of the current user',
         request_body=no_body,
+        manual_parameters=[IDEMPOTENCY_KEY_PARAMETER],
         responses={HTTP_200_OK: Schema(type=TYPE_OBJECT, properties={
+            'id': Schema(type='integer'),
             'quantity': Schema(type='integer'),
             'price': Schema(type='number'),
         })}
     )
     @action(detail=False, methods=['post'], url_path='checkout')
     def checkout(self, request):
-        active_cart = Cart.objects.filter(user=request.user, status='active').first()
-        if active_cart:
-            active_cart.status = 'ordered'
-            active_cart.save()
-            # create order
-            print(request.user.id)
-            serializer = CreateOrderSerializer(data={
-                'user': request.user.id,
-                'products': [item.product.id for item in active_cart.items.all()],
-                'price': sum([item.price for item in active_cart.items.all()]),
-                'quantity': sum([item.quantity for item in active_cart.items.all()]),
-            })
-            serializer.is_valid(raise_exception=True)
-            serializer.save()
-            return Response({'quantity': serializer.instance.quantity, 'price': serializer.instance.price})
-        else:
+        try:
+            order = checkout_service.checkout(request.user)
+        except checkout_service.NoActiveCart:
+            record_checkout('sync', 'no_cart')
             return Response({'message': 'No active cart'}, status=HTTP_404_NOT_FOUND)
+        except checkout_service.EmptyCart:
+            record_checkout('sync', 'empty_cart')
+            return Response({'message': 'Cart is empty'}, status=HTTP_400_BAD_REQUEST)
+        except inventory.OutOfStock as exc:
+            record_checkout('sync', 'out_of_stock')
+            return Response({'message': 'Not enough stock', 'products': exc.product_ids}, status=HTTP_409_CONFLICT)
+        except inventory.InventoryBusy:
+            record_checkout('sync', 'busy')
+            return Response({'message': 'Stock is busy, retry shortly'}, status=HTTP_503_SERVICE_UNAVAILABLE,
+                            headers={'Retry-After': '1'})
+        except Exception:
+            record_checkout('sync', 'error')
+            raise
+        record_checkout('sync', 'succeeded')
+        cart_store.forget(request.user)
+        return Response({'id': order.id, 'quantity': order.quantity, 'price': order.price})
+
+    def checkout_job_response(self, request, job, status):
+        data = CheckoutJobSerializer(job).data
+        data['status_url'] = request.build_absolute_uri(reverse('cart-checkout-job', kwargs={'job_id': job.id}))
+        return Response(data, status=status, headers={'Location': data['status_url']})
+
+    @swagger_auto_schema(
+        methods=['post'],
+        operation_id='Queue checkout of active cart',
+        operation_description='Queue the checkout of the active cart and return 202 with a status URL. '
+                              'Retrying with the same Idempotency-Key returns the job created the first time.',
+        request_body=no_body,
+        manual_parameters=[Parameter('Idempotency-Key', IN_HEADER, type=TYPE_STRING, required=True)],
+        responses={HTTP_202_ACCEPTED: CheckoutJobSerializer}
+    )
+    @action(detail=False, methods=['post'], url_path='checkout-async')
+    def checkout_async(self, request):
+        key = request.headers.get('Idempotency-Key', '').strip()
+        if not key or len(key) > 255:
+            return Response({'message': 'An Idempotency-Key header of at most 255 characters is required'},
+                            status=HTTP_400_BAD_REQUEST)
+        try:
+            job, created = checkout_queue.enqueue(request.user, key)
+        except checkout_service.NoActiveCart:
+            return Response({'message': 'No active cart'}, status=HTTP_404_NOT_FOUND)
+        except checkout_service.EmptyCart:
+            return Response({'message': 'Cart is empty'}, status=HTTP_400_BAD_REQUEST)
+        except inventory.OutOfStock as exc:
+            return Response({'message': 'Not enough stock', 'products': exc.product_ids}, status=HTTP_409_CONFLICT)
+        except inventory.InventoryBusy:
+            return Response({'message': 'Stock is busy, retry shortly'}, status=HTTP_503_SERVICE_UNAVAILABLE,
+                            headers={'Retry-After': '1'})
+        if created:
+            cart_store.forget(request.user)
+        return self.checkout_job_response(request, job, HTTP_202_ACCEPTED)
+
+    @swagger_auto_schema(
+        methods=['get'],
+        operation_id='Get checkout job',
+        operation_description='Get the status of a queued checkout',
+        responses={HTTP_200_OK: CheckoutJobSerializer}
+    )
+    @action(detail=False, methods=['get'], url_path=r'checkout-jobs/(?P<job_id>[0-9]+)', url_name='checkout-job')
+    def checkout_job(self, request, job_id=None):
+        job = CheckoutJob.objects.filter(user=request.user, pk=job_id).first()
+        if job is None:
+            return Response({'message': 'Checkout job not found'}, status=HTTP_404_NOT_FOUND)
+        return self.checkout_job_response(request, job, HTTP_200_OK)
 
     @swagger_auto_schema(
         methods=['delete'],
@@ -144,6 +227,7 @@ class CartViewSet(GenericViewSet):
         if active_cart:
             active_cart.status = 'abandoned'
             active_cart.save()
+            cart_store.forget(request.user)
             return Response({'message': 'Cart deleted'}, status=HTTP_204_NO_CONTENT)
         else:
             return Response({'message': 'No active cart'}, status=HTTP_404_NOT_FOUND)
@@ -158,15 +242,11 @@ class CartViewSet(GenericViewSet):
     )
     @action(detail=False, methods=['delete'], url_path='delete-item')
     def delete_item(self, request):
-        active_cart = Cart.objects.filter(user=request.user, status='active').first()
+        active_cart = cart_store.find_active_cart(request.user)
         if active_cart:
             try:
-                item = active_cart.items.get(product=request.data['product'])
-                if item:
-                    item.delete()
-                    return Response({'message': 'Item deleted'}, status=HTTP_204_NO_CONTENT)
-                else:
-                    return Response({'message': 'Item not found'}, status=HTTP_404_NOT_FOUND)
+                cart_store.remove_item(request.user, active_cart, request.data['product'])
+                return Response({'message': 'Item deleted'}, status=HTTP_204_NO_CONTENT)
             except CartItem.DoesNotExist:
                 return Response({'message': 'Item not found'}, status=HTTP_404_NOT_FOUND)
         else:
@@ -176,35 +256,85 @@ class CartViewSet(GenericViewSet):
         methods=['put'],
         operation_id='Update item in active cart',
         operation_description='Update an item in the active cart of the current user',
-        request_body=AddItemToCartSerializer,
+        request_body=CartItemQuantitySerializer,
     )
     @action(detail=False, methods=['put'], url_path='update-item')
     def update_item(self, request):
-        active_cart = Cart.objects.filter(user=request.user, status='active').first()
+        serializer = CartItemQuantitySerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        active_cart = cart_store.find_active_cart(request.user)
         if active_cart:
-            item = active_cart.items.get(product=request.data['product'])
-            item.quantity = request.data['quantity']
-            item.price = item.product.price * item.quantity
-            item.save()
+            try:
+                cart_store.set_item_quantity(request.user, active_cart, serializer.validated_data['product'],
+                                             serializer.validated_data['quantity'])
+            except CartItem.DoesNotExist:
+                return Response({'message': 'Item not found'}, status=HTTP_404_NOT_FOUND)
             return Response({'message': 'Item updated'}, status=HTTP_200_OK)
         else:
             return Response({'message': 'No active cart'}, status=HTTP_404_NOT_FOUND)
 
 
-class ProductViewSet(viewsets.ReadOnlyModelViewSet):
+class ProductViewSet(CachedResponseMixin, viewsets.ReadOnlyModelViewSet):
     permission_classes = [IsAuthenticated]
-    queryset = Product.objects.all()
+    # products nest their categories
+    cache_dependencies = ('product', 'category')
+    # categories are nested in both serializers, prefetch them so a page costs a fixed number of queries
+    queryset = Product.objects.prefetch_related('categories')
+    pagination_class = KeysetPagination
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == 'list':
+            queryset = filter_products(queryset, *parse_filters(self.request.query_params))
+        return queryset
+
+    @swagger_auto_schema(
+        operation_description='List products, optionally filtered by category and price, with facet counts. '
+                              'Category counts honour the price filter and price counts honour the category filter.',
+        manual_parameters=[
+            Parameter('category', IN_QUERY, type=TYPE_STRING, description='Comma separated category ids'),
+            Parameter('min_price', IN_QUERY, type=TYPE_NUMBER, description='Inclusive lower price bound'),
+            Parameter('max_price', IN_QUERY, type=TYPE_NUMBER, description='Exclusive upper price bound'),
+        ]
+    )
+    def list(self, request, *args, **kwargs):
+        response = super().list(request, *args, **kwargs)
+        response.data['facets'] = facet_counts(*parse_filters(request.query_params))
+        return response
 
     def get_serializer_class(self):
-        if self.action == 'list':
+        if self.action in ('list', 'search'):
             return ListProductSerializer
         if self.action == 'retrieve':
             return RetrieveProductSerializer
         return super().get_serializer_class()
 
+    @swagger_auto_schema(
+        methods=['get'],
+        operation_id='Search products',
+        operation_description='Full-text search over product title, summary and description, best match first',
+        manual_parameters=[
+            Parameter('q', IN_QUERY, type=TYPE_STRING, required=True),
+            Parameter('limit', IN_QUERY, type=TYPE_INTEGER, default=20),
+        ],
+        responses={HTTP_200_OK: ListProductSerializer(many=True)}
+    )
+    @action(detail=False, methods=['get'], url_path='search')
+    def search(self, request):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({'message': 'Missing search query'}, status=HTTP_400_BAD_REQUEST)
+        try:
+            limit = min(max(int(request.query_params.get('limit', 20)), 1), 100)
+        except ValueError:
+            limit = 20
+        products = search_products(query, limit=limit)
+        return Response({'results': ListProductSerializer(products, many=True, context={'request': request}).data})
+
 
-class CategoryViewSet(viewsets.ReadOnlyModelViewSet):
+class CategoryViewSet(CachedResponseMixin, viewsets.ReadOnlyModelViewSet):
     permission_classes = [IsAuthenticated]
+    cache_dependencies = ('category',)
     queryset = Category.objects.all()
 
     def get_serializer_class(self):
@@ -218,6 +348,31 @@ class CategoryViewSet(viewsets.ReadOnlyModelViewSet):
 class OrderViewSet(viewsets.ReadOnlyModelViewSet):
     permission_classes = [IsAuthenticated]
     queryset = Order.objects.all()
+    pagination_class = KeysetPagination
+
+    def get_queryset(self):
+        queryset = super().get_queryset().filter(user=self.request.user)
+        if self.action == 'retrieve':
+            # products with their categories and the lines in a fixed number of queries, however big the order
+            products = Product.objects.prefetch_related('categories').order_by('id')
+            lines = OrderLine.objects.order_by('id')
+            queryset = queryset.prefetch_related(Prefetch('products', queryset=products),
+                                                 Prefetch('lines', queryset=lines))
+        return queryset
+
+    def retrieve(self, request, *args, **kwargs):
+        try:
+            return super().retrieve(request, *args, **kwargs)
+        except Http404:
+            # moved to cold storage by the archive_records command
+            try:
+                order_id = int(kwargs[self.lookup_field])
+            except (TypeError, ValueError):
+                raise Http404
+            data = archive.get_archived_order(request.user, order_id)
+            if data is None:
+                raise
+            return Response(data)
 
     def get_serializer_class(self):
         if self.action == 'list':
@@ -227,10 +382,11 @@ class OrderViewSet(viewsets.ReadOnlyModelViewSet):
         return super().get_serializer_class()
 
 
-class AddressViewSet(GenericViewSet):
+class AddressViewSet(IdempotentResponseMixin, GenericViewSet):
     permission_classes = [IsAuthenticated]
     queryset = Address.objects.all()
     serializer_class = AddressSerializer
+    idempotent_actions = ('create_address',)
 
     @swagger_auto_schema(
         methods=['get'],
@@ -299,6 +455,7 @@ class AddressViewSet(GenericViewSet):
         operation_id='Create address',
         operation_description='Create an address for the current user',
         request_body=AddressSerializer,
+        manual_parameters=[IDEMPOTENCY_KEY_PARAMETER],
         responses={HTTP_201_CREATED: Schema(type=TYPE_OBJECT, properties={
             'id': Schema(type='integer'),
             'address': Schema(type='string'),
@@ -313,3 +470,98 @@ class AddressViewSet(GenericViewSet):
         serializer.is_valid(raise_exception=True)
         serializer.save()
         return Response(serializer.data, status=HTTP_201_CREATED)
+
+    bundle_sections = ('profile', 'addresses', 'cart', 'orders')
+    # recent orders returned by the bundle
+    bundle_orders = 5
+
+    @swagger_auto_schema(
+        methods=['get'],
+        operation_id='Get startup bundle',
+        operation_description='The profile, addresses, active cart and most recent orders of the current user in '
+                              'one response. `include` limits the response to a comma separated list of those '
+                              'sections.',
+        manual_parameters=[Parameter('include', IN_QUERY, type=TYPE_STRING,
+                                     description='Comma separated subset of profile, addresses, cart, orders')],
+    )
+    @action(detail=False, methods=['get'], url_path='bundle')
+    def bundle(self, request):
+        include = request.query_params.get('include')
+        sections = self.bundle_sections
+        if include:
+            sections = [section.strip() for section in include.split(',') if section.strip()]
+            unknown = set(sections) - set(self.bundle_sections)
+            if unknown:
+                raise ValidationError({'include': f'Unknown sections: {", ".join(sorted(unknown))}'})
+
+        data = {}
+        if 'profile' in sections:
+            # the user comes from the authentication cache, no query
+            data['profile'] = GetUserSerializer(request.user).data
+        if 'addresses' in sections:
+            data['addresses'] = AddressSerializer(Address.objects.filter(user=request.user).order_by('id'),
+                                                  many=True).data
+        if 'cart' in sections:
+            data['cart'] = cart_store.get_active_cart(request.user)
+        if 'orders' in sections:
+            orders = Order.objects.filter(user=request.user).order_by('-created_at', '-id')[:self.bundle_orders]
+            data['orders'] = ListOrderSerializer(orders, many=True).data
+        return Response(data)
+
+
+class ReportViewSet(GenericViewSet):
+    permission_classes = [IsAdminUser]
+    # longest range a single report may cover
+    max_days = 366
+
+    def parse_day(self, request, name, default):
+        value = request.query_params.get(name)
+        if not value:
+            return default
+        try:
+            day = parse_date(value)
+        except ValueError:
+            day = None
+        if day is None:
+            raise ValidationError({name: 'Expected a date as YYYY-MM-DD'})
+        return day
+
+    @swagger_auto_schema(
+        methods=['get'],
+        operation_id='Sales report',
+        operation_description='Orders, units and revenue per day from the precomputed sales rollups, for the '
+                              'whole shop, per product or per category, plus the sums over the range',
+        manual_parameters=[
+            Parameter('dimension', IN_QUERY, type=TYPE_STRING, enum=['total', 'product', 'category']),
+            Parameter('start', IN_QUERY, type=TYPE_STRING, format='date'),
+            Parameter('end', IN_QUERY, type=TYPE_STRING, format='date'),
+            Parameter('id', IN_QUERY, type=TYPE_STRING, description='Comma separated product or category ids'),
+        ],
+    )
+    @action(detail=False, methods=['get'], url_path='sales')
+    def sales(self, request):
+        dimension = request.query_params.get('dimension', 'total')
+        if dimension not in ('total', 'product', 'category'):
+            raise ValidationError({'dimension': 'Expected total, product or category'})
+        end = self.parse_day(request, 'end', timezone.localdate())
+        start = self.parse_day(request, 'start', end - timedelta(days=29))
+        if start > end or (end - start).days >= self.max_days:
+            raise ValidationError({'start': f'Expected a range of 1 to {self.max_days} days ending at end'})
+        try:
+            keys = [int(key) for key in request.query_params.get('id', '').split(',') if key]
+        except ValueError:
+            raise ValidationError({'id': 'Expected comma separated ids'})
+        report = sales_report(dimension, start, end, keys)
+        return Response({'dimension': dimension, 'start': start, 'end': end, **report})
+
+    @swagger_auto_schema(
+        methods=['get'],
+        operation_id='Cache report',
+        operation_description='Hit, miss, eviction and invalidation counters of the in-process cache tier of the '
+                              'worker answering the request',
+    )
+    @action(detail=False, methods=['get'], url_path='cache')
+    def cache(self, request):
+        if not hasattr(cache, 'stats'):
+            raise NotFound('The default cache has no in-process tier')
+        return Response(cache.stats())
@@ -62,8 +62,36 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated',
     ),
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'dj_rest_auth.jwt_auth.JWTCookieAuthentication',
-    )
+        'core.authentication.CachedJWTCookieAuthentication',
+    ),
+    'DEFAULT_THROTTLE_CLASSES': (
+        'core.throttling.TokenBucketThrottle',
+    ),
+    # proxies in front of the app (Render's load balancer), the client IP is taken from the
+    # X-Forwarded-For entry the outermost one appended rather than whatever the client sent
+    'NUM_PROXIES': int(os.getenv("NUM_PROXIES", 1)),
+}
+
+# Token buckets of core.throttling: the URL names each one covers, the rate it refills at,
+# how many requests it allows in a burst and whether clients are told apart by user or by IP
+TOKEN_BUCKETS = {
+    'login': {
+        'routes': ['user-login'],
+        'rate': '10/min', 'burst': 10, 'key': 'ip',
+    },
+    'registration': {
+        'routes': ['rest_register'],
+        'rate': '10/hour', 'burst': 5, 'key': 'ip',
+    },
+    'password-reset': {
+        'routes': ['rest_password_reset', 'rest_password_reset_confirm', 'rest_password_change'],
+        'rate': '10/hour', 'burst': 5, 'key': 'ip',
+    },
+    'cart': {
+        'routes': ['cart-add-item', 'cart-batch', 'cart-update-item', 'cart-delete-item', 'cart-abandon',
+                   'cart-checkout', 'cart-checkout-async'],
+        'rate': '120/min', 'burst': 60, 'key': 'user',
+    },
 }
 
 SIMPLE_JWT = {
@@ -81,6 +109,7 @@ REST_AUTH = {
     'LOGIN_SERIALIZER': 'core.serializers.UserLoginSerializer',
     'REGISTER_SERIALIZER': 'core.serializers.UserRegistrationSerializer',
     'USER_DETAILS_SERIALIZER': 'core.serializers.GetUserSerializer',
+    'JWT_TOKEN_CLAIMS_SERIALIZER': 'core.serializers.TokenClaimsSerializer',
     'USE_JWT': True,
     'JWT_AUTH_COOKIE': 'jwt-auth',
     'JWT_AUTH_REFRESH_COOKIE': 'jwt-refresh-auth',
@@ -100,14 +129,18 @@ AUTH_USER_MODEL = 'core.User'
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'core.metrics.MetricsMiddleware',
+    'core.instrumentation.QueryInstrumentationMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'core.routers.ReadYourWritesMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     "allauth.account.middleware.AccountMiddleware",
-    "whitenoise.middleware.WhiteNoiseMiddleware",
+    # whitenoise's middleware with an async path, see core.static
+    "core.static.WhiteNoiseMiddleware",
 
 ]
 
@@ -155,6 +188,16 @@ WSGI_APPLICATION = 'djangoEcommerce.wsgi.application'
 #     }
 # }
 
+# Seconds a connection is kept open across requests (0 opens a new one per request), whether it is
+# pinged before being reused after a request, and an optional psycopg 3 connection pool
+# (Django 5.1+, pip install "psycopg[pool]") that replaces the persistent connections
+DB_CONN_MAX_AGE = int(os.getenv("DB_CONN_MAX_AGE", 60))
+DB_CONN_HEALTH_CHECKS = os.getenv("DB_CONN_HEALTH_CHECKS", "true").lower() in ("1", "true", "yes")
+DB_POOL = os.getenv("DB_POOL", "false").lower() in ("1", "true", "yes")
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 2))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))
+
 DATABASES = {
     # "default": {
     #     "ENGINE": "django.db.backends.postgresql",
@@ -164,9 +207,115 @@ DATABASES = {
     #     "HOST": os.getenv("DB_HOST"),
     #     "PORT": os.getenv("DB_PORT"),
     # }
-    "default": dj_database_url.parse(os.environ.get("DB_URL"))
+    "default": dj_database_url.parse(
+        os.environ.get("DB_URL"),
+        conn_max_age=DB_CONN_MAX_AGE,
+        conn_health_checks=DB_CONN_HEALTH_CHECKS,
+    )
+}
+
+# Read replicas for the catalog and order history: comma separated database URLs, their weights in
+# the round-robin (1 each by default) and the seconds a user's reads stay on the primary after a write
+DB_REPLICA_URLS = [url for url in os.getenv("DB_REPLICA_URLS", "").split(",") if url]
+DB_REPLICA_WEIGHTS = [int(weight) for weight in os.getenv("DB_REPLICA_WEIGHTS", "").split(",") if weight]
+READ_YOUR_WRITES_WINDOW = int(os.getenv("READ_YOUR_WRITES_WINDOW", 5))
+
+REPLICA_DATABASES = {}
+for index, url in enumerate(DB_REPLICA_URLS):
+    alias = f"replica{index + 1}"
+    DATABASES[alias] = dj_database_url.parse(
+        url,
+        conn_max_age=DB_CONN_MAX_AGE,
+        conn_health_checks=DB_CONN_HEALTH_CHECKS,
+        # tests read the replicas through the primary's test database
+        test_options={"MIRROR": "default"},
+    )
+    REPLICA_DATABASES[alias] = DB_REPLICA_WEIGHTS[index] if index < len(DB_REPLICA_WEIGHTS) else 1
+
+DATABASE_ROUTERS = ["core.routers.ReplicaRouter"]
+
+if DB_POOL:
+    for database in DATABASES.values():
+        # psycopg 3's pool hands out the connections, Django must close them after every request
+        database["CONN_MAX_AGE"] = 0
+        database.setdefault("OPTIONS", {})["pool"] = {
+            "min_size": DB_POOL_MIN_SIZE,
+            "max_size": DB_POOL_MAX_SIZE,
+            "timeout": DB_POOL_TIMEOUT,
+        }
+
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+# Use a shared Redis cache when REDIS_URL is set so every worker sees the same entries,
+# otherwise fall back to a per-process cache for local development and tests.
+# The default cache keeps the hottest keys (versioned catalog responses, cached user rows)
+# in a small per-process LRU in front of the shared one, see core.cache_backends.
+
+if os.getenv("REDIS_URL"):
+    SHARED_CACHE = {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": os.getenv("REDIS_URL"),
+    }
+else:
+    SHARED_CACHE = {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "djangoEcommerce",
+    }
+
+CACHES = {
+    "default": {
+        "BACKEND": "core.cache_backends.TieredCache",
+        "LOCATION": "shared",
+        "OPTIONS": {
+            # the response versions change often and get their own prefix, see core.response_cache
+            "L1_PREFIXES": ["response-cache:", "response-version:", "auth-user:"],
+            "L1_MAX_ENTRIES": int(os.getenv("CACHE_L1_MAX_ENTRIES", 1000)),
+            # seconds an entry may be served from the process without asking the shared cache,
+            # and how often the process looks for invalidations made by other workers
+            "L1_TIMEOUT": float(os.getenv("CACHE_L1_TIMEOUT", 5)),
+            "L1_CHECK_INTERVAL": float(os.getenv("CACHE_L1_CHECK_INTERVAL", 1)),
+        },
+    },
+    "shared": SHARED_CACHE,
 }
 
+# Seconds a cached catalog response lives before it is rebuilt even without a change
+RESPONSE_CACHE_TIMEOUT = int(os.getenv("RESPONSE_CACHE_TIMEOUT", 60 * 15))
+
+# Idempotency-Key handling for mutating endpoints: how long a recorded response is replayed,
+# how long a retry waits for the original request and after how long an unfinished one is abandoned
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", 60 * 60 * 24))
+IDEMPOTENCY_WAIT_TIMEOUT = float(os.getenv("IDEMPOTENCY_WAIT_TIMEOUT", 10))
+IDEMPOTENCY_LOCK_TIMEOUT = int(os.getenv("IDEMPOTENCY_LOCK_TIMEOUT", 60))
+
+# Inventory: counter rows a product's stock is spread over, how long a reservation holds stock
+# and how long a reservation may wait on a counter row lock before giving up (PostgreSQL)
+INVENTORY_SHARDS = int(os.getenv("INVENTORY_SHARDS", 8))
+INVENTORY_RESERVATION_TTL = int(os.getenv("INVENTORY_RESERVATION_TTL", 60 * 15))
+INVENTORY_LOCK_TIMEOUT_MS = int(os.getenv("INVENTORY_LOCK_TIMEOUT_MS", 200))
+
+# Age in days after which the archive_records command moves orders and closed carts to the archive tables
+ARCHIVE_ORDERS_AFTER_DAYS = int(os.getenv("ARCHIVE_ORDERS_AFTER_DAYS", 365))
+ARCHIVE_CARTS_AFTER_DAYS = int(os.getenv("ARCHIVE_CARTS_AFTER_DAYS", 90))
+
+# Seconds an order must be old before roll_up_sales folds it in, so a checkout still
+# committing with a lower id is not skipped by the watermark
+SALES_ROLLUP_LAG = int(os.getenv("SALES_ROLLUP_LAG", 60))
+
+# Seconds the user row behind a JWT stays cached by core.authentication
+AUTH_USER_CACHE_TIMEOUT = int(os.getenv("AUTH_USER_CACHE_TIMEOUT", 60 * 15))
+
+# Share of requests whose SQL queries are counted and timed (reported in a Server-Timing header to
+# staff users), and the duration in ms or query count above which such a request is logged with
+# its most repeated queries
+SQL_SAMPLE_RATE = float(os.getenv("SQL_SAMPLE_RATE", 0.05))
+SLOW_REQUEST_MS = int(os.getenv("SLOW_REQUEST_MS", 500))
+SLOW_REQUEST_QUERIES = int(os.getenv("SLOW_REQUEST_QUERIES", 30))
+
+# Bearer token required to scrape /metrics. When empty only direct requests from loopback or private
+# addresses are answered (anyone with DEBUG on)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
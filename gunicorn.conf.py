@@ -0,0 +1,38 @@
+# Loaded by gunicorn from the working directory before it starts the workers.
+import glob
+import os
+import tempfile
+
+# every process writes its metrics here so /metrics can add them up, see core.metrics. The
+# process_checkout_jobs command uses the same default so its workers are counted too.
+# prometheus_client picks its storage when imported, so this has to come first
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "djangoEcommerce-metrics"))
+
+from prometheus_client import multiprocess  # noqa: E402
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # someone else's process
+        return True
+    return True
+
+
+def on_starting(server):
+    # values left by a previous run would be counted again, but checkout workers started on their own
+    # (process_checkout_jobs) share the directory and may still be writing to their files
+    directory = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, "*.db")):
+        # <metric type>_<pid>.db
+        pid = os.path.basename(path)[:-len(".db")].rsplit("_", 1)[-1]
+        if not pid.isdigit() or not _alive(int(pid)):
+            os.remove(path)
+
+
+def child_exit(server, worker):
+    multiprocess.mark_process_dead(worker.pid)